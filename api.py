@@ -1,41 +1,86 @@
-from fastapi import FastAPI, HTTPException, status
-from pydantic import BaseModel, Field
-from typing import Optional
+import providers  # Loads .env before any module reads its settings
+import asyncio
+import os
+import re
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import List, Literal, Optional
 
-# Import your modules
-from tts import get_audio_base64_from_story
-from imageGen import generate_and_save_image
-from brainStorming import get_brainstorming_ideas
-from chapter import generate_story_chapter
-from character import generate_character_profile
-from outline import generate_plot_outline
-from quick_edit import perform_quick_edit
-from rewrite import get_rewritten_text
-
-from fastapi import FastAPI, HTTPException, status
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
-from typing import Optional
 
 # Import your modules
-from tts import get_audio_base64_from_story
-from imageGen import generate_and_save_image
-from brainStorming import get_brainstorming_ideas
-from chapter import generate_story_chapter
-from character import generate_character_profile
-from outline import generate_plot_outline
-from quick_edit import perform_quick_edit
-from rewrite import get_rewritten_text
+from tts import astream_story_audio
+from imageGen import image_path, image_status, submit_image
+from brainStorming import aget_brainstorming_ideas, semantic_cache
+from chapter import agenerate_story_chapter, astream_story_chapter
+from character import agenerate_character_profile
+from outline import agenerate_plot_outline
+from quick_edit import aperform_quick_edit, aperform_quick_edit_patch, patch_view
+from rewrite import MAX_REWRITE_VARIANTS, aget_rewritten_text
+from concurrency import endpoint_limit, run_batch, run_blocking
+from cache import all_stats
+import cache
+import jobs
+import pipeline
+import resilience
+import retrieval
+import router
+import sessions
+import tokens
+import transport
+from metrics import MetricsMiddleware, TimedJSONResponse, render_metrics
+from transport import TransportMiddleware, dumps
+
+# How long a stopping process lets running background jobs finish (see serve.py)
+SERVE_DRAIN_SECONDS = float(os.getenv("SERVE_DRAIN_SECONDS", "120"))
+
+# Readiness of this process (see /ready): set once warmed up, cleared when it starts draining
+readiness = {"ready": False, "warmup_seconds": None, "warmup_errors": []}
+
+
+def warm_up():
+    """
+    Prepares this process before it takes traffic: builds the model clients, opens
+    the shared databases and loads the semantic cache entries stored so far.
+    """
+    start = time.perf_counter()
+    errors = providers.warm_up()
+    cache.warm_up()
+    semantic_cache.sync()
+    readiness.update(warmup_seconds=round(time.perf_counter() - start, 3), warmup_errors=errors)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await asyncio.get_running_loop().run_in_executor(None, warm_up)
+    # Run background jobs (see /jobs/) while the app is up
+    await jobs.start(error_status=lambda error: upstream_error(error).status_code)
+    readiness["ready"] = True
+    try:
+        yield
+    finally:
+        readiness["ready"] = False
+        await jobs.stop(drain_seconds=SERVE_DRAIN_SECONDS)
 
-import uvicorn
-import json  # Necessary for imageGen and tts
 
 app = FastAPI(
     title="AI Storytelling API",
     description="A collection of APIs for generating and manipulating story content.",
     version="1.0.0",
+    default_response_class=TimedJSONResponse,
+    lifespan=lifespan,
 )
 
+# Add compression and ETag middleware (see transport.py)
+app.add_middleware(TransportMiddleware)
+
+# Add request metrics middleware (see /metrics); it wraps the transport one, so sizes are bytes on the wire
+app.add_middleware(MetricsMiddleware)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -45,15 +90,6 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
-import uvicorn
-import json  # Necessary for imageGen and tts
-
-app = FastAPI(
-    title="AI Storytelling API",
-    description="A collection of APIs for generating and manipulating story content.",
-    version="1.0.0",
-)
-
 
 class StoryRequest(BaseModel):
     story: str = Field(..., description="The story text to be converted to speech.")
@@ -61,6 +97,7 @@ class StoryRequest(BaseModel):
 
 class ImageRequest(BaseModel):
     prompt: str = Field(..., description="The prompt for image generation.")
+    wait: bool = Field(True, description="Wait for the image to be generated. If false, returns 202 with the image ID right away.")
 
 
 class IdeaRequest(BaseModel):
@@ -68,66 +105,318 @@ class IdeaRequest(BaseModel):
     list_of: str = Field(..., description="The type of ideas to generate.")
     context: Optional[str] = Field(None, description="Optional context for brainstorming.")
     examples: Optional[str] = Field(None, description="Optional examples for brainstorming.")
+    use_cache: bool = Field(True, description="Set to false to bypass the response cache.")
 
 
 class ChapterRequest(BaseModel):
     plot_point: str = Field(..., description="The main event or development for this chapter.")
-    previous_chapters: str = Field(..., description="Text of the previous chapters for context.")
-    character_data: str = Field(..., description="Description of characters involved in the story.")
-    worldbuilding_data: str = Field(..., description="Information about the story's world, setting, and rules.")
+    previous_chapters: Optional[str] = Field(None, description="Text of the previous chapters for context. Taken from the session if omitted.")
+    character_data: Optional[str] = Field(None, description="Description of characters involved in the story. Taken from the session if omitted.")
+    worldbuilding_data: Optional[str] = Field(None, description="Information about the story's world, setting, and rules. Taken from the session if omitted.")
     user_genre: str = Field(..., description="The genre of the story (e.g., Fantasy, Romance, Thriller).")
     user_style: str = Field(..., description="User-specified style, including length or stylistic preferences.")
+    session_id: Optional[str] = Field(None, pattern=sessions.SESSION_ID_PATTERN, description="Story session to read previous chapters, characters and worldbuilding from.")
+    append_to_session: bool = Field(False, description="Append the generated chapter to the session.")
+    mode: Literal["single", "parallel"] = Field("single", description="\"parallel\" plans the chapter into scenes and writes them concurrently (/chapter/ only).")
 
 
 class CharacterRequest(BaseModel):
     user_character_description: str = Field(..., description="Description of the character's role, appearance, or other traits.")
     user_genre: str = Field(..., description="The genre of the story (e.g., Fantasy, Romance, Thriller).")
+    use_cache: bool = Field(True, description="Set to false to bypass the response cache.")
 
 
 class OutlineRequest(BaseModel):
     user_premise: str = Field(..., description="The main idea or scenario of the story.")
     user_genre: str = Field(..., description="The genre of the story (e.g., Fantasy, Romance, Thriller).")
+    use_cache: bool = Field(True, description="Set to false to bypass the response cache.")
 
 
 class QuickEditRequest(BaseModel):
     user_request: str = Field(..., description="Specific editing request from the user.")
-    document_text: str = Field(..., description="The current story text to be edited.")
-    character_data: str = Field(..., description="Character information for context.")
-    worldbuilding_data: str = Field(..., description="Worldbuilding details for consistency.")
+    document_text: Optional[str] = Field(None, description="The current story text to be edited. Taken from the session if omitted.")
+    character_data: Optional[str] = Field(None, description="Character information for context. Taken from the session if omitted.")
+    worldbuilding_data: Optional[str] = Field(None, description="Worldbuilding details for consistency. Taken from the session if omitted.")
     user_genre: str = Field(..., description="The genre of the story (e.g., Fantasy, Romance, Thriller).")
+    session_id: Optional[str] = Field(None, pattern=sessions.SESSION_ID_PATTERN, description="Story session to read the document, characters and worldbuilding from.")
+    mode: Literal["full", "patch"] = Field("full", description="\"patch\" sends only relevant paragraphs and returns paragraph edits plus the merged text.")
 
 
 class RewriteRequest(BaseModel):
     selected_text: str = Field(..., description="The text to be rewritten.")
-    rewrite_type: str = Field(..., description="The type of rewriting (shorter, longer, more_intense, more_descriptive, custom).")
+    rewrite_type: Literal["shorter", "longer", "more_intense", "more_descriptive", "custom"] = Field(..., description="The type of rewriting.")
     custom_prompt: Optional[str] = Field(None, description="Optional custom instructions for rewriting.")
+    variants: int = Field(1, ge=1, le=MAX_REWRITE_VARIANTS, description="Number of alternative rewrites, generated in a single model call.")
+    use_cache: bool = Field(True, description="Set to false to bypass the response cache.")
+
+
+class BookRequest(BaseModel):
+    user_premise: str = Field(..., description="The main idea or scenario of the story.")
+    user_genre: str = Field(..., description="The genre of the story (e.g., Fantasy, Romance, Thriller).")
+    user_style: str = Field(..., description="User-specified style for the chapters, including length or stylistic preferences.")
+    characters: List[str] = Field(default_factory=list, description="One description per character to create.")
+    worldbuilding_data: Optional[str] = Field(None, description="Information about the story's world, setting, and rules.")
+    chapter_mode: Literal["single", "parallel"] = Field("single", description="How each chapter is written (see /chapter/).")
+    create_session: bool = Field(True, description="Store the finished book in a story session.")
+    use_cache: bool = Field(True, description="Set to false to bypass the response cache for the outline and profiles.")
+
+
+class CharacterBatchRequest(BaseModel):
+    items: List[CharacterRequest] = Field(..., description="Character requests to run concurrently.")
+
+
+class RewriteBatchRequest(BaseModel):
+    items: List[RewriteRequest] = Field(..., description="Rewrite requests to run concurrently.")
+
+
+class IdeaBatchRequest(BaseModel):
+    items: List[IdeaRequest] = Field(..., description="Brainstorming requests to run concurrently.")
+
+
+class SessionCreateRequest(BaseModel):
+    previous_chapters: List[str] = Field(default_factory=list, description="Initial chapters, oldest first.")
+    character_data: Optional[str] = Field(None, description="Description of characters involved in the story.")
+    worldbuilding_data: Optional[str] = Field(None, description="Information about the story's world, setting, and rules.")
+    document_text: Optional[str] = Field(None, description="The current story text used by quick edits.")
+
+
+class SessionChapterRequest(BaseModel):
+    chapter_text: str = Field(..., description="Text of the chapter to append.")
+
+
+class SessionTextRequest(BaseModel):
+    text: str = Field(..., description="New text for the session field.")
+
+
+def upstream_error(error: Exception) -> HTTPException:
+    """
+    Maps a failure to an HTTP error: inputs over the token budget become 413, provider
+    rate limits 429, unavailable providers (including an open circuit breaker) 503,
+    anything else is a 500.
+    """
+    code = resilience.status_code_of(error)
+    if isinstance(error, tokens.PromptTooLarge):
+        return HTTPException(status_code=status.HTTP_413_CONTENT_TOO_LARGE, detail=str(error))
+    if code == 429:
+        return HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(error))
+    if code in (502, 503, 504):
+        return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(error))
+    return HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(error))
+
+
+IMAGE_ID = re.compile(r"^[0-9a-f]{64}$")
+RANGE_HEADER = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Checks the If-None-Match header against an ETag value."""
+    return transport.etag_matches(request.headers.get("if-none-match"), etag)
+
+
+def file_response(request: Request, path: str, etag: str, media_type: str) -> Response:
+    """
+    Serves an immutable file with an ETag, answering If-None-Match with 304 and a
+    single `Range: bytes=start-end` request with 206 Partial Content.
+    """
+    headers = {
+        "ETag": f'"{etag}"',
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "public, max-age=31536000, immutable",
+    }
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    size = os.path.getsize(path)
+    range_header = request.headers.get("range")
+    if not range_header:
+        return FileResponse(path, media_type=media_type, headers=headers)
+
+    match = RANGE_HEADER.match(range_header.strip())
+    if match is None or match.group(1) == match.group(2) == "":
+        return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers={"Content-Range": f"bytes */{size}"})
+    if match.group(1) == "":
+        # Suffix range: the last N bytes
+        start, end = max(size - int(match.group(2)), 0), size - 1
+    else:
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    if start >= size or start > end:
+        return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers={"Content-Range": f"bytes */{size}"})
+
+    with open(path, "rb") as file:
+        file.seek(start)
+        content = file.read(end - start + 1)
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return Response(content, status_code=status.HTTP_206_PARTIAL_CONTENT, media_type=media_type, headers=headers)
+
+
+def session_text(session_id: Optional[str], field: str, value: Optional[str]) -> str:
+    """
+    Returns value if the client sent it, otherwise the text stored in the session.
+    Raises 404 for an unknown session and 422 when neither is available. Reads session
+    files, so handlers call it in the blocking pool (through the *_inputs helpers).
+    """
+    if value is not None:
+        return value
+    if not session_id:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f"{field} is required when no session_id is given")
+    try:
+        if field == "previous_chapters":
+            return "\n\n\n".join(sessions.resolve_chapters(session_id))
+        return sessions.resolve_text(session_id, field)
+    except sessions.SessionNotFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Session {session_id} not found")
+
+
+def fit_request(endpoint: str, fields: dict, trimmable: dict = None) -> dict:
+    """Applies the endpoint's token budget to request fields, raising 413 when they do not fit."""
+    try:
+        return tokens.fit_to_budget(endpoint, fields, trimmable)
+    except tokens.PromptTooLarge as e:
+        raise upstream_error(e)
+
+
+def idea_inputs(request: IdeaRequest) -> dict:
+    """Checks a brainstorming request against its token budget; context and examples may be trimmed."""
+    fields = {"category": request.category, "list_of": request.list_of, "context": request.context, "examples": request.examples}
+    return tokens.fit_to_budget("brainstorming", fields, {"context": "head", "examples": "head"})
+
+
+def story_data_fields(session_id: Optional[str], character_data: Optional[str], worldbuilding_data: Optional[str],
+                      query: str, context: str = "") -> dict:
+    """
+    Resolves character and worldbuilding data. With retrieval enabled they are narrowed
+    here, and only here, to the entries relevant to query (see retrieval.py), so the
+    endpoint's budget applies to the text that is actually sent.
+    """
+    selected = retrieval.select_story_data(
+        session_text(session_id, "character_data", character_data),
+        session_text(session_id, "worldbuilding_data", worldbuilding_data),
+        query, context,
+    )
+    return dict(zip(("character_data", "worldbuilding_data"), selected))
+
+
+def chapter_inputs(request: ChapterRequest) -> dict:
+    """
+    Resolves the keyword arguments for chapter generation from the request and its session.
+    Previous chapters are compacted to fit later, so only the other fields count against the budget here.
+    Reads session files and ranks story data, so it runs in the blocking pool.
+    """
+    if request.session_id and request.append_to_session:
+        # The chapter is appended after generation, so an unknown session is reported before it
+        try:
+            sessions.get_session(request.session_id)
+        except sessions.SessionNotFound:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Session {request.session_id} not found")
+    previous_chapters = session_text(request.session_id, "previous_chapters", request.previous_chapters)
+    story_data = story_data_fields(request.session_id, request.character_data, request.worldbuilding_data,
+                                   request.plot_point, retrieval.recent_words(previous_chapters))
+    fields = fit_request("chapter", {
+        "plot_point": request.plot_point,
+        **story_data,
+        "user_genre": request.user_genre,
+        "user_style": request.user_style,
+    }, {"character_data": "head", "worldbuilding_data": "head"})
+    fields["previous_chapters"] = previous_chapters
+    return fields
 
 # TTS Endpoint
+class ReleasingStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that awaits `release()` once it has been sent or abandoned,
+    including when the client disconnects before the body is iterated at all.
+    """
+
+    def __init__(self, content, release, **kwargs):
+        super().__init__(content, **kwargs)
+        self.release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.release()
+
+
 @app.post("/tts/", tags=["Text-to-Speech"])
 async def text_to_speech(request: StoryRequest):
-    """Converts story text to speech and returns audio as base64 string."""
-    try:
-        # Get the story text from the request
-        story_text = request.story
-        
-        # Get the base64 audio from the story
-        get_audio_base64_from_story(story_text)
-        
-        # Return the base64 audio as JSON
-        # return response
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    """
+    Converts story text to speech and streams the MP3 audio back as it is produced.
+
+    The story is split into sentence/paragraph chunks that are converted concurrently
+    and sent in order, so playback can start after the first sentence.
+    """
+    if not request.story.strip():
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No story provided")
+
+    # One slot of the tts limit is held from the first chunk until the response is done
+    slot = AsyncExitStack()
+    await slot.enter_async_context(endpoint_limit("tts"))
+    audio_chunks = astream_story_audio(request.story)
+
+    async def release():
+        await audio_chunks.aclose()
+        await slot.aclose()
 
-# Image Generation Endpoint
-@app.post("/imageGen/", tags=["Image Generation"])
-async def generate_image(request: ImageRequest):
-    """Generates an image from a text prompt."""
     try:
-        json_input = request.json()  # Access the raw JSON string
-        result = generate_and_save_image(json_input)
-        return json.loads(result)  # Return result as a dictionary
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+        # Convert the first chunk before answering so failures still return a 500
+        first_chunk = await audio_chunks.__anext__()
+    except BaseException as e:
+        # Also on cancellation, e.g. a client that left while the first chunk was converted
+        await release()
+        if isinstance(e, Exception):
+            raise upstream_error(e)
+        raise
+
+    async def audio_stream():
+        yield first_chunk
+        async for chunk in audio_chunks:
+            yield chunk
+
+    # The response releases the slot, so it is freed even if the body is never iterated
+    return ReleasingStreamingResponse(audio_stream(), release, media_type="audio/mpeg")
+
+# Image Generation Endpoints
+@app.post("/imageGen/", tags=["Image Generation"])
+async def generate_image(request: ImageRequest, http_request: Request):
+    """
+    Generates an image from a text prompt.
+
+    Images are stored under a hash of prompt, model, size and steps, so a repeated
+    prompt is served immediately. With `wait=false` the call returns 202 right away
+    and the status can be polled at /imageGen/{image_id}.
+    """
+    if not request.prompt:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No prompt provided")
+
+    key, future = submit_image(request.prompt)
+    result = {"image_id": key, "download_link": str(http_request.url_for("get_image", image_id=key))}
+    if future is not None and not request.wait:
+        return TimedJSONResponse(dict(result, status="pending"), status_code=status.HTTP_202_ACCEPTED)
+    if future is not None:
+        try:
+            await asyncio.wrap_future(future)
+        except Exception as e:
+            raise upstream_error(e)
+    return dict(result, status="ready")
+
+
+@app.get("/imageGen/{image_id}", tags=["Image Generation"])
+async def get_image_status(image_id: str):
+    """Returns whether an image is ready, still pending or failed."""
+    if not IMAGE_ID.match(image_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found")
+    return image_status(image_id)
+
+
+@app.get("/images/{image_id}.png", tags=["Image Generation"], name="get_image")
+async def get_image(image_id: str, request: Request):
+    """Serves a generated image with ETag and Range support."""
+    path = image_path(image_id)
+    if not IMAGE_ID.match(image_id) or not os.path.exists(path):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found")
+    return file_response(request, path, etag=image_id, media_type="image/png")
 
 
 # Brainstorming Endpoint
@@ -135,33 +424,71 @@ async def generate_image(request: ImageRequest):
 async def brainstorming(request: IdeaRequest):
     """Generates brainstorming ideas."""
     try:
-        result = get_brainstorming_ideas(
-            category=request.category,
-            list_of=request.list_of,
-            context=request.context,
-            examples=request.examples,
-        )
+        async with endpoint_limit("brainstorming"):
+            result = await aget_brainstorming_ideas(**idea_inputs(request), use_cache=request.use_cache)
         return result
     except Exception as e:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+        raise upstream_error(e)
 
 
 # Chapter Generation Endpoint
 @app.post("/chapter/", tags=["Chapter Generation"])
 async def chapter_generation(request: ChapterRequest):
     """Generates a story chapter."""
+    inputs = await run_blocking(chapter_inputs, request)
     try:
-        chapter = generate_story_chapter(
-            plot_point=request.plot_point,
-            previous_chapters=request.previous_chapters,
-            character_data=request.character_data,
-            worldbuilding_data=request.worldbuilding_data,
-            user_genre=request.user_genre,
-            user_style=request.user_style,
-        )
+        async with endpoint_limit("chapter"):
+            chapter = await agenerate_story_chapter(**inputs, mode=request.mode)
+        if request.session_id and request.append_to_session:
+            await run_blocking(sessions.append_chapter, request.session_id, chapter["chapter_text"])
         return chapter
     except Exception as e:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+        raise upstream_error(e)
+
+
+def sse_event(event: str, data) -> str:
+    """Formats a single Server-Sent Events message with a JSON payload."""
+    return f"event: {event}\ndata: {dumps(data).decode('utf-8')}\n\n"
+
+
+# Streaming Chapter Generation Endpoint
+@app.post("/chapter/stream", tags=["Chapter Generation"])
+async def chapter_generation_stream(request: ChapterRequest):
+    """
+    Generates a story chapter and streams it as Server-Sent Events.
+
+    Emits `delta` events carrying new chapter text as soon as the model produces it,
+    then a `final` event with the complete parsed chapter plus time-to-first-token
+    and total generation time in seconds. Failures are reported as an `error` event.
+    """
+    inputs = await run_blocking(chapter_inputs, request)
+
+    async def event_stream():
+        start = time.perf_counter()
+        ttft = None
+        try:
+            async with endpoint_limit("chapter"):
+                async for kind, payload in astream_story_chapter(**inputs):
+                    if kind == "delta":
+                        if ttft is None:
+                            ttft = time.perf_counter() - start
+                        yield sse_event("delta", {"chapter_text": payload})
+                    else:
+                        if request.session_id and request.append_to_session:
+                            await run_blocking(sessions.append_chapter, request.session_id, payload.get("chapter_text", ""))
+                        yield sse_event("final", {
+                            "chapter": payload,
+                            "ttft_seconds": round(ttft, 3) if ttft is not None else None,
+                            "total_seconds": round(time.perf_counter() - start, 3),
+                        })
+        except Exception as e:
+            yield sse_event("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 # Character Generation Endpoint
@@ -169,13 +496,15 @@ async def chapter_generation(request: ChapterRequest):
 async def character_generation(request: CharacterRequest):
     """Generates a character profile."""
     try:
-        profile = generate_character_profile(
-            user_character_description=request.user_character_description,
-            user_genre=request.user_genre,
-        )
+        async with endpoint_limit("character"):
+            profile = await agenerate_character_profile(
+                user_character_description=request.user_character_description,
+                user_genre=request.user_genre,
+                use_cache=request.use_cache,
+            )
         return profile
     except Exception as e:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+        raise upstream_error(e)
 
 
 # Outline Generation Endpoint
@@ -183,48 +512,346 @@ async def character_generation(request: CharacterRequest):
 async def outline_generation(request: OutlineRequest):
     """Generates a plot outline."""
     try:
-        outline = generate_plot_outline(
-            user_premise=request.user_premise,
-            user_genre=request.user_genre,
-        )
+        async with endpoint_limit("outline"):
+            outline = await agenerate_plot_outline(
+                user_premise=request.user_premise,
+                user_genre=request.user_genre,
+                use_cache=request.use_cache,
+            )
         return outline
     except Exception as e:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+        raise upstream_error(e)
+
+
+def quick_edit_inputs(request: QuickEditRequest) -> dict:
+    """
+    Resolves the keyword arguments for a quick edit from the request and its session,
+    checking the text that is actually sent against the budget. In patch mode that is
+    the patch view of the document, which is passed on so it is computed once.
+    Reads session files and ranks story data, so it runs in the blocking pool.
+    """
+    document_text = session_text(request.session_id, "document_text", request.document_text)
+    sent_document, context, options = document_text, document_text, {}
+    if request.mode == "patch":
+        # Only the relevant paragraphs are sent in full, the others as previews
+        view = patch_view(request.user_request, document_text)
+        _, sent_document, context = view
+        options["view"] = view
+    fields = fit_request("quick_edit", {
+        "user_request": request.user_request,
+        "document_text": sent_document,
+        **story_data_fields(request.session_id, request.character_data, request.worldbuilding_data, request.user_request, context),
+    }, {"character_data": "head", "worldbuilding_data": "head"})
+    return {
+        "user_request": request.user_request,
+        "document_text": document_text,
+        "character_data": fields["character_data"],
+        "worldbuilding_data": fields["worldbuilding_data"],
+        "user_genre": request.user_genre,
+        **options,
+    }
 
 
 # Quick Edit Endpoint
 @app.post("/quick_edit/", tags=["Quick Edit"])
 async def quick_edit(request: QuickEditRequest):
     """Performs a quick edit on story text."""
+    inputs = await run_blocking(quick_edit_inputs, request)
     try:
-        edited_text = perform_quick_edit(
-            user_request=request.user_request,
-            document_text=request.document_text,
-            character_data=request.character_data,
-            worldbuilding_data=request.worldbuilding_data,
-            user_genre=request.user_genre,
-        )
+        async with endpoint_limit("quick_edit"):
+            perform = aperform_quick_edit_patch if request.mode == "patch" else aperform_quick_edit
+            edited_text = await perform(**inputs)
         return edited_text
     except Exception as e:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+        raise upstream_error(e)
 
 
-# Rewrite Endpoint
 # Rewrite Endpoint
 @app.post("/rewrite/", tags=["Rewrite"])
 async def rewrite(request: RewriteRequest):
     """Rewrites text based on instructions."""
     try:
-        rewritten_text = get_rewritten_text(
-            selected_text=request.selected_text,
-            rewrite_type=request.rewrite_type,
-            custom_prompt=request.custom_prompt,
-        )
+        async with endpoint_limit("rewrite"):
+            rewritten_text = await aget_rewritten_text(
+                selected_text=request.selected_text,
+                rewrite_type=request.rewrite_type,
+                custom_prompt=request.custom_prompt,
+                variants=request.variants,
+                use_cache=request.use_cache,
+            )
         return rewritten_text
     except Exception as e:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+        raise upstream_error(e)
+
+
+# Batch Endpoints
+@app.post("/character/batch", tags=["Character Generation"])
+async def character_generation_batch(request: CharacterBatchRequest):
+    """Generates several character profiles concurrently. Results and errors are reported per item, in order."""
+    async def generate(item: CharacterRequest):
+        return await agenerate_character_profile(
+            user_character_description=item.user_character_description,
+            user_genre=item.user_genre,
+            use_cache=item.use_cache,
+        )
+
+    return {"results": await run_batch("character", generate, request.items)}
+
+
+@app.post("/rewrite/batch", tags=["Rewrite"])
+async def rewrite_batch(request: RewriteBatchRequest):
+    """Rewrites several passages concurrently. Results and errors are reported per item, in order."""
+    async def rewrite_one(item: RewriteRequest):
+        return await aget_rewritten_text(
+            selected_text=item.selected_text,
+            rewrite_type=item.rewrite_type,
+            custom_prompt=item.custom_prompt,
+            variants=item.variants,
+            use_cache=item.use_cache,
+        )
+
+    return {"results": await run_batch("rewrite", rewrite_one, request.items)}
+
+
+@app.post("/brainstorming/batch", tags=["Brainstorming"])
+async def brainstorming_batch(request: IdeaBatchRequest):
+    """Runs several brainstorming requests concurrently. Results and errors are reported per item, in order."""
+    async def brainstorm(item: IdeaRequest):
+        return await aget_brainstorming_ideas(**idea_inputs(item), use_cache=item.use_cache)
+
+    return {"results": await run_batch("brainstorming", brainstorm, request.items)}
+
+
+# Background Job Endpoints
+async def run_chapter_job(payload: dict) -> dict:
+    chapter = await agenerate_story_chapter(**payload["inputs"], mode=payload["mode"])
+    if payload["session_id"] and payload["append_to_session"]:
+        await run_blocking(sessions.append_chapter, payload["session_id"], chapter["chapter_text"])
+    return chapter
+
+
+async def run_image_job(payload: dict) -> dict:
+    key, future = submit_image(payload["prompt"])
+    if future is not None:
+        await asyncio.wrap_future(future)
+    return {"image_id": key, "status": "ready"}
+
+
+async def run_tts_job(payload: dict) -> bytes:
+    return b"".join([chunk async for chunk in astream_story_audio(payload["story"])])
+
+
+jobs.register("chapter", run_chapter_job)
+jobs.register("imageGen", run_image_job)
+jobs.register("tts", run_tts_job, media_type="audio/mpeg")
+jobs.register("book", pipeline.run_book_job)
+
+
+def job_accepted(job: dict, http_request: Request, **fields) -> JSONResponse:
+    """Answers a job submission with 202 and the URL to poll, plus any extra fields."""
+    status_url = str(http_request.url_for("get_job", job_id=job["job_id"]))
+    return TimedJSONResponse(dict(job, status_url=status_url, **fields), status_code=status.HTTP_202_ACCEPTED, headers={"Location": status_url})
+
+
+@app.post("/jobs/chapter", tags=["Jobs"])
+async def submit_chapter_job(request: ChapterRequest, http_request: Request):
+    """Queues a chapter generation and returns its job ID right away. Poll /jobs/{job_id} for the chapter."""
+    job = await jobs.submit("chapter", {
+        "inputs": await run_blocking(chapter_inputs, request),
+        "mode": request.mode,
+        "session_id": request.session_id,
+        "append_to_session": request.append_to_session,
+    })
+    return job_accepted(job, http_request)
+
+
+@app.post("/jobs/imageGen", tags=["Jobs"])
+async def submit_image_job(request: ImageRequest, http_request: Request):
+    """Queues an image generation and returns its job ID right away."""
+    if not request.prompt:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No prompt provided")
+    return job_accepted(await jobs.submit("imageGen", {"prompt": request.prompt}), http_request)
+
+
+@app.post("/jobs/tts", tags=["Jobs"])
+async def submit_tts_job(request: StoryRequest, http_request: Request):
+    """Queues a text-to-speech conversion. Once done, the MP3 is served at /jobs/{job_id}/result."""
+    if not request.story.strip():
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No story provided")
+    return job_accepted(await jobs.submit("tts", {"story": request.story}), http_request)
+
+
+@app.get("/jobs/stats", tags=["Monitoring"])
+async def job_stats():
+    """Returns job counts by kind and status and how long the oldest queued job has waited."""
+    return await run_blocking(jobs.all_stats)
+
+
+@app.get("/jobs/{job_id}", tags=["Jobs"], name="get_job")
+async def get_job(job_id: str, http_request: Request):
+    """
+    Returns a job's status ("queued", "running", "done" or "failed") and, when done,
+    its result. Jobs are kept for JOB_RESULT_TTL_SECONDS after they finish.
+    """
+    try:
+        job = await run_blocking(jobs.get_job, job_id)
+    except jobs.JobNotFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Job {job_id} not found")
+    if job["status"] == "done" and job["media_type"] is not None:
+        job["download_link"] = str(http_request.url_for("get_job_result", job_id=job_id))
+    elif job["status"] == "done" and job["kind"] == "imageGen":
+        job["result"]["download_link"] = str(http_request.url_for("get_image", image_id=job["result"]["image_id"]))
+    return job
+
+
+@app.get("/jobs/{job_id}/result", tags=["Jobs"], name="get_job_result")
+async def get_job_result(job_id: str, request: Request):
+    """Serves the audio of a finished tts job."""
+    try:
+        result = await run_blocking(jobs.result_file, job_id)
+    except jobs.JobNotFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Job {job_id} not found")
+    if result is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Job {job_id} has no file result")
+    path, media_type = result
+    return file_response(request, path, etag=job_id, media_type=media_type)
+
+
+# Book Pipeline Endpoints
+def pipeline_accepted(pipeline_id: str, job: dict, http_request: Request) -> JSONResponse:
+    """Answers a pipeline submission with 202, the job URL and the pipeline progress URL."""
+    pipeline_url = str(http_request.url_for("get_pipeline", pipeline_id=pipeline_id))
+    return job_accepted(job, http_request, pipeline_id=pipeline_id, pipeline_url=pipeline_url)
+
+
+@app.post("/pipelines/book", tags=["Pipelines"])
+async def submit_book_pipeline(request: BookRequest, http_request: Request):
+    """
+    Drafts a whole book in the background: the outline and character profiles
+    concurrently, then one chapter per plot point. Poll /jobs/{job_id} for the book,
+    or /pipelines/{pipeline_id} for the steps finished so far.
+    """
+    pipeline_id, job = await pipeline.start_book(
+        user_premise=request.user_premise,
+        user_genre=request.user_genre,
+        user_style=request.user_style,
+        characters=request.characters,
+        worldbuilding_data=request.worldbuilding_data,
+        chapter_mode=request.chapter_mode,
+        create_session=request.create_session,
+        use_cache=request.use_cache,
+    )
+    return pipeline_accepted(pipeline_id, job, http_request)
+
+
+@app.get("/pipelines/{pipeline_id}", tags=["Pipelines"], name="get_pipeline")
+async def get_pipeline(pipeline_id: str):
+    """Returns a pipeline's current job, its status and the steps checkpointed so far."""
+    try:
+        return await run_blocking(pipeline.get_pipeline, pipeline_id)
+    except pipeline.PipelineNotFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Pipeline {pipeline_id} not found")
+
+
+@app.post("/pipelines/{pipeline_id}/resume", tags=["Pipelines"])
+async def resume_pipeline(pipeline_id: str, http_request: Request):
+    """Runs a failed pipeline again; the steps it already finished are not repeated."""
+    try:
+        job = await pipeline.resume(pipeline_id)
+    except pipeline.PipelineNotFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Pipeline {pipeline_id} not found")
+    except pipeline.PipelineRunning as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    return pipeline_accepted(pipeline_id, job, http_request)
+
+
+# Story Session Endpoints
+@app.post("/sessions/", tags=["Sessions"])
+async def create_session(request: SessionCreateRequest):
+    """Creates a story session so later calls only need to send new inputs."""
+    session = await run_blocking(
+        sessions.create_session,
+        chapters=request.previous_chapters,
+        character_data=request.character_data,
+        worldbuilding_data=request.worldbuilding_data,
+        document_text=request.document_text,
+    )
+    return sessions.describe(session)
+
+
+@app.get("/sessions/{session_id}", tags=["Sessions"])
+async def get_session(session_id: str):
+    """Returns the content digests stored in a session."""
+    try:
+        return sessions.describe(await run_blocking(sessions.get_session, session_id))
+    except sessions.SessionNotFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Session {session_id} not found")
+
+
+@app.post("/sessions/{session_id}/chapters", tags=["Sessions"])
+async def append_session_chapter(session_id: str, request: SessionChapterRequest):
+    """Appends a chapter to a session."""
+    try:
+        return sessions.describe(await run_blocking(sessions.append_chapter, session_id, request.chapter_text))
+    except sessions.SessionNotFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Session {session_id} not found")
+
+
+@app.put("/sessions/{session_id}/{field}", tags=["Sessions"])
+async def update_session_text(session_id: str, field: str, request: SessionTextRequest):
+    """Replaces the characters, worldbuilding or document text of a session."""
+    fields = {"characters": "character_data", "worldbuilding": "worldbuilding_data", "document": "document_text"}
+    if field not in fields:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Unknown session field: {field}")
+    try:
+        return sessions.describe(await run_blocking(sessions.set_text, session_id, fields[field], request.text))
+    except sessions.SessionNotFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Session {session_id} not found")
+
+
+# Cache Statistics Endpoint
+@app.get("/cache/stats", tags=["Cache"])
+async def cache_stats():
+    """Returns hit/miss counters for the response cache of each endpoint and the brainstorming semantic cache."""
+    return dict(all_stats(), brainstorming_semantic=semantic_cache.snapshot())
+
+
+# Provider Resilience Endpoint
+@app.get("/resilience/stats", tags=["Monitoring"])
+async def resilience_stats():
+    """Returns call, retry and rejection counters, rate-limiter wait time and circuit breaker state per provider."""
+    return resilience.all_stats()
+
+
+# Model Routing Endpoint
+@app.get("/router/stats", tags=["Monitoring"])
+async def router_stats():
+    """Returns rolling latency percentiles, error rates and hedge counts per model backend."""
+    return router.all_stats()
+
+
+# Token Accounting Endpoint
+@app.get("/tokens/stats", tags=["Monitoring"])
+async def token_stats():
+    """Returns input and output token histograms per endpoint and model."""
+    return tokens.all_stats()
+
+
+# Readiness Endpoint
+@app.get("/ready", tags=["Monitoring"])
+async def ready():
+    """Returns 200 once this process is warmed up and 503 while it starts or drains, for load balancer checks."""
+    return TimedJSONResponse(readiness, status_code=status.HTTP_200_OK if readiness["ready"] else status.HTTP_503_SERVICE_UNAVAILABLE)
+
 
+# Prometheus Metrics Endpoint
+@app.get("/metrics", tags=["Monitoring"], response_class=Response)
+async def prometheus_metrics():
+    """Returns request, stage latency, error, cache, provider and token metrics in the Prometheus text format."""
+    # Job counts are read from the shared queue database
+    return Response(await run_blocking(render_metrics), media_type="text/plain; version=0.0.4")
 
 
 if __name__ == "__main__":
+    # Single process for development; use serve.py for production
     uvicorn.run(app, host="0.0.0.0", port=8080)
\ No newline at end of file
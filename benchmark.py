@@ -0,0 +1,765 @@
+"""
+Offline benchmarks for the API.
+
+The chat models, ElevenLabs and Together clients are replaced by the stand-ins in
+fakes.py, and the app is served by a local uvicorn server so responses are
+streamed exactly as in production.
+
+Modes:
+    --requests N   Fire N concurrent /chapter/ requests against a fake model that
+                   takes `--latency` seconds. With the async endpoints the batch
+                   should finish in about one model latency rather than N.
+    --stream       Measure time-to-first-token on /chapter/stream.
+    --payload      Compare request size and parse time of a /chapter/ call on a
+                   100k-word story: whole book vs. session ID plus new inputs.
+    --tts          Measure time to the first audio byte on /tts/.
+    --chapter-modes
+                   Compare /chapter/ wall time in single-call and parallel scene
+                   mode, with fake outputs sized like a 3000-word chapter.
+    --parsing      Compare JsonOutputParser and parsers.TolerantJsonOutputParser on
+                   4000-word chapter outputs with common defects: how often the
+                   full chapter text comes back, and parse time.
+    --retrieval    Measure recall and prompt-size reduction of retrieval.py on a
+                   synthetic story bible (120 characters, 200 places) and 200
+                   plot points that each name two characters and a place.
+    --semantic-cache
+                   Fill the /brainstorming/ semantic cache with 100k requests and
+                   measure, per similarity threshold, the hit rate on reworded
+                   requests, the false-hit rate on requests that differ in one
+                   word, and lookup latency.
+    --transport    Compare JSON serializers and gzip/zstd compression on a 4000-word
+                   chapter response and a 2 MB previous_chapters request, and
+                   measure bytes on the wire through the API, including 304s.
+    --startup      Measure cold-start import time of api.py and show the slowest imports.
+    --suite        Drive every endpoint at increasing concurrency and report req/s,
+                   p50/p95/p99 latency, time-to-first-byte and peak RSS. Results
+                   are written as JSON to `--output` for regression tracking.
+
+The fakes are tuned with `--latency`, `--token-rate` and `--failure-rate`.
+
+Usage:
+    python benchmark.py --requests 10 --latency 1.0
+    python benchmark.py --stream --latency 1.0 --token-rate 200
+    python benchmark.py --payload
+    python benchmark.py --tts --latency 0.5
+    python benchmark.py --chapter-modes --latency 2.0 --token-rate 60
+    python benchmark.py --parsing
+    python benchmark.py --retrieval
+    python benchmark.py --semantic-cache
+    python benchmark.py --transport
+    python benchmark.py --startup
+    python benchmark.py --suite --concurrency 1,8,32 --output bench_results.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import httpx
+
+import providers
+from fakes import FakeChatModel, FakeElevenLabs, FakeTogether
+
+
+CHAPTER_PAYLOAD = {
+    "plot_point": "The heroes reach the city gates.",
+    "previous_chapters": "",
+    "character_data": "Ana, a reluctant knight.",
+    "worldbuilding_data": "A walled city on a river.",
+    "user_genre": "Fantasy",
+    "user_style": "Short",
+}
+
+
+# One response that satisfies the JSON schema of every chain
+FAKE_RESPONSE = json.dumps({
+    "chapter_text": " ".join(["Once upon a time."] * 200),
+    "outline": ["The call", "The journey", "The return"],
+    "ideas": ["Brakka Emberhand", "Tor Ironvein", "Hilda Anvilsong"],
+    "name": "Ana",
+    "personality_traits": ["brave", "guarded", "curious"],
+    "backstory": "A knight who never wanted the title.",
+    "edited_text": "Once upon a time.",
+    "variants": ["Once upon a time.", "Long ago.", "In a distant land."],
+    "summary": "Ana reaches the city.",
+    "beats": ["Ana reaches the gates.", "The guards refuse her.", "She enters by the river."],
+    "scene_text": "Once upon a time.\n\nThe end.",
+    "ending": "The end.",
+    "opening": "Once upon a time.",
+})
+
+
+def install_fakes(latency: float, tokens_per_second: float = 0.0, failure_rate: float = 0.0, responses: dict = None):
+    """Replaces every provider with a fake taking `latency` seconds per call."""
+    fake = FakeChatModel(
+        response=FAKE_RESPONSE,
+        responses=responses or {},
+        latency=latency,
+        tokens_per_second=tokens_per_second,
+        failure_rate=failure_rate,
+    )
+    providers.override("gemini", fake)
+    providers.override("together", fake)
+    providers.override("elevenlabs", FakeElevenLabs(latency=latency, failure_rate=failure_rate))
+    providers.override("together_images", FakeTogether(latency=latency, failure_rate=failure_rate))
+
+
+@contextmanager
+def live_server():
+    """Serves api.app with uvicorn on a free local port and yields its base URL."""
+    import uvicorn
+    from api import app
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+async def run_concurrent_chapters(base_url: str, num_requests: int) -> float:
+    """Sends num_requests concurrent /chapter/ calls and returns the wall time in seconds."""
+    limits = httpx.Limits(max_connections=num_requests)
+    async with httpx.AsyncClient(base_url=base_url, timeout=None, limits=limits) as client:
+        start = time.perf_counter()
+        responses = await asyncio.gather(
+            *(client.post("/chapter/", json=CHAPTER_PAYLOAD) for _ in range(num_requests))
+        )
+        elapsed = time.perf_counter() - start
+
+    failed = [r for r in responses if r.status_code != 200]
+    if failed:
+        raise RuntimeError(f"{len(failed)} requests failed, first: {failed[0].text}")
+    return elapsed
+
+
+def chapter_mode_responses(words: int = 3000, scenes: int = 4) -> dict:
+    """
+    Fake responses for each chapter prompt, sized like real output: a full chapter
+    for the single call, a plan, scenes of words/scenes each and short transitions.
+    """
+    def text(word_count):
+        paragraph = " ".join(["Once upon a time there was a gate."] * 10)
+        return "\n\n".join([paragraph] * max(2, word_count // 80))
+
+    return {
+        "SCENE PLAN": json.dumps({"beats": [f"Scene {i + 1} happens." for i in range(scenes)]}),
+        "SCENE TO WRITE": json.dumps({"scene_text": text(words // scenes)}),
+        "SCENE TRANSITION": json.dumps({"ending": text(80), "opening": text(80)}),
+        "TASK: Write a chapter": json.dumps({"chapter_text": text(words)}),
+    }
+
+
+async def run_chapter_modes(base_url: str) -> dict:
+    """Generates one chapter in each mode and returns the wall time of each in seconds."""
+    timings = {}
+    async with httpx.AsyncClient(base_url=base_url, timeout=None) as client:
+        for mode in ("single", "parallel"):
+            start = time.perf_counter()
+            response = await client.post("/chapter/", json=dict(CHAPTER_PAYLOAD, mode=mode))
+            if response.status_code != 200:
+                raise RuntimeError(f"{mode} chapter failed: {response.text}")
+            timings[mode] = (time.perf_counter() - start, len(response.json()["chapter_text"].split()))
+    return timings
+
+
+async def run_streamed_chapter(base_url: str) -> tuple:
+    """Streams one /chapter/stream call and returns (ttft_seconds, total_seconds)."""
+    async with httpx.AsyncClient(base_url=base_url, timeout=None) as client:
+        start = time.perf_counter()
+        ttft = None
+        async with client.stream("POST", "/chapter/stream", json=CHAPTER_PAYLOAD) as response:
+            async for line in response.aiter_lines():
+                if line == "event: error":
+                    raise RuntimeError("stream reported an error")
+                if ttft is None and line == "event: delta":
+                    ttft = time.perf_counter() - start
+        total = time.perf_counter() - start
+    return ttft, total
+
+
+async def run_streamed_tts(base_url: str) -> tuple:
+    """Streams /tts/ for a multi-paragraph story and returns (first_byte_seconds, total_seconds, bytes)."""
+    story = "\n\n".join(synthetic_story(5_000, chapters=10))
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=None) as client:
+        start = time.perf_counter()
+        first_byte = None
+        size = 0
+        async with client.stream("POST", "/tts/", json={"story": story}) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                if first_byte is None:
+                    first_byte = time.perf_counter() - start
+                size += len(chunk)
+        total = time.perf_counter() - start
+    return first_byte, total, size
+
+
+def synthetic_story(words: int, chapters: int = 20) -> list:
+    """Builds a list of chapter texts totalling roughly `words` words."""
+    sentence = "Ana walked the long road to the river city while the rain kept falling. "
+    per_chapter = words // chapters // len(sentence.split())
+    return [f"Chapter {i + 1}\n" + sentence * per_chapter for i in range(chapters)]
+
+
+def measure_payloads(words: int = 100_000, repeat: int = 20) -> dict:
+    """Returns body size and average parse+validation time for full vs session requests."""
+    from api import ChapterRequest
+
+    chapters = synthetic_story(words)
+    full = dict(CHAPTER_PAYLOAD, previous_chapters="\n\n\n".join(chapters),
+                character_data="Ana, a reluctant knight. " * 200,
+                worldbuilding_data="A walled city on a river. " * 400)
+    session = {key: CHAPTER_PAYLOAD[key] for key in ("plot_point", "user_genre", "user_style")}
+    session["session_id"] = "0" * 32
+
+    results = {}
+    for name, payload in (("full", full), ("session", session)):
+        body = json.dumps(payload).encode("utf-8")
+        start = time.perf_counter()
+        for _ in range(repeat):
+            ChapterRequest(**json.loads(body))
+        results[name] = {"bytes": len(body), "parse_ms": (time.perf_counter() - start) / repeat * 1000}
+    return results
+
+
+def defective_outputs(words: int = 4000) -> tuple:
+    """Returns (chapter text, {defect: raw model output}) for a chapter of about `words` words."""
+    sentence = 'Ana said "wait" and the rain kept falling on the river city. '
+    paragraphs = [sentence * 10] * (words // (len(sentence.split()) * 10))
+    text = "\n\n".join(paragraphs)
+    clean = json.dumps({"chapter_text": text})
+    outputs = {
+        "clean": f"```json\n{clean}\n```",
+        "unclosed_fence": f"```json\n{clean}",
+        "prose_around": f"Here is the chapter:\n{clean}\nLet me know if you want changes.",
+        "trailing_comma": clean[:-1] + ",}",
+        "raw_newlines": clean.replace("\\n", "\n"),
+        "unescaped_quotes": clean.replace('\\"', '"'),
+    }
+    return text, outputs
+
+
+def measure_parsing(repeat: int = 3) -> dict:
+    """Returns {parser: {defect: (full text recovered, parse ms)}} for the outputs of defective_outputs()."""
+    from langchain_core.output_parsers import JsonOutputParser
+    import parsers
+
+    # Measure the local repairs only, without the model fallback
+    parsers.FIX_JSON_ENABLED = False
+    text, outputs = defective_outputs()
+    results = {}
+    for name, parser in (("JsonOutputParser", JsonOutputParser()), ("Tolerant", parsers.TolerantJsonOutputParser())):
+        results[name] = {}
+        for defect, output in outputs.items():
+            start = time.perf_counter()
+            for _ in range(repeat):
+                try:
+                    value = parser.parse(output)
+                except Exception:
+                    value = None
+            elapsed = (time.perf_counter() - start) / repeat * 1000
+            results[name][defect] = (isinstance(value, dict) and value.get("chapter_text") == text, elapsed)
+    return results
+
+
+def synthetic_bible(characters: int = 120, places: int = 200, seed: int = 7) -> tuple:
+    """
+    Returns (character_data, worldbuilding_data, character names, place names) for a
+    story bible whose entries cross-reference each other, like real ones do.
+    """
+    rng = random.Random(seed)
+    syllables = ["ka", "ren", "dor", "mi", "sal", "tho", "vin", "ela", "bru", "zan", "oth", "lys", "gar", "quel", "fen"]
+
+    def names(count, suffix):
+        result = set()
+        while len(result) < count:
+            result.add("".join(rng.choice(syllables) for _ in range(rng.randint(2, 3))).capitalize() + suffix)
+        return sorted(result)
+
+    people, towns = names(characters, ""), names(places, "holm")
+    filler = ("proud stubborn loyal secretive weathered restless scarred ambitious cautious grieving "
+              "river mountain harbor forest market guild temple archive ruin tower bridge border").split()
+
+    def description(words):
+        return " ".join(rng.choice(filler) for _ in range(words))
+
+    character_entries = [
+        f"{name}: a {description(3)} figure from {rng.choice(towns)}, sworn rival of {rng.choice(people)}. "
+        f"{description(60)}."
+        for name in people
+    ]
+    place_entries = [
+        f"{town}: a {description(3)} settlement near {rng.choice(towns)}, ruled by {rng.choice(people)}. "
+        f"{description(60)}."
+        for town in towns
+    ]
+    return "\n\n".join(character_entries), "\n\n".join(place_entries), people, towns
+
+
+def measure_retrieval(plot_points: int = 200, seed: int = 11) -> dict:
+    """
+    Returns recall (share of the characters and places named by each plot point
+    that were selected) and the average prompt tokens of the full and selected data.
+    """
+    import retrieval
+    from tokens import count_tokens
+
+    character_data, worldbuilding_data, people, towns = synthetic_bible()
+    rng = random.Random(seed)
+    found = expected = full_tokens = selected_tokens = 0
+    start = time.perf_counter()
+    for _ in range(plot_points):
+        first, second = rng.sample(people, 2)
+        town = rng.choice(towns)
+        plot_point = f"{first} confronts {second} in {town} over the stolen charter."
+        characters = retrieval.select_context(character_data, plot_point, retrieval.CHARACTER_CONTEXT_TOKENS)
+        places = retrieval.select_context(worldbuilding_data, plot_point, retrieval.WORLDBUILDING_CONTEXT_TOKENS)
+        selected_names = {entry.split(":")[0] for entry in (characters + "\n\n" + places).split("\n\n")}
+        found += len({first, second, town} & selected_names)
+        expected += 3
+        full_tokens += count_tokens(character_data) + count_tokens(worldbuilding_data)
+        selected_tokens += count_tokens(characters) + count_tokens(places)
+    return {
+        "recall": found / expected,
+        "full_tokens": full_tokens / plot_points,
+        "selected_tokens": selected_tokens / plot_points,
+        "select_ms": (time.perf_counter() - start) / plot_points * 1000,
+    }
+
+
+SEMANTIC_ADJECTIVES = ("grumpy cheerful ancient young cursed noble exiled wandering blind scarred famous disgraced "
+                       "secretive loyal greedy pious drunken heroic cowardly clever foolish silent boisterous gentle "
+                       "ruthless lonely rich poor sickly mighty tiny royal rebel haunted lucky unlucky reformed retired "
+                       "rookie veteran mad wise cunning brave timid jolly grim proud humble stern").split()
+SEMANTIC_RACES = {"dwarf": "dwarven", "elf": "elven", "orc": "orcish", "gnome": "gnomish", "troll": "trollish",
+                  "dragon": "draconic", "vampire": "vampiric", "demon": "demonic", "ghost": "ghostly", "angel": "angelic",
+                  "human": "human", "goblin": "goblin", "halfling": "halfling", "giant": "giant", "centaur": "centaur",
+                  "merfolk": "merfolk", "undead": "undead", "fairy": "fairy", "celestial": "celestial", "ogre": "ogre"}
+SEMANTIC_PROFESSIONS = ("blacksmith baker knight wizard thief bard merchant sailor priest hunter farmer healer assassin "
+                        "scholar guard innkeeper alchemist cartographer jeweler tailor miner archer shepherd fisher "
+                        "brewer mercenary captain spy necromancer monk druid ranger paladin cook scribe herbalist tinker "
+                        "courier smuggler pirate").split()
+SEMANTIC_LANDS = ["north", "desert", "islands", "mountains", "swamps"]
+
+
+def measure_semantic_cache(entries: int = 100_000, queries: int = 1000, thresholds=(0.85, 0.9, 0.95, 0.97)) -> dict:
+    """
+    Fills a brainStorming.SemanticCache with `entries` "Names" requests, then looks up
+    rewordings of cached requests (which should hit that entry) and requests that
+    differ from a cached one in a single word (which should miss).
+
+    Returns:
+        dict: {"thresholds": {threshold: (hit rate, false-hit rate)}, "lookup_ms": (p50, p95), "fill_seconds": ...}
+    """
+    from brainStorming import SemanticCache
+
+    rng = random.Random(3)
+    subjects = [(adjective, race, profession, land) for adjective in SEMANTIC_ADJECTIVES for race in SEMANTIC_RACES
+                for profession in SEMANTIC_PROFESSIONS for land in SEMANTIC_LANDS]
+    rng.shuffle(subjects)
+    cached, known = subjects[:entries], set(subjects[:entries])
+
+    def phrase(subject):
+        adjective, race, profession, land = subject
+        return f"names for a {adjective} {race} {profession} from the {land}"
+
+    def reword(subject):
+        adjective, race, profession, land = subject
+        return rng.choice([
+            f"{adjective} {SEMANTIC_RACES[race]} {profession} names from the {land}",
+            f"name ideas for a {adjective} {race} {profession} from the {land}",
+            f"{profession} names for a {adjective} {race} from the {land}",
+            f"some names for {adjective} {race} {profession}s from the {land}",
+        ])
+
+    cache = SemanticCache(max_entries=entries)
+    start = time.perf_counter()
+    for subject in cached:
+        cache.add("Names", phrase(subject), [" ".join(subject)])
+    fill_seconds = time.perf_counter() - start
+
+    reworded = [(subject, reword(subject)) for subject in rng.sample(cached, queries)]
+    near_misses = []
+    while len(near_misses) < queries:
+        changed = list(rng.choice(cached))
+        slot = rng.randrange(4)
+        changed[slot] = rng.choice([SEMANTIC_ADJECTIVES, list(SEMANTIC_RACES), SEMANTIC_PROFESSIONS, SEMANTIC_LANDS][slot])
+        if tuple(changed) not in known:
+            near_misses.append(phrase(tuple(changed)))
+
+    results, latencies = {}, []
+    for threshold in thresholds:
+        hits = false_hits = 0
+        for subject, text in reworded:
+            start = time.perf_counter()
+            matches = cache.lookup("Names", text, threshold)
+            latencies.append(time.perf_counter() - start)
+            if matches and matches[0][1][0] == " ".join(subject):
+                hits += 1
+            elif matches:
+                false_hits += 1
+        false_hits += sum(1 for text in near_misses if cache.lookup("Names", text, threshold))
+        results[threshold] = (hits / queries, false_hits / (2 * queries))
+    return {
+        "thresholds": results,
+        "lookup_ms": (percentile(latencies, 0.50) * 1000, percentile(latencies, 0.95) * 1000),
+        "fill_seconds": fill_seconds,
+    }
+
+
+def synthetic_prose(words: int, seed: int = 3) -> str:
+    """Builds paragraphs of `words` words drawn from a skewed vocabulary, so they compress like prose."""
+    rng = random.Random(seed)
+    syllables = ["an", "bel", "cor", "da", "en", "fal", "gri", "hal", "ir", "jo", "ke", "lum", "mor", "na", "or", "pra"]
+    vocabulary = ("the a and of to in was her his she he it that with on as at by from but not had they".split()
+                  + ["".join(rng.choice(syllables) for _ in range(rng.randint(1, 3))) for _ in range(600)])
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    paragraphs, written = [], 0
+    while written < words:
+        sentences = []
+        for _ in range(rng.randint(3, 7)):
+            sentence = rng.choices(vocabulary, weights, k=rng.randint(6, 20))
+            sentences.append(" ".join(sentence).capitalize() + ".")
+            written += len(sentence)
+        paragraphs.append(" ".join(sentences))
+    return "\n\n".join(paragraphs)
+
+
+def measure_transport(response_words: int = 4000, request_words: int = 450_000, repeat: int = 50) -> dict:
+    """
+    Returns serialization time per JSON library, size and time per compression
+    encoding, and the bytes on the wire of API calls with and without compression.
+    """
+    import transport
+
+    chapter = {"chapter_text": synthetic_prose(response_words), "status": "ok"}
+    request = dict(CHAPTER_PAYLOAD, previous_chapters=synthetic_prose(request_words, seed=5))
+
+    serialize = {}
+    serializers = {"json": lambda content: json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")}
+    if transport.orjson is not None:
+        serializers["orjson"] = lambda content: transport.orjson.dumps(content)
+    for name, dumps in serializers.items():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            body = dumps(chapter)
+        serialize[name] = (time.perf_counter() - start) / repeat * 1000
+
+    compression = {}
+    for payload_name, content in (("chapter response", chapter), ("2 MB request", request)):
+        body = transport.dumps(content)
+        compression[(payload_name, "identity")] = (len(body), 0.0, 0.0)
+        for encoding in transport.ENCODINGS:
+            start = time.perf_counter()
+            compressed = transport.compress(body, encoding)
+            compress_ms = (time.perf_counter() - start) * 1000
+            start = time.perf_counter()
+            transport.decompress(compressed, encoding)
+            compression[(payload_name, encoding)] = (len(compressed), compress_ms, (time.perf_counter() - start) * 1000)
+
+    install_fakes(0, responses={"TASK: Write a chapter": json.dumps({"chapter_text": chapter["chapter_text"]})})
+
+    async def over_the_wire():
+        from api import app
+
+        wire = {}
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=None)
+        async with client:
+            for encoding in ("identity",) + transport.ENCODINGS:
+                response = await client.post("/chapter/", json=CHAPTER_PAYLOAD, headers={"Accept-Encoding": encoding})
+                wire[("/chapter/ response", encoding)] = response.num_bytes_downloaded
+
+            body = transport.dumps({"previous_chapters": [request["previous_chapters"]]})
+            for encoding in ("identity",) + transport.ENCODINGS:
+                headers = {"Content-Type": "application/json"}
+                if encoding != "identity":
+                    headers["Content-Encoding"] = encoding
+                sent = body if encoding == "identity" else transport.compress(body, encoding)
+                response = await client.post("/sessions/", content=sent, headers=headers)
+                response.raise_for_status()
+                wire[("/sessions/ request", encoding)] = len(sent)
+
+            path = f"/sessions/{response.json()['session_id']}"
+            first = await client.get(path)
+            again = await client.get(path, headers={"If-None-Match": first.headers["ETag"]})
+            wire[(f"GET /sessions/{{id}} ({first.status_code})", "identity")] = first.num_bytes_downloaded
+            wire[(f"GET /sessions/{{id}} revalidated ({again.status_code})", "identity")] = again.num_bytes_downloaded
+        return wire
+
+    return {"serialize": serialize, "compression": compression, "wire": asyncio.run(over_the_wire())}
+
+
+def measure_startup(top: int = 15) -> dict:
+    """
+    Imports api.py in a fresh interpreter with `-X importtime` and returns the
+    wall time plus the top-level packages with the largest cumulative import time.
+    """
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import api"],
+        capture_output=True, text=True, check=True,
+    )
+    wall = time.perf_counter() - start
+
+    packages = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or line.count("|") != 2:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        # Nesting is shown as two spaces per level; level 1 are the imports made by api.py itself
+        name = name[1:]
+        if (len(name) - len(name.lstrip())) // 2 != 1:
+            continue
+        package = name.strip().split(".")[0]
+        packages[package] = packages.get(package, 0) + int(cumulative) / 1e6
+    slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    return {"wall_seconds": wall, "imports": slowest}
+
+
+def suite_scenarios() -> dict:
+    """
+    Returns {name: (path, payload_factory)} for every endpoint. Payloads disable the
+    response cache and vary per request so each call reaches the (fake) provider.
+    """
+    run = uuid.uuid4().hex[:8]
+    story = "\n\n".join(synthetic_story(1_000, chapters=4))
+    return {
+        "tts": ("/tts/", lambda i: {"story": story}),
+        "imageGen": ("/imageGen/", lambda i: {"prompt": f"A lighthouse in a storm {run}-{i}"}),
+        "brainstorming": ("/brainstorming/", lambda i: {"category": "Names", "list_of": f"Dwarf blacksmith names {i}", "use_cache": False}),
+        "chapter": ("/chapter/", lambda i: CHAPTER_PAYLOAD),
+        "chapter_stream": ("/chapter/stream", lambda i: CHAPTER_PAYLOAD),
+        "character": ("/character/", lambda i: {"user_character_description": f"A reluctant knight {i}", "user_genre": "Fantasy", "use_cache": False}),
+        "outline": ("/outline/", lambda i: {"user_premise": f"A knight guards a river city {i}", "user_genre": "Fantasy", "use_cache": False}),
+        "quick_edit": ("/quick_edit/", lambda i: {
+            "user_request": "Make the opening line punchier.",
+            "document_text": story,
+            "character_data": CHAPTER_PAYLOAD["character_data"],
+            "worldbuilding_data": CHAPTER_PAYLOAD["worldbuilding_data"],
+            "user_genre": "Fantasy",
+        }),
+        "rewrite": ("/rewrite/", lambda i: {"selected_text": f"Ana walked to the gate {i}.", "rewrite_type": "shorter", "use_cache": False}),
+    }
+
+
+def percentile(values: list, fraction: float) -> float:
+    """Nearest-rank percentile of values (0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process (server and load generator) in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return peak / 1024 / 1024 if platform.system() == "Darwin" else peak / 1024
+
+
+async def drive_endpoint(base_url: str, path: str, payload_factory, concurrency: int, total: int) -> dict:
+    """
+    Sends `total` requests to path with at most `concurrency` in flight and returns
+    throughput, latency and time-to-first-byte statistics in seconds.
+    """
+    latencies, ttfbs, errors = [], [], 0
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=None, limits=limits) as client:
+        async def one(i):
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                first_byte = None
+                try:
+                    async with client.stream("POST", path, json=payload_factory(i)) as response:
+                        async for chunk in response.aiter_raw():
+                            if first_byte is None and chunk:
+                                first_byte = time.perf_counter() - start
+                        failed = response.status_code >= 400
+                except httpx.RemoteProtocolError:
+                    # A streamed response that failed after its headers were sent
+                    failed = True
+                end = time.perf_counter() - start
+                if failed:
+                    errors += 1
+                    return
+                latencies.append(end)
+                ttfbs.append(first_byte if first_byte is not None else end)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        wall = time.perf_counter() - start
+
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "wall_seconds": round(wall, 4),
+        "req_per_s": round(len(latencies) / wall, 3) if wall else 0.0,
+        "latency_p50": round(percentile(latencies, 0.50), 4),
+        "latency_p95": round(percentile(latencies, 0.95), 4),
+        "latency_p99": round(percentile(latencies, 0.99), 4),
+        "ttfb_p50": round(percentile(ttfbs, 0.50), 4),
+        "ttfb_p95": round(percentile(ttfbs, 0.95), 4),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def run_suite(base_url: str, concurrency_levels: list, requests_per_level: int, endpoints: list = None) -> list:
+    """Runs every scenario at every concurrency level and prints one line per run."""
+    results = []
+    for name, (path, payload_factory) in suite_scenarios().items():
+        if endpoints and name not in endpoints:
+            continue
+        for concurrency in concurrency_levels:
+            total = max(requests_per_level, concurrency)
+            # Request IDs are unique across levels so cached endpoints are not warmed by earlier levels
+            unique_payload = lambda i, level=concurrency, factory=payload_factory: factory(f"{level}-{i}")
+            result = asyncio.run(drive_endpoint(base_url, path, unique_payload, concurrency, total))
+            result["endpoint"] = name
+            results.append(result)
+            print(f"{name:<15} c={concurrency:<4} {result['req_per_s']:8.2f} req/s  "
+                  f"p50 {result['latency_p50']:.3f}s  p95 {result['latency_p95']:.3f}s  "
+                  f"p99 {result['latency_p99']:.3f}s  ttfb p50 {result['ttfb_p50']:.3f}s  "
+                  f"errors {result['errors']}  rss {result['peak_rss_mb']:.0f} MiB")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=10, help="Number of concurrent requests.")
+    parser.add_argument("--latency", type=float, default=1.0, help="Fake provider latency in seconds.")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="Fake chat model output speed in tokens/s (0 = instant). Ignored by the default --requests run, whose baseline is the model latency alone.")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of fake provider calls that fail.")
+    parser.add_argument("--stream", action="store_true", help="Measure time-to-first-token on /chapter/stream.")
+    parser.add_argument("--payload", action="store_true", help="Compare full-book and session request payloads.")
+    parser.add_argument("--tts", action="store_true", help="Measure time to first audio byte on /tts/.")
+    parser.add_argument("--chapter-modes", action="store_true", help="Compare single-call and parallel /chapter/ wall time.")
+    parser.add_argument("--parsing", action="store_true", help="Compare JSON output parsers on defective model output.")
+    parser.add_argument("--retrieval", action="store_true", help="Measure recall and prompt-size reduction of retrieval.py.")
+    parser.add_argument("--semantic-cache", action="store_true", help="Measure hit rate, false-hit rate and lookup latency of the brainstorming semantic cache.")
+    parser.add_argument("--transport", action="store_true", help="Measure JSON serialization, compression and bytes on the wire.")
+    parser.add_argument("--startup", action="store_true", help="Measure import time of api.py.")
+    parser.add_argument("--suite", action="store_true", help="Run the full endpoint benchmark suite.")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma-separated concurrency levels for --suite.")
+    parser.add_argument("--requests-per-level", type=int, default=32, help="Requests per endpoint and concurrency level.")
+    parser.add_argument("--endpoints", default="", help="Comma-separated subset of endpoints for --suite.")
+    parser.add_argument("--output", default="bench_results.json", help="JSON results file for --suite.")
+    args = parser.parse_args()
+
+    if args.startup:
+        startup = measure_startup()
+        print(f"import api: {startup['wall_seconds']:.2f}s wall (including interpreter start)")
+        for package, seconds in startup["imports"]:
+            print(f"  {package:<28} {seconds:6.3f}s")
+        return
+
+    if args.parsing:
+        for name, defects in measure_parsing().items():
+            recovered = sum(ok for ok, _ in defects.values())
+            print(f"{name}: full text recovered for {recovered}/{len(defects)} outputs")
+            for defect, (ok, ms) in defects.items():
+                print(f"  {defect:<18} {'ok' if ok else 'LOST':<5} {ms:8.2f} ms")
+        return
+
+    if args.retrieval:
+        result = measure_retrieval()
+        print(f"recall: {result['recall']:.1%} of the named characters and places selected")
+        print(f"prompt data: {result['full_tokens']:.0f} -> {result['selected_tokens']:.0f} tokens "
+              f"({1 - result['selected_tokens'] / result['full_tokens']:.1%} smaller), "
+              f"{result['select_ms']:.2f} ms per chapter")
+        return
+
+    if args.semantic_cache:
+        result = measure_semantic_cache()
+        print(f"100k entries filled in {result['fill_seconds']:.1f}s; lookup p50 {result['lookup_ms'][0]:.2f} ms, "
+              f"p95 {result['lookup_ms'][1]:.2f} ms")
+        for threshold, (hit_rate, false_hit_rate) in result["thresholds"].items():
+            print(f"  threshold {threshold:.2f}: hit rate {hit_rate:6.1%}, false-hit rate {false_hit_rate:6.1%}")
+        return
+
+    if args.transport:
+        result = measure_transport()
+        for name, ms in result["serialize"].items():
+            print(f"serialize 4000-word chapter with {name:<7} {ms:7.3f} ms")
+        for (payload, encoding), (size, compress_ms, decompress_ms) in result["compression"].items():
+            print(f"{payload:<17} {encoding:<9} {size / 1024:9.1f} KiB  compress {compress_ms:7.2f} ms  "
+                  f"decompress {decompress_ms:6.2f} ms")
+        for (call, encoding), size in result["wire"].items():
+            print(f"{call:<38} {encoding:<9} {size / 1024:9.1f} KiB on the wire")
+        return
+
+    if args.payload:
+        for name, result in measure_payloads().items():
+            print(f"{name:>8}: {result['bytes'] / 1024:9.1f} KiB, parse {result['parse_ms']:.3f} ms")
+        return
+
+    responses = chapter_mode_responses() if args.chapter_modes else None
+    # The --requests run reports wall time as a multiple of --latency, so decoding must be instant there
+    measures_decoding = args.suite or args.chapter_modes or args.tts or args.stream
+    token_rate = args.token_rate if measures_decoding else 0.0
+    install_fakes(args.latency, token_rate, args.failure_rate, responses=responses)
+
+    with live_server() as base_url:
+        if args.suite:
+            levels = [int(level) for level in args.concurrency.split(",")]
+            endpoints = [name for name in args.endpoints.split(",") if name]
+            results = run_suite(base_url, levels, args.requests_per_level, endpoints)
+            report = {
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python": platform.python_version(),
+                "config": {
+                    "latency": args.latency,
+                    "token_rate": args.token_rate,
+                    "failure_rate": args.failure_rate,
+                    "concurrency": levels,
+                    "requests_per_level": args.requests_per_level,
+                },
+                "results": results,
+            }
+            with open(args.output, "w") as file:
+                json.dump(report, file, indent=2)
+            print(f"results written to {args.output}")
+        elif args.chapter_modes:
+            for mode, (seconds, words) in asyncio.run(run_chapter_modes(base_url)).items():
+                print(f"/chapter/ {mode:<8} {seconds:6.2f}s  {words} words")
+        elif args.tts:
+            first_byte, total, size = asyncio.run(run_streamed_tts(base_url))
+            print(f"/tts/ first audio byte: {first_byte:.2f}s, total: {total:.2f}s, {size / 1024:.0f} KiB")
+        elif args.stream:
+            ttft, total = asyncio.run(run_streamed_chapter(base_url))
+            print(f"/chapter/stream time-to-first-token: {ttft:.2f}s, total: {total:.2f}s")
+        else:
+            elapsed = asyncio.run(run_concurrent_chapters(base_url, args.requests))
+            print(f"{args.requests} concurrent /chapter/ requests, model latency {args.latency:.2f}s")
+            print(f"wall time: {elapsed:.2f}s ({elapsed / args.latency:.2f}x one model latency, "
+                  f"serial would be {args.requests:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,28 @@
-from langchain_google_genai import ChatGoogleGenerativeAI
-from dotenv import load_dotenv
-from langchain_openai import ChatOpenAI
-from langchain_core.output_parsers import JsonOutputParser
+import json
+import os
+import random
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
 from langchain_core.prompts import PromptTemplate
 from langchain_core.pydantic_v1 import BaseModel, Field
-import os
 
-load_dotenv()
-TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY")
+from router import routed_model
+from metrics import timed_chain
+from parsers import TolerantJsonOutputParser
+import store
+from concurrency import run_blocking
+from cache import CACHE_DIR, CACHE_TTL_SECONDS, acached_invoke, get_cache
 
-llm = ChatOpenAI(
-    base_url='https://api.together.xyz/v1',
-    api_key=TOGETHER_API_KEY,
-    model='google/gemma-2-27b-it',
-    temperature=1
-)
+llm = routed_model("together", model="google/gemma-2-27b-it", temperature=1)
 
 class IDEAS(BaseModel):
     idea: str = Field(description="ideas for the given context")
 
-parser = JsonOutputParser(pydantic_object=IDEAS)
+parser = TolerantJsonOutputParser(pydantic_object=IDEAS)
 
 from langchain_core.prompts import PromptTemplate
 
@@ -65,6 +68,7 @@ The ideas should be presented as a JSON object with the key "ideas", structured
         "...and so on"
     ]
 }}
+```
 """
 
 brainstorming_prompt = PromptTemplate( input_variables=["category", "list_of", "context", "examples"], template=brainstorming_prompt_template ,
@@ -72,7 +76,211 @@ brainstorming_prompt = PromptTemplate( input_variables=["category", "list_of", "
 
 
 
-chain = brainstorming_prompt | llm | parser
+chain = timed_chain(brainstorming_prompt, llm, parser)
+
+brainstorming_cache = get_cache("brainstorming")
+
+# Near-duplicate cache: requests whose wording is similar enough to a cached one
+# (cosine similarity of hashed n-gram vectors) reuse its ideas
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "1") == "1"
+# 0.95 is the lowest threshold of the benchmark (python benchmark.py --semantic-cache) with no false hits
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "100000"))
+SEMANTIC_CACHE_DIMENSIONS = int(os.getenv("SEMANTIC_CACHE_DIMENSIONS", "512"))
+# How a hit is served: "as_is", "shuffled", or "merged" (ideas of every match above the threshold)
+SEMANTIC_CACHE_MODE = os.getenv("SEMANTIC_CACHE_MODE", "shuffled")
+SEMANTIC_CACHE_MAX_MERGED = 5
+# Entries are shared with the other server processes through this database ("" keeps them in this process)
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", os.path.join(CACHE_DIR, "semantic.sqlite3"))
+# How often entries added by the other processes are loaded
+SEMANTIC_CACHE_SYNC_SECONDS = float(os.getenv("SEMANTIC_CACHE_SYNC_SECONDS", "1"))
+# Categories offered by the prompt; each has its own matrix, so other values are not cached
+SEMANTIC_CACHE_CATEGORIES = {
+    "characters", "world building", "plot points", "names", "places", "objects", "descriptions", "article ideas", "tweets",
+}
+# Stored vectors are int8: component * QUANTIZATION_SCALE
+QUANTIZATION_SCALE = 127
+
+# Words that phrase a request without changing what is asked for
+REQUEST_WORDS = {"a", "an", "the", "for", "of", "some", "me", "give", "list", "ideas", "idea", "suggestions", "possible"}
+
+def similarity_threshold(category: str) -> float:
+    """
+    Returns the similarity threshold of a category: `<CATEGORY>_SEMANTIC_THRESHOLD`
+    (e.g. WORLD_BUILDING_SEMANTIC_THRESHOLD=0.95), or SEMANTIC_CACHE_THRESHOLD.
+    """
+    name = re.sub(r"\W+", "_", category.strip()).upper()
+    value = os.getenv(f"{name}_SEMANTIC_THRESHOLD")
+    return float(value) if value else SEMANTIC_CACHE_THRESHOLD
+
+def request_text(list_of: str, context: str, examples: str) -> str:
+    return " ".join(part for part in (list_of, context, examples) if part)
+
+def embed(text: str, dimensions: int = SEMANTIC_CACHE_DIMENSIONS) -> np.ndarray:
+    """
+    Embeds text as a unit vector of hashed features: its words (plural "s" removed)
+    and their character trigrams, so "dwarf"/"dwarves"/"dwarven" still overlap.
+    """
+    words = [word[:-1] if len(word) > 3 and word.endswith("s") else word
+             for word in re.findall(r"\w+", text.lower()) if word not in REQUEST_WORDS]
+    features = words + [f" {word} "[i:i + 3] for word in words for i in range(len(word))]
+    hashes = np.array([zlib.crc32(feature.encode("utf-8")) for feature in features], dtype=np.uint64)
+    weights = np.where(hashes & 1, 1.0, -1.0) * np.where(np.arange(len(features)) < len(words), 2.0, 1.0)
+    vector = np.bincount((hashes >> 1) % dimensions, weights=weights, minlength=dimensions).astype(np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+class SemanticCache:
+    """
+    Idea lists keyed by request embeddings, searched by cosine similarity.
+
+    Each category has its own matrix of unit vectors, quantized to int8 and stored
+    one dimension per row, so a lookup only reads the rows where the query vector
+    is non-zero: a few dozen out of `dimensions`. When a category reaches max_entries, its
+    oldest entries are overwritten. Entries expire after ttl seconds.
+
+    With a path, entries are also appended to a SQLite table, and every process
+    loads the entries the others added (see `sync` and `arefresh`).
+    """
+
+    def __init__(self, max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL_SECONDS,
+                 dimensions: int = SEMANTIC_CACHE_DIMENSIONS, path: str = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.dimensions = dimensions
+        self.path = path
+        self._categories = {}
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._last_id = 0
+        self._synced_at = 0.0
+        self.stats = {"hits": 0, "misses": 0, "entries": 0, "lookup_seconds": 0.0}
+
+    def _connection(self):
+        if self._db is None:
+            self._db = store.connect(self.path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " category TEXT NOT NULL, vector BLOB NOT NULL, ideas TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)")
+            self._db.commit()
+        return self._db
+
+    def sync(self):
+        """Loads the entries added to the shared table since the last call, e.g. by other processes."""
+        if not self.path:
+            return
+        with self._db_lock:
+            rows = self._connection().execute(
+                "SELECT id, category, vector, ideas, expires FROM entries WHERE id > ? AND expires > ? ORDER BY id",
+                (self._last_id, time.time()),
+            ).fetchall()
+            if rows:
+                self._last_id = rows[-1][0]
+        for _, category, vector, ideas, expires in rows:
+            if len(vector) == self.dimensions:
+                self._insert(category, np.frombuffer(vector, dtype=np.int8), json.loads(ideas), expires)
+
+    async def arefresh(self, interval: float = SEMANTIC_CACHE_SYNC_SECONDS):
+        """Runs `sync` in the blocking pool, at most once every interval seconds."""
+        if not self.path or time.monotonic() - self._synced_at < interval:
+            return
+        self._synced_at = time.monotonic()
+        await run_blocking(self.sync)
+
+    def _category(self, category: str) -> dict:
+        if category not in self._categories:
+            self._categories[category] = {
+                "vectors": np.zeros((self.dimensions, min(1024, self.max_entries)), dtype=np.int8),
+                "ideas": [],
+                "expires": [],
+                "next": 0,
+            }
+        return self._categories[category]
+
+    def add(self, category: str, text: str, ideas: list):
+        """Adds an entry. With a path this writes to the database, so call `aadd` from the event loop."""
+        quantized = np.round(embed(text, self.dimensions) * QUANTIZATION_SCALE).astype(np.int8)
+        expires = time.time() + self.ttl
+        if not self.path:
+            self._insert(category, quantized, ideas, expires)
+            return
+        with self._db_lock:
+            db = self._connection()
+            db.execute("DELETE FROM entries WHERE expires <= ?", (time.time(),))
+            db.execute(
+                "INSERT INTO entries (category, vector, ideas, expires) VALUES (?, ?, ?, ?)",
+                (category, quantized.tobytes(), json.dumps(ideas, ensure_ascii=False), expires),
+            )
+            db.commit()
+        self.sync()
+
+    async def aadd(self, category: str, text: str, ideas: list):
+        await run_blocking(self.add, category, text, ideas)
+
+    def _insert(self, category: str, quantized: np.ndarray, ideas: list, expires: float):
+        with self._lock:
+            partition = self._category(category)
+            position = partition["next"]
+            if position == partition["vectors"].shape[1] and position < self.max_entries:
+                # Grow by doubling, up to max_entries
+                grown = np.zeros((self.dimensions, min(2 * position, self.max_entries)), dtype=np.int8)
+                grown[:, :position] = partition["vectors"]
+                partition["vectors"] = grown
+            position %= self.max_entries
+            partition["vectors"][:, position] = quantized
+            if position == len(partition["ideas"]):
+                partition["ideas"].append(ideas)
+                partition["expires"].append(expires)
+                self.stats["entries"] += 1
+            else:
+                partition["ideas"][position] = ideas
+                partition["expires"][position] = expires
+            partition["next"] = position + 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["average_lookup_ms"] = round(stats.pop("lookup_seconds") / lookups * 1000, 3) if lookups else 0.0
+        return stats
+
+    def lookup(self, category: str, text: str, threshold: float, limit: int = 1) -> list:
+        """Returns up to `limit` (similarity, ideas) pairs at or above threshold, best first."""
+        start = time.perf_counter()
+        vector = embed(text, self.dimensions)
+        rows = np.flatnonzero(vector)
+        matches = []
+        with self._lock:
+            partition = self._categories.get(category)
+            count = len(partition["ideas"]) if partition else 0
+            if count:
+                similarities = vector[rows] @ partition["vectors"][rows, :count] / QUANTIZATION_SCALE
+                if limit < count:
+                    candidates = np.argpartition(similarities, -limit)[-limit:]
+                else:
+                    candidates = np.arange(count)
+                now = time.time()
+                for index in candidates[np.argsort(similarities[candidates])[::-1]]:
+                    if similarities[index] >= threshold and partition["expires"][index] > now:
+                        matches.append((float(similarities[index]), partition["ideas"][index]))
+            self.stats["hits" if matches else "misses"] += 1
+            self.stats["lookup_seconds"] += time.perf_counter() - start
+        return matches
+
+semantic_cache = SemanticCache(path=SEMANTIC_CACHE_PATH or None)
+
+def serve_similar(matches: list, mode: str = SEMANTIC_CACHE_MODE) -> dict:
+    """Builds a response from semantic cache matches, reshuffled or merged as configured."""
+    if mode == "merged":
+        ideas = list(dict.fromkeys(idea for _, match in matches for idea in match))
+    else:
+        ideas = list(matches[0][1])
+    if mode in ("shuffled", "merged"):
+        random.shuffle(ideas)
+    return {"ideas": ideas}
 
 def get_brainstorming_ideas(category, list_of, context="", examples=""):
     test_input = {
@@ -82,4 +290,34 @@ def get_brainstorming_ideas(category, list_of, context="", examples=""):
         "examples": examples
     }
     response = chain.invoke(test_input)
-    return response
\ No newline at end of file
+    return response
+
+async def aget_brainstorming_ideas(category, list_of, context="", examples="", use_cache=True):
+    """
+    Async version of get_brainstorming_ideas that awaits the model call.
+    Identical requests are served from the response cache, and requests worded like
+    a cached one of the same category from the semantic cache, unless use_cache is False.
+    The semantic cache indexes exactly the answers the response cache stores.
+    """
+    test_input = {
+        "category": category,
+        "list_of": list_of,
+        "context": context,
+        "examples": examples
+    }
+    text = request_text(list_of, context, examples)
+    partition = category.strip().lower()
+    semantic = SEMANTIC_CACHE_ENABLED and partition in SEMANTIC_CACHE_CATEGORIES
+    if use_cache and semantic:
+        await semantic_cache.arefresh()
+        limit = SEMANTIC_CACHE_MAX_MERGED if SEMANTIC_CACHE_MODE == "merged" else 1
+        matches = semantic_cache.lookup(partition, text, similarity_threshold(category), limit)
+        if matches:
+            return serve_similar(matches)
+
+    async def remember(response):
+        if isinstance(response, dict) and isinstance(response.get("ideas"), list):
+            await semantic_cache.aadd(partition, text, response["ideas"])
+
+    return await acached_invoke(brainstorming_cache, brainstorming_prompt, llm, parser, test_input, use_cache,
+                                on_store=remember if semantic else None)
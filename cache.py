@@ -0,0 +1,274 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import store
+from concurrency import run_blocking
+from metrics import Timed
+from router import fallback_backend
+
+# Cache configuration, overridable through environment variables
+CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+CACHE_MAX_DISK_BYTES = int(os.getenv("CACHE_MAX_DISK_MB", "256")) * 1024 * 1024
+
+_db_lock = threading.Lock()
+_db = None
+# Size of the on-disk tier as last counted plus this process's writes since; writes by
+# other processes are picked up when it reaches the limit and the rows are counted again
+_disk_bytes = None
+
+
+def _connection():
+    """Opens the on-disk cache database, shared by all processes, on first use."""
+    global _db
+    if _db is None:
+        _db = store.connect(os.path.join(CACHE_DIR, "responses.sqlite3"))
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " name TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            " size INTEGER NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL,"
+            " PRIMARY KEY (name, key))"
+        )
+        _db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        _db.commit()
+    return _db
+
+
+def make_key(model: str, temperature, prompt_text: str) -> str:
+    """Builds a cache key from the model name, temperature and fully rendered prompt."""
+    payload = json.dumps([model, temperature, prompt_text], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Two-tier cache for parsed chain responses.
+
+    Entries live in an in-process LRU (bounded by CACHE_MAX_ENTRIES) backed by a
+    SQLite table shared by every cache and server process (bounded by CACHE_MAX_DISK_BYTES). Both tiers
+    honour the TTL, and a disk hit is promoted back into memory.
+    """
+
+    def __init__(self, name: str, ttl: float = CACHE_TTL_SECONDS, max_entries: int = CACHE_MAX_ENTRIES):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "bypassed": 0, "coalesced": 0}
+
+    def get(self, key: str):
+        """Returns the cached value for key, or None on a miss. Blocks on the disk tier; see `aget`."""
+        value = self._recall(key)
+        return value if value is not None else self._load(key)
+
+    async def aget(self, key: str):
+        """Returns the cached value for key, reading the disk tier in the blocking pool."""
+        value = self._recall(key)
+        return value if value is not None else await run_blocking(self._load, key)
+
+    def set(self, key: str, value):
+        """Stores a JSON-serializable value in both tiers. Blocks on the disk tier; see `aset`."""
+        self._store(key, value, self._remember(key, value))
+
+    async def aset(self, key: str, value):
+        """Stores a JSON-serializable value in both tiers, writing the disk tier in the blocking pool."""
+        await run_blocking(self._store, key, value, self._remember(key, value))
+
+    def _recall(self, key: str):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > now:
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return value
+                del self._memory[key]
+        return None
+
+    def _load(self, key: str):
+        now = time.time()
+        with _db_lock:
+            db = _connection()
+            row = db.execute(
+                "SELECT value, expires FROM responses WHERE name = ? AND key = ?", (self.name, key)
+            ).fetchone()
+            if row is not None and row[1] <= now:
+                db.execute("DELETE FROM responses WHERE name = ? AND key = ?", (self.name, key))
+                db.commit()
+                row = None
+            elif row is not None:
+                db.execute(
+                    "UPDATE responses SET accessed = ? WHERE name = ? AND key = ?", (now, self.name, key)
+                )
+                db.commit()
+
+        if row is None:
+            with self._lock:
+                self.stats["misses"] += 1
+            return None
+
+        value = json.loads(row[0])
+        self._remember(key, value, row[1])
+        with self._lock:
+            self.stats["disk_hits"] += 1
+        return value
+
+    def _store(self, key: str, value, expires: float):
+        global _disk_bytes
+        serialized = json.dumps(value, ensure_ascii=False)
+        size = len(serialized.encode("utf-8"))
+        now = time.time()
+        with _db_lock:
+            db = _connection()
+            if _disk_bytes is None:
+                _count_disk(db)
+            previous = db.execute(
+                "SELECT size FROM responses WHERE name = ? AND key = ?", (self.name, key)
+            ).fetchone()
+            db.execute(
+                "INSERT OR REPLACE INTO responses (name, key, value, size, expires, accessed)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (self.name, key, serialized, size, expires, now),
+            )
+            _disk_bytes += size - (previous[0] if previous else 0)
+            if _disk_bytes > CACHE_MAX_DISK_BYTES:
+                _evict_disk(db, now)
+            db.commit()
+
+    def record_bypass(self):
+        with self._lock:
+            self.stats["bypassed"] += 1
+
+    def _remember(self, key, value, expires: float = None):
+        """Stores value in the memory tier and returns its expiry time."""
+        if expires is None:
+            expires = time.time() + self.ttl
+        with self._lock:
+            self._memory[key] = (expires, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+        return expires
+
+
+def _count_disk(db):
+    global _disk_bytes
+    _disk_bytes = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+
+def _evict_disk(db, now: float):
+    """Drops expired rows, then the least recently used rows until under the size limit."""
+    global _disk_bytes
+    db.execute("DELETE FROM responses WHERE expires <= ?", (now,))
+    _count_disk(db)
+    if _disk_bytes <= CACHE_MAX_DISK_BYTES:
+        return
+    for name, key, size in db.execute(
+        "SELECT name, key, size FROM responses ORDER BY accessed ASC"
+    ).fetchall():
+        db.execute("DELETE FROM responses WHERE name = ? AND key = ?", (name, key))
+        _disk_bytes -= size
+        if _disk_bytes <= CACHE_MAX_DISK_BYTES:
+            break
+
+
+def warm_up():
+    """Opens the shared database and drops expired entries before the first request."""
+    with _db_lock:
+        db = _connection()
+        _evict_disk(db, time.time())
+        db.commit()
+
+
+def model_name(llm) -> str:
+    """Returns the model identifier of a LangChain chat model."""
+    return getattr(llm, "model", None) or getattr(llm, "model_name", "") or type(llm).__name__
+
+
+async def acached_invoke(cache: ResponseCache, prompt, llm, parser, input_data: dict, use_cache: bool = True, on_store=None):
+    """
+    Runs `prompt | llm | parser` on input_data, serving the parsed result from cache
+    when the same model, temperature and rendered prompt were seen before. Answers
+    that a routed model got from a fallback backend (see router.py) are returned
+    but not cached, since the key names the preferred model.
+
+    Concurrent cached calls with the same key share one upstream call (single flight):
+    later callers wait for the first one and receive its result or its error.
+
+    Args:
+        cache (ResponseCache): Cache for the calling endpoint.
+        prompt: The chain's PromptTemplate.
+        llm: The chat model.
+        parser: The output parser.
+        input_data (dict): Variables for the prompt.
+        use_cache (bool): Set to False to skip the cache and force a fresh generation;
+            the result is not stored either.
+        on_store: Optional coroutine function called with a freshly generated result
+            after it is stored, e.g. to index it in a second cache. Not called for
+            results served from cache or not stored.
+
+    Returns:
+        dict: The parsed model response.
+    """
+    model = model_name(llm)
+    backend = getattr(llm, "backend", "")
+    prompt_value = await Timed("prompt", prompt, backend).ainvoke(input_data)
+    key = make_key(model, getattr(llm, "temperature", None), prompt_value.to_string())
+    parser = Timed("parse", parser, backend)
+
+    if not use_cache:
+        # A forced regeneration must not receive another caller's result
+        cache.record_bypass()
+        return await _generate(cache, key, llm, parser, prompt_value, store_result=False)
+
+    cached = await cache.aget(key)
+    if cached is not None:
+        return cached
+
+    flight_key = (cache.name, key)
+    task = _in_flight.get(flight_key)
+    if task is None:
+        task = asyncio.ensure_future(_generate(cache, key, llm, parser, prompt_value, on_store=on_store))
+        _in_flight[flight_key] = task
+        task.add_done_callback(lambda _, flight_key=flight_key: _in_flight.pop(flight_key, None))
+    else:
+        with cache._lock:
+            cache.stats["coalesced"] += 1
+    # Shielded, so a caller that disconnects does not cancel the call for the others
+    return await asyncio.shield(task)
+
+
+async def _generate(cache: ResponseCache, key: str, llm, parser, prompt_value, store_result: bool = True, on_store=None):
+    message = await llm.ainvoke(prompt_value)
+    response = await parser.ainvoke(message)
+    if store_result and fallback_backend(message) is None:
+        await cache.aset(key, response)
+        if on_store is not None:
+            await on_store(response)
+    return response
+
+
+# Upstream calls currently running, keyed by (cache name, key)
+_in_flight = {}
+_registry = {}
+
+
+def get_cache(name: str, ttl: float = CACHE_TTL_SECONDS) -> ResponseCache:
+    """Returns the cache for an endpoint, creating it on first use."""
+    if name not in _registry:
+        _registry[name] = ResponseCache(name, ttl=ttl)
+    return _registry[name]
+
+
+def all_stats() -> dict:
+    """Returns the hit/miss/coalesced counters of every cache created so far, keyed by name."""
+    return {cache.name: dict(cache.stats) for cache in _registry.values()}
@@ -1,29 +1,26 @@
 # Importing Required Libraries
-from langchain_google_genai import ChatGoogleGenerativeAI
-from dotenv import load_dotenv
-from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.prompts import PromptTemplate
 from langchain_core.pydantic_v1 import BaseModel, Field
+import asyncio
 import os
+import re
 
-# Load Environment Variables
-load_dotenv()
+from router import routed_model
+from metrics import timed_chain
+from parsers import TolerantJsonOutputParser
+from cache import acached_invoke, get_cache
+from tokens import count_tokens, input_budget
+import retrieval
 
-# Get GEMINI API Key
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-
-# Initialize Language Model
-llm = ChatGoogleGenerativeAI(
-    model="gemini-2.0-pro-exp-02-05",
-    temperature=1,
-)
+# Initialize Language Model (the shared Gemini client is created on first use)
+llm = routed_model("gemini", temperature=1)
 
 # Define Output Schema for JSON Response
 class StoryChapter(BaseModel):
     chapter_text: str = Field(description="Full text of the generated chapter")
 
 # Create JSON Output Parser
-parser = JsonOutputParser(pydantic_object=StoryChapter)
+parser = TolerantJsonOutputParser(pydantic_object=StoryChapter)
 
 # Prompt Template with JSON Output Specification
 chapter_prompt_template = """
@@ -58,12 +55,349 @@ The output must be in JSON format as follows:
 {{
     "chapter_text": "Full text of the generated chapter here"
 }}
+```
 """
 
 
 chapter_prompt = PromptTemplate( input_variables=[ "plotPoint", "previousChapters", "characterData", "worldbuildingData", "userGenre", "userStyle" ], template=chapter_prompt_template )
 
-chapter_chain = chapter_prompt | llm | parser
+chapter_chain = timed_chain(chapter_prompt, llm, parser)
+
+# Context compaction settings: the whole rendered prompt is kept under
+# CHAPTER_PROMPT_TOKEN_BUDGET, with the last FULL_CHAPTERS_KEPT chapters verbatim
+CHAPTER_PROMPT_TOKEN_BUDGET = int(os.getenv("CHAPTER_PROMPT_TOKEN_BUDGET", str(input_budget("chapter"))))
+FULL_CHAPTERS_KEPT = int(os.getenv("FULL_CHAPTERS_KEPT", "2"))
+SUMMARY_CACHE_TTL_SECONDS = float(os.getenv("SUMMARY_CACHE_TTL_SECONDS", str(30 * 24 * 60 * 60)))
+
+# Define Output Schema for Chapter Summaries
+class ChapterSummary(BaseModel):
+    summary: str = Field(description="Condensed summary of the chapter")
+
+summary_parser = TolerantJsonOutputParser(pydantic_object=ChapterSummary)
+
+summary_prompt_template = """
+TASK: Summarize the following story text so it can stand in for the full text when writing later chapters.
+Keep every plot event, character decision, relationship change, revealed secret and open thread, in order.
+Drop description and dialogue that do not affect the plot. Use at most {maxWords} words.
+
+STORY TEXT:
+{chapterText}
+
+The output must be in JSON format as follows:
+```json
+{{
+    "summary": "Summary of the text here"
+}}
+```
+"""
+
+summary_prompt = PromptTemplate(input_variables=["chapterText", "maxWords"], template=summary_prompt_template)
+
+# Summaries are cached by rendered prompt, so each chapter is summarized once and reused
+summary_cache = get_cache("chapter_summary", ttl=SUMMARY_CACHE_TTL_SECONDS)
+
+CHAPTER_HEADING = re.compile(r"^(?=[ \t]*(?:#{1,6}[ \t]|chapter\b))", re.IGNORECASE | re.MULTILINE)
+
+def split_chapters(previous_chapters: str) -> list:
+    """
+    Splits the previous chapters text into individual chapters.
+
+    Chapters are split on headings such as "Chapter 3" or "## The Gate". Text
+    without headings is split on runs of three or more newlines.
+    """
+    if not previous_chapters or not previous_chapters.strip():
+        return []
+    parts = CHAPTER_HEADING.split(previous_chapters)
+    if len([part for part in parts if part.strip()]) <= 1:
+        parts = re.split(r"\n[ \t]*\n[ \t]*\n+", previous_chapters)
+    return [part.strip() for part in parts if part.strip()]
+
+async def summarize_text(text: str, max_words: int) -> str:
+    """
+    Returns a cached summary of text, generating it on first use. Text too large for
+    one summary prompt is summarized in parts.
+    """
+    limit = CHAPTER_PROMPT_TOKEN_BUDGET - count_tokens(summary_prompt_template) - 100
+    if count_tokens(text) > limit:
+        size = limit * 4
+        parts = [text[start:start + size] for start in range(0, len(text), size)]
+        summaries = await asyncio.gather(*(summarize_text(part, max(50, max_words // len(parts))) for part in parts))
+        return "\n\n".join(summaries)
+
+    response = await acached_invoke(
+        summary_cache, summary_prompt, llm, summary_parser,
+        {"chapterText": text, "maxWords": max_words},
+    )
+    return response.get("summary", "")
+
+async def compact_previous_chapters(previous_chapters: str, token_budget: int) -> str:
+    """
+    Shrinks the previous chapters so they fit within token_budget.
+
+    The most recent FULL_CHAPTERS_KEPT chapters are kept verbatim and older ones are
+    replaced by their summaries. If that is still too large, the oldest summaries are
+    folded into a single "story so far" summary, and finally fewer chapters are kept
+    in full. Every summary is cached, so a chapter is only summarized once.
+
+    Args:
+        previous_chapters (str): Text of the previous chapters.
+        token_budget (int): Maximum estimated tokens for the returned text.
+
+    Returns:
+        str: Text to use in place of previous_chapters in the prompt.
+    """
+    if count_tokens(previous_chapters) <= token_budget:
+        return previous_chapters
+    if token_budget <= 0:
+        # No room at all: nothing is worth summarizing
+        return ""
+
+    chapters = split_chapters(previous_chapters)
+    keep = min(FULL_CHAPTERS_KEPT, len(chapters))
+    older, recent = chapters[:len(chapters) - keep], chapters[len(chapters) - keep:]
+
+    summaries = list(await asyncio.gather(*(summarize_text(c, 300) for c in older)))
+
+    def render(summaries, recent):
+        sections = []
+        if summaries:
+            sections.append("SUMMARY OF EARLIER CHAPTERS:\n" + "\n\n".join(summaries))
+        if recent:
+            sections.append("MOST RECENT CHAPTERS (full text):\n" + "\n\n".join(recent))
+        return "\n\n".join(sections)
+
+    compacted = render(summaries, recent)
+    while count_tokens(compacted) > token_budget and len(summaries) > 1:
+        # Fold the oldest half of the summaries into one; the fold of a given
+        # prefix is cached, so appending chapters only re-summarizes the tail.
+        half = max(2, len(summaries) // 2)
+        folded = await summarize_text("\n\n".join(summaries[:half]), 500)
+        summaries = [folded] + summaries[half:]
+        compacted = render(summaries, recent)
+
+    while count_tokens(compacted) > token_budget and recent:
+        summaries = summaries + [await summarize_text(recent[0], 300)]
+        recent = recent[1:]
+        compacted = render(summaries, recent)
+
+    if count_tokens(compacted) > token_budget:
+        compacted = compacted[-token_budget * 4:]
+    return compacted
+
+def select_story_data(plot_point: str, previous_chapters: str, character_data: str, worldbuilding_data: str) -> tuple:
+    """
+    Narrows character and worldbuilding data to the entries relevant to the plot point
+    and the end of the previous chapters (see retrieval.py). Callers do this once,
+    before checking the request against its budget.
+    """
+    return retrieval.select_story_data(character_data, worldbuilding_data, plot_point, retrieval.recent_words(previous_chapters))
+
+async def prepare_chapter_input(input_data: dict, reserve_tokens: int = 0) -> dict:
+    """
+    Replaces previousChapters with a compacted version that keeps the prompt within
+    budget, leaving reserve_tokens free for prompts that add more than the chapter
+    prompt does. characterData and worldbuildingData are expected to be narrowed
+    already (see select_story_data).
+    """
+    other_inputs = dict(input_data, previousChapters="")
+    base_tokens = count_tokens(chapter_prompt.format(**other_inputs))
+    history_budget = max(CHAPTER_PROMPT_TOKEN_BUDGET - base_tokens - reserve_tokens, 0)
+    compacted = await compact_previous_chapters(input_data["previousChapters"], history_budget)
+    return dict(input_data, previousChapters=compacted)
+
+# Parallel mode: the chapter is planned into PARALLEL_CHAPTER_SCENES beats, the
+# scenes are written concurrently and their transitions smoothed afterwards
+PARALLEL_CHAPTER_SCENES = int(os.getenv("PARALLEL_CHAPTER_SCENES", "4"))
+PARALLEL_CHAPTER_WORDS = int(os.getenv("PARALLEL_CHAPTER_WORDS", "3000"))
+
+# Define Output Schemas for the Parallel Mode
+class ChapterPlan(BaseModel):
+    beats: list = Field(description="One short description per scene, in order")
+
+class ChapterScene(BaseModel):
+    scene_text: str = Field(description="Full text of the scene")
+
+class SceneTransition(BaseModel):
+    ending: str = Field(description="Revised last paragraph of the earlier scene")
+    opening: str = Field(description="Revised first paragraph of the later scene")
+
+plan_parser = TolerantJsonOutputParser(pydantic_object=ChapterPlan)
+scene_parser = TolerantJsonOutputParser(pydantic_object=ChapterScene)
+transition_parser = TolerantJsonOutputParser(pydantic_object=SceneTransition)
+
+plan_prompt_template = """
+TASK: Plan the next chapter of a story as a SCENE PLAN of exactly {sceneCount} scene beats, in order.
+Each beat is two or three sentences saying where the scene takes place, who is in it, what happens and
+how it ends, so that the scenes can be written independently and still read as one continuous chapter.
+Together the beats must cover the plot point from start to finish.
+
+PLOT POINT:
+{plotPoint}
+
+PREVIOUS CHAPTERS:
+{previousChapters}
+
+CHARACTERS:
+{characterData}
+
+WORLDBUILDING:
+{worldbuildingData}
+
+GENRE: {userGenre}
+
+STYLE: {userStyle}
+
+The output must be in JSON format as follows:
+```json
+{{
+    "beats": ["Beat of scene 1", "Beat of scene 2"]
+}}
+```
+"""
+
+scene_prompt_template = """
+TASK: Write SCENE TO WRITE number {sceneNumber} of {sceneCount} of a story chapter. The other scenes are
+written separately, so write only this scene: pick up where the previous beat leaves off and end where the
+next beat begins. Do not summarize the other scenes or add a chapter heading.
+Maintain a consistent style and tone, aligning with the genre and any established themes.
+Aim for about {sceneWords} words, unless 'STYLE' asks for a different chapter length, in which case write
+this scene's share of it.
+
+CHAPTER PLAN:
+{chapterPlan}
+
+PREVIOUS BEAT:
+{previousBeat}
+
+SCENE TO WRITE:
+{sceneBeat}
+
+NEXT BEAT:
+{nextBeat}
+
+PLOT POINT:
+{plotPoint}
+
+PREVIOUS CHAPTERS:
+{previousChapters}
+
+CHARACTERS:
+{characterData}
+
+WORLDBUILDING:
+{worldbuildingData}
+
+GENRE: {userGenre}
+
+STYLE: {userStyle}
+
+The output must be in JSON format as follows:
+```json
+{{
+    "scene_text": "Full text of the scene here"
+}}
+```
+"""
+
+transition_prompt_template = """
+TASK: Two consecutive scenes of a chapter were written separately. Revise the SCENE TRANSITION below, the
+last paragraph of the earlier scene and the first paragraph of the later one, so the chapter flows
+naturally across it: remove repetition, fix contradictions and add a bridge where needed.
+Keep the events, the style and roughly the same length. Change nothing else.
+
+GENRE: {userGenre}
+
+STYLE: {userStyle}
+
+LAST PARAGRAPH OF THE EARLIER SCENE:
+{ending}
+
+FIRST PARAGRAPH OF THE LATER SCENE:
+{opening}
+
+The output must be in JSON format as follows:
+```json
+{{
+    "ending": "Revised last paragraph of the earlier scene",
+    "opening": "Revised first paragraph of the later scene"
+}}
+```
+"""
+
+plan_prompt = PromptTemplate(input_variables=["plotPoint", "previousChapters", "characterData", "worldbuildingData", "userGenre", "userStyle", "sceneCount"], template=plan_prompt_template)
+scene_prompt = PromptTemplate(input_variables=["chapterPlan", "previousBeat", "sceneBeat", "nextBeat", "sceneNumber", "sceneCount", "sceneWords", "plotPoint", "previousChapters", "characterData", "worldbuildingData", "userGenre", "userStyle"], template=scene_prompt_template)
+transition_prompt = PromptTemplate(input_variables=["ending", "opening", "userGenre", "userStyle"], template=transition_prompt_template)
+
+plan_chain = timed_chain(plan_prompt, llm, plan_parser)
+scene_chain = timed_chain(scene_prompt, llm, scene_parser)
+transition_chain = timed_chain(transition_prompt, llm, transition_parser)
+
+def split_paragraphs(text: str) -> list:
+    """Splits text into paragraphs on blank lines."""
+    return [part.strip() for part in re.split(r"\n[ \t]*\n", text) if part.strip()]
+
+async def plan_chapter(input_data: dict, scene_count: int) -> list:
+    """Returns up to scene_count scene beats for the chapter."""
+    response = await plan_chain.ainvoke(dict(input_data, sceneCount=scene_count))
+    beats = [str(beat).strip() for beat in response.get("beats") or [] if str(beat).strip()]
+    return beats[:scene_count]
+
+async def write_scene(input_data: dict, beats: list, index: int) -> list:
+    """Writes the scene for beats[index] and returns its paragraphs."""
+    plan = "\n".join(f"{number}. {beat}" for number, beat in enumerate(beats, start=1))
+    response = await scene_chain.ainvoke(dict(
+        input_data,
+        chapterPlan=plan,
+        previousBeat=beats[index - 1] if index > 0 else "(start of the chapter)",
+        sceneBeat=beats[index],
+        nextBeat=beats[index + 1] if index + 1 < len(beats) else "(end of the chapter)",
+        sceneNumber=index + 1,
+        sceneCount=len(beats),
+        sceneWords=PARALLEL_CHAPTER_WORDS // len(beats),
+    ))
+    return split_paragraphs(response.get("scene_text") or "")
+
+async def smooth_transition(input_data: dict, earlier: list, later: list):
+    """Rewrites the last paragraph of earlier and the first of later in place."""
+    response = await transition_chain.ainvoke({
+        "ending": earlier[-1],
+        "opening": later[0],
+        "userGenre": input_data["userGenre"],
+        "userStyle": input_data["userStyle"],
+    })
+    if response.get("ending") and response.get("opening"):
+        earlier[-1], later[0] = response["ending"].strip(), response["opening"].strip()
+
+async def agenerate_parallel_chapter(input_data: dict) -> dict:
+    """
+    Generates a chapter as concurrently written scenes.
+
+    The chapter is planned into scene beats, every scene is written at the same
+    time with the shared context and its neighbouring beats, and a continuity pass
+    then revises the paragraphs on either side of each scene boundary (also
+    concurrently). Wall time is roughly one plan, one scene and one transition
+    call instead of one full-chapter call; total tokens are higher, since every
+    scene prompt repeats the context.
+
+    Args:
+        input_data (dict): Prepared input of the chapter prompt.
+
+    Returns:
+        dict: The generated chapter, in the same format as the single-call mode.
+    """
+    beats = await plan_chapter(input_data, PARALLEL_CHAPTER_SCENES)
+    if len(beats) < 2:
+        # Nothing to parallelize
+        return await chapter_chain.ainvoke(input_data)
+
+    scenes = list(await asyncio.gather(*(write_scene(input_data, beats, i) for i in range(len(beats)))))
+    scenes = [scene for scene in scenes if scene]
+
+    # A boundary is only smoothed when both sides have a paragraph no other boundary touches
+    boundaries = [i for i in range(len(scenes) - 1) if len(scenes[i]) > 1 and len(scenes[i + 1]) > 1]
+    await asyncio.gather(*(smooth_transition(input_data, scenes[i], scenes[i + 1]) for i in boundaries))
+
+    return {"chapter_text": "\n\n".join("\n\n".join(scene) for scene in scenes)}
 
 def generate_story_chapter( 
     plot_point: str, 
@@ -103,3 +437,80 @@ def generate_story_chapter(
     
     # Return the generated chapter in JSON format
     return response
+
+async def agenerate_story_chapter(
+    plot_point: str,
+    previous_chapters: str,
+    character_data: str,
+    worldbuilding_data: str,
+    user_genre: str,
+    user_style: str,
+    mode: str = "single"
+) -> dict:
+    """
+    Async version of generate_story_chapter. Awaits the model call instead of
+    blocking the event loop, so other requests keep being served meanwhile.
+
+    With mode="parallel" the chapter is written as concurrent scenes
+    (see agenerate_parallel_chapter) instead of in one call.
+    """
+    input_data = {
+        "plotPoint": plot_point,
+        "previousChapters": previous_chapters,
+        "characterData": character_data,
+        "worldbuildingData": worldbuilding_data,
+        "userGenre": user_genre,
+        "userStyle": user_style
+    }
+
+    if mode == "parallel":
+        # Scene prompts also carry the scene template and the chapter plan
+        reserve = count_tokens(scene_prompt_template) + (PARALLEL_CHAPTER_SCENES + 3) * 100
+        return await agenerate_parallel_chapter(await prepare_chapter_input(input_data, reserve))
+
+    input_data = await prepare_chapter_input(input_data)
+    response = await chapter_chain.ainvoke(input_data)
+    return response
+
+async def astream_story_chapter(
+    plot_point: str,
+    previous_chapters: str,
+    character_data: str,
+    worldbuilding_data: str,
+    user_genre: str,
+    user_style: str
+):
+    """
+    Streams a story chapter as it is generated.
+
+    The chain's JSON parser re-parses the partial output on every chunk, so each
+    yielded item is the cumulative object parsed so far. Only the newly added part
+    of `chapter_text` is yielded, followed by the complete object at the end. When a
+    repaired parse rewrites text that was already sent, nothing is yielded until the
+    text extends what was sent again.
+
+    Yields:
+        tuple: ("delta", str) for each new piece of chapter text, then ("final", dict).
+    """
+    input_data = {
+        "plotPoint": plot_point,
+        "previousChapters": previous_chapters,
+        "characterData": character_data,
+        "worldbuildingData": worldbuilding_data,
+        "userGenre": user_genre,
+        "userStyle": user_style
+    }
+
+    input_data = await prepare_chapter_input(input_data)
+    latest = {}
+    sent = ""
+    async for partial in chapter_chain.astream(input_data):
+        if not isinstance(partial, dict):
+            continue
+        latest = partial
+        text = partial.get("chapter_text") or ""
+        if len(text) > len(sent) and text.startswith(sent):
+            yield "delta", text[len(sent):]
+            sent = text
+
+    yield "final", latest
@@ -1,21 +1,13 @@
-from langchain_google_genai import ChatGoogleGenerativeAI
-from dotenv import load_dotenv
-from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.prompts import PromptTemplate
 from langchain_core.pydantic_v1 import BaseModel, Field
-import os
 
-# Load environment variables
-load_dotenv()
+from router import routed_model
+from metrics import timed_chain
+from parsers import TolerantJsonOutputParser
+from cache import acached_invoke, get_cache
 
-# Get GEMINI API Key
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-
-# Initialize LLM with Google Generative AI
-llm = ChatGoogleGenerativeAI(
-    model="gemini-2.0-pro-exp-02-05",
-    temperature=1
-)
+# Initialize LLM (the shared Gemini client is created on first use)
+llm = routed_model("gemini", temperature=1)
 
 # Define Output Schema
 class CharacterProfile(BaseModel):
@@ -24,7 +16,7 @@ class CharacterProfile(BaseModel):
     backstory: str = Field(description="Short backstory that aligns with the personality traits")
 
 # Create Output Parser
-parser = JsonOutputParser(pydantic_object=CharacterProfile)
+parser = TolerantJsonOutputParser(pydantic_object=CharacterProfile)
 
 # Define Character Prompt Template
 character_prompt_template = """
@@ -53,7 +45,10 @@ character_prompt = PromptTemplate(
 )
 
 # Combine Prompt, LLM, and Parser into a Chain
-character_chain = character_prompt | llm | parser
+character_chain = timed_chain(character_prompt, llm, parser)
+
+# Response cache keyed on model, temperature and rendered prompt
+character_cache = get_cache("character")
 
 # Function to Generate Character Profile
 def generate_character_profile(user_character_description: str, user_genre: str) -> dict:
@@ -78,3 +73,16 @@ def generate_character_profile(user_character_description: str, user_genre: str)
     
     # Return the generated character profile in JSON format
     return response
+
+async def agenerate_character_profile(user_character_description: str, user_genre: str, use_cache: bool = True) -> dict:
+    """
+    Async version of generate_character_profile that awaits the model call.
+    Identical requests are served from the response cache unless use_cache is False.
+    """
+    input_data = {
+        "userCharacterDescription": user_character_description,
+        "userGenre": user_genre
+    }
+
+    response = await acached_invoke(character_cache, character_prompt, llm, parser, input_data, use_cache)
+    return response
@@ -0,0 +1,88 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import tokens
+
+# Default number of in-flight calls allowed per endpoint when no override is set
+DEFAULT_MAX_CONCURRENCY = int(os.getenv("DEFAULT_MAX_CONCURRENCY", "16"))
+
+# Size of the shared thread pool used for providers that have no async client
+BLOCKING_POOL_SIZE = int(os.getenv("BLOCKING_POOL_SIZE", "8"))
+
+_executor = ThreadPoolExecutor(max_workers=BLOCKING_POOL_SIZE, thread_name_prefix="blocking")
+_semaphores = {}
+
+
+def max_concurrency(endpoint: str) -> int:
+    """
+    Returns the concurrency limit configured for an endpoint.
+
+    The limit is read from the `<ENDPOINT>_MAX_CONCURRENCY` environment variable
+    (e.g. `CHAPTER_MAX_CONCURRENCY=4`), falling back to DEFAULT_MAX_CONCURRENCY.
+    """
+    value = os.getenv(f"{endpoint.upper()}_MAX_CONCURRENCY")
+    return int(value) if value else DEFAULT_MAX_CONCURRENCY
+
+
+def _semaphore(endpoint: str) -> asyncio.Semaphore:
+    if endpoint not in _semaphores:
+        _semaphores[endpoint] = asyncio.Semaphore(max_concurrency(endpoint))
+    return _semaphores[endpoint]
+
+
+@asynccontextmanager
+async def endpoint_limit(endpoint: str):
+    """
+    Async context manager that caps the number of concurrent calls for an endpoint.
+    Requests above the limit wait for a free slot instead of piling onto the provider.
+    Model calls made inside it are accounted to the endpoint (see tokens.py).
+    """
+    async with _semaphore(endpoint):
+        previous = tokens.current_endpoint.get()
+        tokens.current_endpoint.set(endpoint)
+        try:
+            yield
+        finally:
+            # Not reset(): a streaming response may be closed from another context
+            tokens.current_endpoint.set(previous)
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Runs a blocking function in the shared bounded thread pool so it does not
+    stall the event loop. Used for clients that have no async API (Together, ElevenLabs).
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+async def run_batch(endpoint: str, func, items: list, limit: int = None) -> list:
+    """
+    Runs func on every item concurrently and returns one result per item, in order.
+
+    At most `limit` items of the batch run at once (default: the
+    `<ENDPOINT>_BATCH_MAX_CONCURRENCY` setting), and every call also counts against
+    the endpoint's own concurrency limit. A failing item does not affect the others.
+
+    Args:
+        endpoint (str): Endpoint name used for the concurrency limits.
+        func: Async function called with each item.
+        items (list): Inputs for the batch.
+        limit (int): Optional override for the per-batch concurrency cap.
+
+    Returns:
+        list: {"status": "ok", "result": ...} or {"status": "error", "error": ...} per item.
+    """
+    batch_semaphore = asyncio.Semaphore(limit or max_concurrency(f"{endpoint}_batch"))
+
+    async def run_one(item):
+        async with batch_semaphore, endpoint_limit(endpoint):
+            try:
+                return {"status": "ok", "result": await func(item)}
+            except Exception as e:
+                return {"status": "error", "error": str(e)}
+
+    return await asyncio.gather(*(run_one(item) for item in items))
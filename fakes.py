@@ -0,0 +1,136 @@
+"""
+Local stand-ins for the Gemini / Together chat models, the Together image client
+and the ElevenLabs client, used by benchmark.py to load test the API without
+spending API credits.
+
+Every fake takes a `latency` (seconds before the first byte/token), and can be
+told to fail a fraction of calls with `failure_rate`. Chat models also emit their
+output at `tokens_per_second` (0 means instantly), counting four characters per token.
+"""
+import asyncio
+import json
+import random
+import time
+from types import SimpleNamespace
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+class FakeProviderError(Exception):
+    """Error raised by the fakes for simulated failures, shaped like an upstream 503."""
+    status_code = 503
+
+
+def _maybe_fail(failure_rate: float, provider: str):
+    if failure_rate and random.random() < failure_rate:
+        raise FakeProviderError(f"Simulated {provider} failure")
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Fake chat model. Every call waits `latency` seconds, then produces `response`
+    at `tokens_per_second`. When streamed, the response is sent in `chunk_size`
+    character pieces as they are "generated".
+
+    `responses` maps marker strings to responses: a prompt containing a marker gets
+    that response instead, so different chains can get outputs of realistic length.
+    """
+    response: str = json.dumps({"chapter_text": "Once upon a time."})
+    responses: dict = {}
+    latency: float = 1.0
+    tokens_per_second: float = 0.0
+    failure_rate: float = 0.0
+    chunk_size: int = 16
+    model: str = "fake-chat-model"
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def _decode_seconds(self, text: str) -> float:
+        return len(text) / 4 / self.tokens_per_second if self.tokens_per_second else 0.0
+
+    def _response_for(self, messages) -> str:
+        prompt = "\n".join(str(message.content) for message in messages)
+        for marker, response in self.responses.items():
+            if marker in prompt:
+                return response
+        return self.response
+
+    def _result(self, response: str) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=response))])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        response = self._response_for(messages)
+        time.sleep(self.latency)
+        _maybe_fail(self.failure_rate, "chat model")
+        time.sleep(self._decode_seconds(response))
+        return self._result(response)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        response = self._response_for(messages)
+        await asyncio.sleep(self.latency)
+        _maybe_fail(self.failure_rate, "chat model")
+        await asyncio.sleep(self._decode_seconds(response))
+        return self._result(response)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        response = self._response_for(messages)
+        await asyncio.sleep(self.latency)
+        _maybe_fail(self.failure_rate, "chat model")
+        for start in range(0, len(response), self.chunk_size):
+            piece = response[start:start + self.chunk_size]
+            if start:
+                await asyncio.sleep(self._decode_seconds(piece))
+            yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+
+
+class _FakeTextToSpeech:
+    def __init__(self, latency: float, bytes_per_char: int, failure_rate: float):
+        self.latency = latency
+        self.bytes_per_char = bytes_per_char
+        self.failure_rate = failure_rate
+
+    def convert(self, text, voice_id=None, model_id=None, output_format=None, **kwargs):
+        time.sleep(self.latency)
+        _maybe_fail(self.failure_rate, "ElevenLabs")
+        # Yields the audio in pieces like the real client does
+        payload = text.encode("utf-8") * self.bytes_per_char
+        for start in range(0, len(payload), 4096):
+            yield payload[start:start + 4096]
+
+
+class FakeElevenLabs:
+    """
+    Fake elevenlabs.client.ElevenLabs. `text_to_speech.convert` sleeps for `latency`
+    seconds and returns placeholder bytes proportional to the text length.
+    """
+
+    def __init__(self, latency: float = 0.5, bytes_per_char: int = 64, failure_rate: float = 0.0):
+        self.text_to_speech = _FakeTextToSpeech(latency, bytes_per_char, failure_rate)
+
+
+class _FakeImages:
+    # A 1x1 transparent PNG
+    PNG_B64 = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII="
+
+    def __init__(self, latency: float, failure_rate: float):
+        self.latency = latency
+        self.failure_rate = failure_rate
+
+    def generate(self, prompt, **kwargs):
+        time.sleep(self.latency)
+        _maybe_fail(self.failure_rate, "Together")
+        return SimpleNamespace(data=[SimpleNamespace(b64_json=self.PNG_B64)])
+
+
+class FakeTogether:
+    """
+    Fake together.Together. `images.generate` sleeps for `latency` seconds and
+    returns a tiny placeholder PNG.
+    """
+
+    def __init__(self, latency: float = 2.0, failure_rate: float = 0.0):
+        self.images = _FakeImages(latency, failure_rate)
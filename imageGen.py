@@ -1,61 +1,149 @@
 import base64
+import hashlib
 import json
 import os
-from together import Together
-from dotenv import load_dotenv
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
-# Load environment variables
-load_dotenv()
-TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY")
+import providers
+import resilience
 
-# Initialize the client
-client = Together(
-    api_key=TOGETHER_API_KEY
-)
+# Image settings
+IMAGE_MODEL = "black-forest-labs/FLUX.1-dev"
+IMAGE_WIDTH = 1024
+IMAGE_HEIGHT = 768
+IMAGE_STEPS = 28
 
-def generate_and_save_image(json_input):
-    """
-    Takes a JSON input containing a prompt, generates an image using the Together API,
-    saves the image as a file, and returns a download link.
-    
-    Example input: '{"prompt": "A character continuously crying and in a very depressed mood"}'
-    """
-    # Parse the JSON input to get the prompt
-    data = json.loads(json_input)
-    prompt = data.get('prompt')
-    
-    if not prompt:
-        return json.dumps({"error": "No prompt provided"})
-    
-    # Call the Together API to generate the image
-    response = client.images.generate(
+# Generated images are stored under IMAGE_DIR, named by the hash of their request
+IMAGE_DIR = os.getenv("IMAGE_DIR", "generated_images")
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "4"))
+# A pending marker older than this is left over from a process that stopped mid-generation
+IMAGE_PENDING_TIMEOUT_SECONDS = float(os.getenv("IMAGE_PENDING_TIMEOUT_SECONDS", "600"))
+
+_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+_jobs = {}
+_jobs_lock = threading.RLock()
+
+def set_client(new_client):
+    """Swaps the image client, e.g. for fakes.FakeTogether in benchmarks."""
+    providers.override("together_images", new_client)
+
+def image_id(prompt: str, model: str = IMAGE_MODEL, width: int = IMAGE_WIDTH, height: int = IMAGE_HEIGHT, steps: int = IMAGE_STEPS) -> str:
+    """Returns the content address of an image request: a hash of prompt, model, size and steps."""
+    payload = json.dumps([prompt, model, width, height, steps], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def image_path(image_id: str) -> str:
+    """Returns the file path of a stored image."""
+    return os.path.join(IMAGE_DIR, f"{image_id}.png")
+
+def _marker_path(image_id: str, state: str) -> str:
+    # "pending" and "failed" markers let every server process report the status of a generation
+    return os.path.join(IMAGE_DIR, f"{image_id}.{state}")
+
+def _write_marker(image_id: str, state: str, text: str = ""):
+    os.makedirs(IMAGE_DIR, exist_ok=True)
+    with open(_marker_path(image_id, state), "w", encoding="utf-8") as file:
+        file.write(text)
+
+def _remove_marker(image_id: str, state: str):
+    try:
+        os.remove(_marker_path(image_id, state))
+    except FileNotFoundError:
+        pass
+
+def _generate(prompt: str, key: str):
+    # Call the Together API to generate the image, with retries and rate limiting
+    response = resilience.call_blocking("together", lambda: providers.get_together_client().images.generate(
         prompt=prompt,
-        model="black-forest-labs/FLUX.1-dev",
-        width=1024,
-        height=768,
-        steps=28,
+        model=IMAGE_MODEL,
+        width=IMAGE_WIDTH,
+        height=IMAGE_HEIGHT,
+        steps=IMAGE_STEPS,
         n=1,
         response_format="b64_json",
-    )
-    
-    # Extract the Base64 image data
-    b64_json = response.data[0].b64_json
-    
-    # Decode the Base64 string to image data
-    image_data = base64.b64decode(b64_json)
-    
-    # Save the image as a file
-    image_filename = "generated_image.png"
-    with open(image_filename, "wb") as file:
+    ))
+
+    # Decode the Base64 image data and write it atomically, so readers never see a partial file
+    image_data = base64.b64decode(response.data[0].b64_json)
+    os.makedirs(IMAGE_DIR, exist_ok=True)
+    tmp_path = f"{image_path(key)}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as file:
         file.write(image_data)
-    
-    # Get the absolute file path
-    image_path = os.path.abspath(image_filename)
-    
-    # Return the download link (adjust the URL if serving from a web server)
-    download_link = f"file://{image_path}"
-    result = {
-        "download_link": download_link
-    }
-    
-    return json.dumps(result)
\ No newline at end of file
+    os.replace(tmp_path, image_path(key))
+    return key
+
+def submit_image(prompt: str):
+    """
+    Queues an image for generation on the background worker pool.
+
+    Images already on disk are not regenerated, and concurrent requests for the
+    same image share a single generation.
+
+    Args:
+        prompt (str): The prompt for image generation.
+
+    Returns:
+        tuple: (image_id, future). The future is None when the image already exists.
+    """
+    key = image_id(prompt)
+    if os.path.exists(image_path(key)):
+        return key, None
+
+    with _jobs_lock:
+        future = _jobs.get(key)
+        # Failed jobs are retried on the next request
+        if future is None or future.done():
+            _remove_marker(key, "failed")
+            _write_marker(key, "pending")
+            future = _executor.submit(_generate, prompt, key)
+            future.add_done_callback(lambda f, key=key: _forget(key, f))
+            _jobs[key] = future
+    return key, future
+
+def _forget(key, future):
+    _remove_marker(key, "pending")
+    if future.exception() is not None:
+        _write_marker(key, "failed", str(future.exception()))
+    # Successful jobs are served from disk from now on, failed ones are reported from their marker
+    with _jobs_lock:
+        if _jobs.get(key) is future:
+            del _jobs[key]
+
+def image_status(image_id: str) -> dict:
+    """
+    Returns the status of an image: "ready", "pending", "failed" or "unknown".
+    """
+    if os.path.exists(image_path(image_id)):
+        return {"image_id": image_id, "status": "ready"}
+    with _jobs_lock:
+        future = _jobs.get(image_id)
+    if future is None:
+        # Generated by another server process, if at all
+        try:
+            if time.time() - os.path.getmtime(_marker_path(image_id, "pending")) < IMAGE_PENDING_TIMEOUT_SECONDS:
+                return {"image_id": image_id, "status": "pending"}
+        except OSError:
+            pass
+        try:
+            with open(_marker_path(image_id, "failed"), encoding="utf-8") as file:
+                return {"image_id": image_id, "status": "failed", "error": file.read()}
+        except OSError:
+            return {"image_id": image_id, "status": "unknown"}
+    if not future.done():
+        return {"image_id": image_id, "status": "pending"}
+    return {"image_id": image_id, "status": "failed", "error": str(future.exception())}
+
+def generate_and_save_image(prompt):
+    """
+    Generates an image for the prompt using the Together API (or reuses a stored one)
+    and returns its image ID.
+
+    Example input: "A character continuously crying and in a very depressed mood"
+    """
+    key, future = submit_image(prompt)
+    if future is not None:
+        future.result()
+    return key
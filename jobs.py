@@ -0,0 +1,352 @@
+"""
+Background jobs for generations that can outlast an HTTP request.
+
+A job is submitted with a kind (the endpoint, e.g. "chapter") and a JSON payload,
+and gets an ID right away. JOB_WORKERS workers per process take queued jobs in
+order of priority, then age. The priority of a kind is `<KIND>_JOB_PRIORITY`
+(lower runs first), falling back to DEFAULT_JOB_PRIORITIES. Clients poll the job
+for its status and result, which is kept for JOB_RESULT_TTL_SECONDS.
+
+The queue is a SQLite table, so queued jobs survive a restart. A running job holds
+a lease that its worker renews. When a worker dies, the lease runs out and another
+worker takes the job again, up to JOB_MAX_ATTEMPTS times.
+
+Queue reads and writes block (another process may hold the write lock), so the
+workers run them in the blocking pool. `submit` is async for the same reason;
+callers on the event loop should run get_job, result_file and all_stats there too.
+"""
+import asyncio
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+import metrics
+import store
+from concurrency import endpoint_limit, run_blocking
+
+# Where the queue database and binary job results are stored
+JOBS_DIR = os.getenv("JOBS_DIR", ".jobs")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_RESULT_TTL_SECONDS = float(os.getenv("JOB_RESULT_TTL_SECONDS", str(60 * 60)))
+# How long a running job stays claimed without its worker renewing the lease
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "30"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Idle workers look for jobs at least this often (jobs submitted here wake them right away)
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))
+
+# Short interactive jobs first, images next, whole books (see pipeline.py) last
+DEFAULT_JOB_PRIORITIES = {"tts": 0, "chapter": 1, "imageGen": 2, "book": 3}
+
+STATUSES = ("queued", "running", "done", "failed")
+
+# Identifies this process in the `worker` column
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+_db_lock = threading.Lock()
+_db = None
+_handlers = {}
+_running = set()
+_workers = []
+_wakeup = None
+_last_purge = 0.0
+_error_status = None
+_draining = False
+
+
+class JobNotFound(KeyError):
+    """Raised when a job ID does not exist or its result has expired."""
+
+
+def _connection():
+    """Opens the job queue database, shared by all processes, on first use."""
+    global _db
+    if _db is None:
+        _db = store.connect(os.path.join(JOBS_DIR, "jobs.sqlite3"))
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, kind TEXT NOT NULL, priority INTEGER NOT NULL,"
+            " status TEXT NOT NULL, payload TEXT NOT NULL, result TEXT, media_type TEXT,"
+            " error TEXT, status_code INTEGER, attempts INTEGER NOT NULL DEFAULT 0,"
+            " worker TEXT, lease_expires REAL, created REAL NOT NULL, started REAL,"
+            " finished REAL, expires REAL)"
+        )
+        _db.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority, created)")
+        _db.commit()
+    return _db
+
+
+def _result_path(job_id: str) -> str:
+    return os.path.join(JOBS_DIR, "results", job_id)
+
+
+def priority(kind: str) -> int:
+    """Returns the queue priority of a job kind; lower runs first."""
+    value = os.getenv(f"{kind.upper()}_JOB_PRIORITY")
+    return int(value) if value else DEFAULT_JOB_PRIORITIES.get(kind, 10)
+
+
+def register(kind: str, handler, media_type: str = None):
+    """
+    Registers the function that runs jobs of a kind.
+
+    Args:
+        kind (str): Job kind, also used as the endpoint for concurrency limits.
+        handler: Async function called with the job payload. It returns a
+            JSON-serializable result, or bytes when media_type is given.
+        media_type (str): Content type of a bytes result; these are stored as files.
+    """
+    _handlers[kind] = (handler, media_type)
+
+
+async def submit(kind: str, payload: dict) -> dict:
+    """Queues a job and returns its description."""
+    if kind not in _handlers:
+        raise ValueError(f"Unknown job kind: {kind}")
+    job = await run_blocking(_enqueue, kind, payload)
+    if _wakeup is not None:
+        _wakeup.set()
+    return job
+
+
+def _enqueue(kind: str, payload: dict) -> dict:
+    job_id = uuid.uuid4().hex
+    with _db_lock:
+        db = _connection()
+        db.execute(
+            "INSERT INTO jobs (id, kind, priority, status, payload, created) VALUES (?, ?, ?, 'queued', ?, ?)",
+            (job_id, kind, priority(kind), json.dumps(payload, ensure_ascii=False), time.time()),
+        )
+        db.commit()
+    return get_job(job_id)
+
+
+def get_job(job_id: str) -> dict:
+    """
+    Returns a job's status, timings and, once done, its result.
+
+    Raises:
+        JobNotFound: When the job does not exist or has expired.
+    """
+    with _db_lock:
+        db = _connection()
+        row = db.execute(
+            "SELECT id, kind, priority, status, result, media_type, error, status_code, attempts,"
+            " created, started, finished, expires FROM jobs WHERE id = ? AND (expires IS NULL OR expires > ?)",
+            (job_id, time.time()),
+        ).fetchone()
+        if row is None:
+            raise JobNotFound(job_id)
+        (job_id, kind, job_priority, status, result, media_type, error, status_code, attempts,
+         created, started, finished, expires) = row
+        position = None
+        if status == "queued":
+            # Jobs that will run before this one
+            position = db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND (priority < ? OR (priority = ? AND created < ?))",
+                (job_priority, job_priority, created),
+            ).fetchone()[0]
+
+    job = {
+        "job_id": job_id,
+        "kind": kind,
+        "status": status,
+        "priority": job_priority,
+        "attempts": attempts,
+        "created": created,
+        "started": started,
+        "finished": finished,
+        "expires": expires,
+    }
+    if position is not None:
+        job["queue_position"] = position
+    if status == "done":
+        job["media_type"] = media_type
+        if media_type is None:
+            job["result"] = json.loads(result)
+    if status == "failed":
+        job["error"] = error
+        job["status_code"] = status_code
+    return job
+
+
+def result_file(job_id: str):
+    """Returns (path, media_type) of a finished job's bytes result, or None if it has none."""
+    job = get_job(job_id)
+    if job["status"] != "done" or job["media_type"] is None:
+        return None
+    return _result_path(job_id), job["media_type"]
+
+
+def _claim():
+    """Takes the next job off the queue for this process, or returns None when there is none."""
+    now = time.time()
+    with _db_lock:
+        db = _connection()
+        # A job whose worker died too often is given up on instead of being retried forever
+        db.execute(
+            "UPDATE jobs SET status = 'failed', error = 'The worker stopped while running the job',"
+            " status_code = 500, finished = ?, expires = ?"
+            " WHERE status = 'running' AND lease_expires < ? AND attempts >= ?",
+            (now, now + JOB_RESULT_TTL_SECONDS, now, JOB_MAX_ATTEMPTS),
+        )
+        row = db.execute(
+            "UPDATE jobs SET status = 'running', worker = ?, started = ?, lease_expires = ?, attempts = attempts + 1"
+            " WHERE id = (SELECT id FROM jobs WHERE status = 'queued' OR (status = 'running' AND lease_expires < ?)"
+            " ORDER BY priority, created LIMIT 1)"
+            " RETURNING id, kind, payload, created",
+            (WORKER_ID, now, now + JOB_LEASE_SECONDS, now),
+        ).fetchone()
+        db.commit()
+    return row
+
+
+def _finish(job_id: str, status: str, result: str = None, media_type: str = None, error: str = None, status_code: int = None):
+    now = time.time()
+    with _db_lock:
+        db = _connection()
+        db.execute(
+            "UPDATE jobs SET status = ?, result = ?, media_type = ?, error = ?, status_code = ?,"
+            " finished = ?, expires = ?, lease_expires = NULL WHERE id = ? AND worker = ?",
+            (status, result, media_type, error, status_code, now, now + JOB_RESULT_TTL_SECONDS, job_id, WORKER_ID),
+        )
+        db.commit()
+
+
+def _renew_leases(ids: list):
+    with _db_lock:
+        db = _connection()
+        db.execute(
+            f"UPDATE jobs SET lease_expires = ? WHERE worker = ? AND id IN ({', '.join('?' * len(ids))})",
+            [time.time() + JOB_LEASE_SECONDS, WORKER_ID, *ids],
+        )
+        db.commit()
+
+
+def purge_expired():
+    """Deletes finished jobs whose results have expired, with their result files."""
+    with _db_lock:
+        db = _connection()
+        expired = db.execute(
+            "DELETE FROM jobs WHERE expires IS NOT NULL AND expires <= ? RETURNING id, media_type", (time.time(),)
+        ).fetchall()
+        db.commit()
+    for job_id, media_type in expired:
+        if media_type is not None:
+            try:
+                os.remove(_result_path(job_id))
+            except FileNotFoundError:
+                pass
+
+
+def _write_result(job_id: str, result: bytes):
+    path = _result_path(job_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(result)
+    os.replace(tmp_path, path)
+
+
+async def _run(job_id: str, kind: str, payload: str, created: float):
+    started = time.time()
+    metrics.job_seconds.observe(kind, "wait", value=started - created)
+    _running.add(job_id)
+    try:
+        handler, media_type = _handlers[kind]
+        async with endpoint_limit(kind):
+            result = await handler(json.loads(payload))
+        if media_type is not None:
+            await run_blocking(_write_result, job_id, result)
+            await run_blocking(_finish, job_id, "done", media_type=media_type)
+        else:
+            await run_blocking(_finish, job_id, "done", result=json.dumps(result, ensure_ascii=False))
+    except asyncio.CancelledError:
+        # Shutting down: the lease runs out and the job is picked up again
+        raise
+    except Exception as e:
+        metrics.record_error(e, endpoint=kind)
+        await run_blocking(_finish, job_id, "failed", error=str(e), status_code=_error_status(e) if _error_status else 500)
+    finally:
+        _running.discard(job_id)
+        metrics.job_seconds.observe(kind, "run", value=time.time() - started)
+
+
+async def _worker():
+    global _last_purge
+    while not _draining:
+        if time.time() - _last_purge > 60:
+            _last_purge = time.time()
+            await run_blocking(purge_expired)
+        job = await run_blocking(_claim)
+        if job is None:
+            try:
+                await asyncio.wait_for(_wakeup.wait(), JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            _wakeup.clear()
+            continue
+        await _run(*job)
+
+
+async def _heartbeat():
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        if _running:
+            await run_blocking(_renew_leases, list(_running))
+
+
+async def start(workers: int = JOB_WORKERS, error_status=None):
+    """
+    Starts the worker pool and lease heartbeat on the running event loop.
+
+    Args:
+        workers (int): Number of jobs run at once by this process.
+        error_status: Optional function mapping a job's exception to the HTTP status
+            reported to pollers (500 by default).
+    """
+    global _wakeup, _error_status
+    _wakeup = asyncio.Event()
+    _error_status = error_status
+    _workers.append(asyncio.ensure_future(_heartbeat()))
+    _workers.extend(asyncio.ensure_future(_worker()) for _ in range(workers))
+
+
+async def stop(drain_seconds: float = 0):
+    """
+    Stops the workers. No new jobs are taken, and running jobs get up to
+    drain_seconds to finish. Jobs still running then are cancelled and keep their
+    lease, so they are run again once it expires.
+    """
+    global _draining
+    _draining = True
+    if _wakeup is not None:
+        _wakeup.set()
+    deadline = time.monotonic() + drain_seconds
+    while _running and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    _draining = False
+
+
+def all_stats() -> dict:
+    """Returns job counts by kind and status, and the wait time of the oldest queued job."""
+    now = time.time()
+    with _db_lock:
+        db = _connection()
+        rows = db.execute(
+            "SELECT kind, status, COUNT(*), MIN(created) FROM jobs WHERE expires IS NULL OR expires > ? GROUP BY kind, status",
+            (now,),
+        ).fetchall()
+    stats = {}
+    for kind, status, count, oldest in rows:
+        kind_stats = stats.setdefault(kind, dict.fromkeys(STATUSES, 0))
+        kind_stats[status] = count
+        if status == "queued":
+            kind_stats["oldest_queued_seconds"] = round(now - oldest, 3)
+    return stats
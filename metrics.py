@@ -0,0 +1,319 @@
+"""
+Prometheus metrics for the API, served in the text exposition format at /metrics.
+
+HTTP metrics (request counts by status, in-flight requests, duration, request and
+response sizes) are collected by MetricsMiddleware and labelled by route. Model calls record a per-stage latency breakdown in
+`hacksync_stage_seconds`, labelled by endpoint, backend ("provider:model") and stage:
+
+* prompt    - rendering the prompt template
+* upstream  - the provider call, including retries (see providers.LazyChatModel)
+* ttft      - time to the first streamed chunk
+* parse     - JSON output parsing (on streams, only the time spent in the parser)
+* serialize - rendering the JSON response (labelled with the route and no backend)
+
+Upstream and ttft are labelled with the backend that handled the call, so a routed
+chain's fallbacks show up separately; prompt and parse carry the chain's preferred
+backend. Model call errors in `hacksync_errors_total` carry the backend as well.
+
+Cache, resilience (including rate limiter wait time), routing, JSON parse outcome,
+retrieval, job queue, compression and token counters are exported alongside.
+
+Metrics are plain dictionaries updated under a lock, so leaving them on costs a few
+microseconds per observation.
+"""
+import threading
+import time
+from contextvars import ContextVar
+
+from langchain_core.runnables import Runnable
+from starlette.routing import Match
+
+import tokens
+from transport import FastJSONResponse
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# Route template of the request being handled
+current_route = ContextVar("current_route", default="unmatched")
+
+
+class Metric:
+    """A labelled counter, gauge or histogram."""
+
+    def __init__(self, name: str, kind: str, help: str, labels: tuple, buckets: tuple = None):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values):
+        self.inc(*label_values, amount=-1)
+
+    def observe(self, *label_values, value: float):
+        with self._lock:
+            if label_values not in self.values:
+                self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            counts, _, _ = entry = self.values[label_values]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> list:
+        with self._lock:
+            items = [(key, value if self.kind != "histogram" else [list(value[0]), value[1], value[2]])
+                     for key, value in self.values.items()]
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in items:
+            labels = _labels(self.labels, key)
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{{{labels}}} {value}")
+                continue
+            counts, total, count = value
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{{{_join(labels, _le(bound))}}} {bucket_count}")
+            lines.append(f"{self.name}_bucket{{{_join(labels, _le('+Inf'))}}} {count}")
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+def _le(bound) -> str:
+    return f'le="{bound}"'
+
+
+def _join(*parts) -> str:
+    return ",".join(part for part in parts if part)
+
+
+requests_total = Metric("hacksync_requests_total", "counter", "HTTP requests by route, method and status.", ("route", "method", "status"))
+requests_in_flight = Metric("hacksync_requests_in_flight", "gauge", "HTTP requests being handled.", ("route",))
+request_seconds = Metric("hacksync_request_duration_seconds", "histogram", "HTTP request duration until the response is fully sent.", ("route",), LATENCY_BUCKETS)
+request_bytes = Metric("hacksync_request_bytes", "histogram", "HTTP request body size.", ("route",), SIZE_BUCKETS)
+response_bytes = Metric("hacksync_response_bytes", "histogram", "HTTP response body size.", ("route",), SIZE_BUCKETS)
+errors_total = Metric("hacksync_errors_total", "counter", "Failed requests and model calls by endpoint, backend and error class.", ("endpoint", "backend", "error_class"))
+stage_seconds = Metric("hacksync_stage_seconds", "histogram", "Time spent per stage of a model call.", ("endpoint", "backend", "stage"), LATENCY_BUCKETS)
+job_seconds = Metric("hacksync_job_seconds", "histogram", "Background job time queued (wait) and running (run).", ("kind", "phase"), LATENCY_BUCKETS + (300, 600, 1800))
+pipeline_node_seconds = Metric("hacksync_pipeline_node_seconds", "histogram", "Time to run one node of a book pipeline, by node kind.", ("node",), LATENCY_BUCKETS + (300, 600))
+
+_metrics = [requests_total, requests_in_flight, request_seconds, request_bytes, response_bytes, errors_total, stage_seconds, job_seconds, pipeline_node_seconds]
+
+
+def route_of(scope) -> str:
+    """Returns the route template of a request (e.g. /imageGen/{image_id}) to keep label values bounded."""
+    for route in scope["app"].router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", "unmatched")
+    return "unmatched"
+
+
+def observe_stage(stage: str, backend: str, seconds: float):
+    """Records the duration of one stage of a model call under the current endpoint."""
+    stage_seconds.observe(tokens.current_endpoint.get(), backend, stage, value=seconds)
+
+
+def record_error(error: Exception, endpoint: str = None, backend: str = ""):
+    errors_total.inc(endpoint or tokens.current_endpoint.get(), backend, type(error).__name__)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording request counts, in-flight requests, duration and
+    body sizes per route. Written as plain ASGI so streamed responses pass through
+    untouched.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        route = route_of(scope)
+        current_route.set(route)
+        state = {"status": 500, "request_bytes": 0, "response_bytes": 0}
+        requests_in_flight.inc(route)
+
+        async def receive_wrapper():
+            message = await receive()
+            if message["type"] == "http.request":
+                state["request_bytes"] += len(message.get("body", b""))
+            return message
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                state["response_bytes"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            requests_in_flight.dec(route)
+            requests_total.inc(route, scope["method"], state["status"])
+            request_seconds.observe(route, value=time.perf_counter() - start)
+            request_bytes.observe(route, value=state["request_bytes"])
+            response_bytes.observe(route, value=state["response_bytes"])
+
+
+class TimedJSONResponse(FastJSONResponse):
+    """JSON response that records serialization time as the "serialize" stage of its route."""
+
+    def render(self, content) -> bytes:
+        start = time.perf_counter()
+        body = super().render(content)
+        stage_seconds.observe(current_route.get(), "", "serialize", value=time.perf_counter() - start)
+        return body
+
+
+class Timed(Runnable):
+    """
+    Wraps a prompt or parser so its invocations are recorded as a stage.
+
+    Streams pass through: for a parser, only the time spent inside the parser is
+    counted, not the time waiting for model chunks or for the consumer.
+    """
+
+    def __init__(self, stage: str, inner: Runnable, backend: str):
+        self.stage = stage
+        self.inner = inner
+        self.backend = backend
+
+    def invoke(self, input, config=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.inner.invoke(input, config, **kwargs)
+        finally:
+            observe_stage(self.stage, self.backend, time.perf_counter() - start)
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await self.inner.ainvoke(input, config, **kwargs)
+        finally:
+            observe_stage(self.stage, self.backend, time.perf_counter() - start)
+
+    def transform(self, input, config=None, **kwargs):
+        yield from self.inner.transform(input, config, **kwargs)
+
+    async def atransform(self, input, config=None, **kwargs):
+        excluded = 0.0
+
+        async def tracked():
+            nonlocal excluded
+            iterator = input.__aiter__()
+            while True:
+                waiting = time.perf_counter()
+                try:
+                    item = await iterator.__anext__()
+                except StopAsyncIteration:
+                    return
+                finally:
+                    excluded += time.perf_counter() - waiting
+                yield item
+
+        start = time.perf_counter()
+        async for output in self.inner.atransform(tracked(), config, **kwargs):
+            paused = time.perf_counter()
+            yield output
+            excluded += time.perf_counter() - paused
+        observe_stage(self.stage, self.backend, time.perf_counter() - start - excluded)
+
+
+def timed_chain(prompt, llm, parser):
+    """Builds `prompt | llm | parser` with prompt rendering and parsing recorded as stages."""
+    backend = getattr(llm, "backend", "")
+    return Timed("prompt", prompt, backend) | llm | Timed("parse", parser, backend)
+
+
+def _collected() -> list:
+    """Metrics of the other modules' counters, gathered at scrape time."""
+    import cache
+    import jobs
+    import parsers
+    import resilience
+    import retrieval
+    import router
+    import transport
+
+    from brainStorming import semantic_cache
+
+    semantic = semantic_cache.snapshot()
+    lines = ["# TYPE hacksync_cache_events_total counter"]
+    for name, stats in dict(cache.all_stats(), brainstorming_semantic={"hits": semantic["hits"], "misses": semantic["misses"]}).items():
+        for event, value in stats.items():
+            lines.append(f'hacksync_cache_events_total{{{_labels(("cache", "event"), (name, event))}}} {value}')
+
+    lines.append("# TYPE hacksync_provider_events_total counter")
+    wait_lines = ["# TYPE hacksync_provider_limiter_wait_seconds_total counter"]
+    breaker_lines = ["# TYPE hacksync_provider_breaker_open gauge"]
+    for provider, stats in resilience.all_stats().items():
+        for event in ("calls", "failures", "retries", "rejected"):
+            lines.append(f'hacksync_provider_events_total{{{_labels(("provider", "event"), (provider, event))}}} {stats[event]}')
+        wait_lines.append(f'hacksync_provider_limiter_wait_seconds_total{{provider="{_escape(provider)}"}} {stats["limiter_wait_seconds"]}')
+        breaker_lines.append(f'hacksync_provider_breaker_open{{provider="{_escape(provider)}"}} {int(stats["breaker_state"] != "closed")}')
+    lines += wait_lines + breaker_lines
+
+    lines.append("# TYPE hacksync_backend_error_rate gauge")
+    for backend, stats in router.all_stats().items():
+        lines.append(f'hacksync_backend_error_rate{{backend="{_escape(backend)}"}} {stats["error_rate"]}')
+
+    lines.append("# TYPE hacksync_parse_outcomes_total counter")
+    for outcome, value in dict(parsers.stats).items():
+        lines.append(f'hacksync_parse_outcomes_total{{outcome="{outcome}"}} {value}')
+
+    lines.append("# TYPE hacksync_retrieval_total counter")
+    for name, value in dict(retrieval.stats).items():
+        lines.append(f'hacksync_retrieval_total{{counter="{name}"}} {value}')
+
+    lines.append("# TYPE hacksync_jobs gauge")
+    for kind, stats in jobs.all_stats().items():
+        for status in jobs.STATUSES:
+            lines.append(f'hacksync_jobs{{{_labels(("kind", "status"), (kind, status))}}} {stats[status]}')
+
+    lines.append("# TYPE hacksync_transport_total counter")
+    for name, value in transport.all_stats().items():
+        if not name.endswith("_ratio"):
+            lines.append(f'hacksync_transport_total{{counter="{name}"}} {value}')
+
+    lines.append("# TYPE hacksync_tokens histogram")
+    for endpoint, models in tokens.all_stats().items():
+        for model, directions in models.items():
+            for direction, histogram in directions.items():
+                labels = _labels(("endpoint", "model", "direction"), (endpoint, model, direction))
+                for bound, count in histogram["buckets"].items():
+                    lines.append(f"hacksync_tokens_bucket{{{_join(labels, _le(bound))}}} {count}")
+                lines.append(f"hacksync_tokens_bucket{{{_join(labels, _le('+Inf'))}}} {histogram['count']}")
+                lines.append(f"hacksync_tokens_sum{{{labels}}} {histogram['sum']}")
+                lines.append(f"hacksync_tokens_count{{{labels}}} {histogram['count']}")
+    return lines
+
+
+def render_metrics() -> str:
+    """Returns every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in _metrics:
+        lines += metric.render()
+    lines += _collected()
+    return "\n".join(lines) + "\n"
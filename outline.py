@@ -1,28 +1,20 @@
-from langchain_google_genai import ChatGoogleGenerativeAI
-from dotenv import load_dotenv
-from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.prompts import PromptTemplate
 from langchain_core.pydantic_v1 import BaseModel, Field
-import os
 
-# Load environment variables
-load_dotenv()
+from router import routed_model
+from metrics import timed_chain
+from parsers import TolerantJsonOutputParser
+from cache import acached_invoke, get_cache
 
-# Get API Key
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-
-# Initialize LLM
-llm = ChatGoogleGenerativeAI(
-    model="gemini-2.0-pro-exp-02-05",
-    temperature=1,
-)
+# Initialize LLM (the shared Gemini client is created on first use)
+llm = routed_model("gemini", temperature=1)
 
 # Define the Output Schema
 class PlotOutline(BaseModel):
     outline: str = Field(description="Generated plot outline")
 
 # Create JSON Output Parser
-parser = JsonOutputParser(pydantic_object=PlotOutline)
+parser = TolerantJsonOutputParser(pydantic_object=PlotOutline)
 
 # Define Prompt Template
 outline_prompt_template = """
@@ -40,6 +32,7 @@ The output must be in JSON format as follows:
         "Plot point 3"
     ]
 }}
+```
 """
 
 # Create Prompt
@@ -52,7 +45,10 @@ outline_prompt = PromptTemplate(
 
 
 # Create Chain
-outline_chain = outline_prompt | llm | parser
+outline_chain = timed_chain(outline_prompt, llm, parser)
+
+# Response cache keyed on model, temperature and rendered prompt
+outline_cache = get_cache("outline")
 
 # Function to Generate Plot Outline
 def generate_plot_outline(user_premise, user_genre):
@@ -74,3 +70,16 @@ def generate_plot_outline(user_premise, user_genre):
     # Invoke the chain and get the response
     response = outline_chain.invoke(input_data)
     return response
+
+async def agenerate_plot_outline(user_premise, user_genre, use_cache=True):
+    """
+    Async version of generate_plot_outline that awaits the model call.
+    Identical requests are served from the response cache unless use_cache is False.
+    """
+    input_data = {
+        "userPremise": user_premise,
+        "userGenre": user_genre
+    }
+
+    response = await acached_invoke(outline_cache, outline_prompt, llm, parser, input_data, use_cache)
+    return response
@@ -0,0 +1,241 @@
+"""
+Fault-tolerant JSON output parsing for the chains.
+
+LangChain's JsonOutputParser gives up on output that is almost right, or worse,
+silently truncates it: an unescaped quote inside a long `chapter_text` ends the
+string early and the rest of the chapter is dropped. TolerantJsonOutputParser
+repairs the common defects instead:
+
+* Markdown fences, including an unterminated one, and prose around the object
+* unescaped quotes inside strings. A quote only ends a string when what follows
+  it is valid JSON structure.
+* raw newlines, tabs and other control characters inside strings
+* trailing commas
+* output cut off mid-way. Open strings, arrays and objects are closed.
+
+Only if the repaired text still does not parse, a small model is asked to fix
+the JSON (FIX_JSON_MODEL). The same repair is used for partial parses while
+streaming.
+"""
+import functools
+import json
+import os
+import re
+import threading
+
+from langchain_core.exceptions import OutputParserException
+from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.prompts import PromptTemplate
+from langchain_core.runnables.config import run_in_executor
+
+# Model used to fix output the repairs cannot handle
+FIX_JSON_MODEL = os.getenv("FIX_JSON_MODEL", "gemini-2.0-flash")
+FIX_JSON_ENABLED = os.getenv("FIX_JSON_ENABLED", "1") == "1"
+
+# Parse outcomes: "clean" (valid as returned), "repaired", "llm_fixed", "failed"
+stats = {"clean": 0, "repaired": 0, "llm_fixed": 0, "failed": 0}
+_stats_lock = threading.Lock()
+
+# Inside a string, everything up to the next quote, backslash or control character is copied as is
+STRING_RUN = re.compile(r'[^"\\\x00-\x1f]+')
+CONTROL_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t"}
+VALID_ESCAPES = set('"\\/bfnrtu')
+# A key (and its colon) left at the end of a cut-off object
+DANGLING_KEY = re.compile(r'(?:,|(?<=\{))\s*"(?:[^"\\]|\\.)*"\s*:?\s*$')
+
+fix_json_prompt = PromptTemplate.from_template("""
+TASK: The text below was meant to be a single JSON object but is not valid JSON.
+Return the same content as valid JSON: escape quotes and newlines inside strings, close what is left open
+and remove anything that is not part of the object. Do not change, shorten or summarize any values.
+Output only the JSON object.
+
+TEXT:
+{text}
+""")
+
+
+def _count(outcome: str):
+    with _stats_lock:
+        stats[outcome] += 1
+
+
+def extract_json_text(text: str) -> str:
+    """Returns the part of text that should hold the JSON: from the first { or [ to the end of its fence."""
+    fence = re.search(r"```(?:json)?", text)
+    if fence:
+        closing = text.find("```", fence.end())
+        text = text[fence.end():] if closing == -1 else text[fence.end():closing]
+    starts = [index for index in (text.find("{"), text.find("[")) if index != -1]
+    return text[min(starts):].strip() if starts else text.strip()
+
+
+def _next_significant(text: str, index: int):
+    """Returns (char, position) of the next non-whitespace character at or after index."""
+    length = len(text)
+    while index < length and text[index] in " \t\r\n":
+        index += 1
+    return (text[index], index) if index < length else ("", length)
+
+
+def _ends_string(text: str, index: int, stack: list, is_key: bool) -> bool:
+    """Whether the quote at text[index] closes the current string, judging by what follows it."""
+    char, position = _next_significant(text, index + 1)
+    if char == "":
+        return True
+    if char == ":":
+        return is_key
+    if char in "}]":
+        return bool(stack) and stack[-1] == char
+    if char == ",":
+        # After a comma comes the next key or value, or (a trailing comma) the closing bracket
+        following, _ = _next_significant(text, position + 1)
+        if following in ('"', "") or (stack and following == stack[-1]):
+            return True
+        return bool(stack) and stack[-1] == "]" and (following in "{[-tfn" or following.isdigit())
+    return False
+
+
+def repair_json(text: str) -> str:
+    """
+    Rewrites almost-JSON into valid JSON: escapes stray quotes and control characters
+    in strings, drops trailing commas, and closes whatever is left open at the end.
+    """
+    out = []
+    stack = []
+    in_string = False
+    is_key = False
+    index = 0
+    length = len(text)
+
+    while index < length:
+        char = text[index]
+        if in_string:
+            run = STRING_RUN.match(text, index)
+            if run:
+                out.append(run.group())
+                index = run.end()
+                continue
+            if char == "\\":
+                if index + 1 == length or text[index + 1] not in VALID_ESCAPES:
+                    # An invalid escape such as \' is read as the character alone
+                    index += 1
+                    continue
+                out.append(text[index:index + 2])
+                index += 2
+                continue
+            if char == '"':
+                if _ends_string(text, index, stack, is_key):
+                    in_string = False
+                    out.append('"')
+                else:
+                    out.append('\\"')
+                index += 1
+                continue
+            out.append(CONTROL_ESCAPES.get(char, f"\\u{ord(char):04x}"))
+            index += 1
+            continue
+
+        if char == '"':
+            in_string = True
+            # A string directly inside an object, before its colon, is a key
+            previous = next((c for c in reversed(out) if c.strip()), "")
+            is_key = bool(stack) and stack[-1] == "}" and previous in ("{", ",")
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]":
+            if not stack or stack[-1] != char:
+                index += 1
+                continue
+            stack.pop()
+            # Drop a trailing comma before the closing bracket
+            while out and out[-1].strip() == "":
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+        out.append(char)
+        index += 1
+        if not stack and not in_string and char in "}]":
+            break
+
+    if in_string:
+        out.append('"')
+    repaired = "".join(out).rstrip()
+    if stack:
+        # Output was cut off: drop a dangling key or comma, then close what is open
+        if stack[-1] == "}":
+            repaired = DANGLING_KEY.sub("", repaired)
+        repaired = repaired.rstrip().rstrip(",")
+    return repaired + "".join(reversed(stack))
+
+
+def parse_json(text: str):
+    """
+    Parses model output as JSON, repairing it if needed.
+
+    Returns:
+        tuple: (value, outcome) where outcome is "clean" or "repaired".
+
+    Raises:
+        ValueError: When the output cannot be repaired into JSON.
+    """
+    candidate = extract_json_text(text)
+    try:
+        return json.loads(candidate), "clean"
+    except ValueError:
+        pass
+    return json.loads(repair_json(candidate)), "repaired"
+
+
+class TolerantJsonOutputParser(JsonOutputParser):
+    """
+    JsonOutputParser that repairs malformed output (see module docstring) and, as a
+    last resort, asks FIX_JSON_MODEL to fix it. Partial parses while streaming use
+    the same repairs, so an unescaped quote does not cut the streamed text short.
+    """
+
+    def _parse_text(self, text: str, partial: bool):
+        try:
+            value, outcome = parse_json(text)
+        except ValueError as e:
+            if partial:
+                return None
+            raise OutputParserException(f"Invalid json output: {text[:200]}", llm_output=text) from e
+        if not partial:
+            _count(outcome)
+        return value
+
+    def parse_result(self, result, *, partial: bool = False):
+        text = result[0].text.strip()
+        try:
+            return self._parse_text(text, partial)
+        except OutputParserException:
+            if not FIX_JSON_ENABLED:
+                _count("failed")
+                raise
+            return self._fixed(text, _fix_model().invoke(fix_json_prompt.format_prompt(text=text)))
+
+    async def aparse_result(self, result, *, partial: bool = False):
+        text = result[0].text.strip()
+        try:
+            return await run_in_executor(None, self._parse_text, text, partial)
+        except OutputParserException:
+            if not FIX_JSON_ENABLED:
+                _count("failed")
+                raise
+            return self._fixed(text, await _fix_model().ainvoke(fix_json_prompt.format_prompt(text=text)))
+
+    def _fixed(self, text: str, message):
+        try:
+            value, _ = parse_json(str(message.content))
+        except ValueError as e:
+            _count("failed")
+            raise OutputParserException(f"Invalid json output: {text[:200]}", llm_output=text) from e
+        _count("llm_fixed")
+        return value
+
+
+@functools.lru_cache(maxsize=None)
+def _fix_model():
+    """Returns the chat model that repairs invalid JSON, created once and shared by every parser."""
+    from providers import chat_model
+    return chat_model("gemini", model=FIX_JSON_MODEL, temperature=0)
@@ -0,0 +1,366 @@
+"""
+Whole-book pipeline: outline, character profiles and chapters as one dependency graph.
+
+Each step of a book is a node that starts as soon as the nodes it depends on are
+done:
+
+    outline ──────────────┬─► chapter:0 ─► chapter:1 ─► ... ─► session
+    character:0 ... :N ───┘
+
+The outline and the character profiles do not depend on each other, so they are
+generated concurrently. Every chapter needs the plot points, all profiles and
+the chapters before it. A final node stores the book in a story session (see
+sessions.py) so follow-up edits can refer to it by ID.
+
+Every finished node is checkpointed in a SQLite table under JOBS_DIR. A pipeline
+runs as a background job (see jobs.py). If its worker dies, the job is taken again
+and the pipeline resumes from the checkpoints. If a node fails, e.g. during a
+provider outage, the nodes already finished are kept, and `resume` starts a new job
+that only runs the missing ones.
+
+Checkpoint reads and writes block on the shared database, so they run in the
+blocking pool; get_pipeline should be called there too.
+"""
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+import jobs
+import metrics
+import sessions
+import store
+from chapter import agenerate_story_chapter, select_story_data
+from character import agenerate_character_profile
+from concurrency import endpoint_limit, run_blocking
+from outline import agenerate_plot_outline
+
+# Most chapters written for one outline
+PIPELINE_MAX_CHAPTERS = int(os.getenv("PIPELINE_MAX_CHAPTERS", "20"))
+# How long a pipeline and its checkpoints are kept after it was last run
+PIPELINE_TTL_SECONDS = float(os.getenv("PIPELINE_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+
+LIST_MARKER = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s*")
+
+_db_lock = threading.Lock()
+_db = None
+
+
+class PipelineNotFound(KeyError):
+    """Raised when a pipeline ID does not exist or has expired."""
+
+
+class PipelineRunning(Exception):
+    """Raised when resuming a pipeline whose job is still queued or running."""
+    status_code = 409
+
+
+def _connection():
+    """Opens the pipeline checkpoint database, shared by all processes, on first use."""
+    global _db
+    if _db is None:
+        _db = store.connect(os.path.join(jobs.JOBS_DIR, "pipelines.sqlite3"))
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS pipelines ("
+            " id TEXT PRIMARY KEY, spec TEXT NOT NULL, job_id TEXT, created REAL NOT NULL, expires REAL NOT NULL)"
+        )
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS nodes ("
+            " pipeline_id TEXT NOT NULL, name TEXT NOT NULL, result TEXT NOT NULL,"
+            " started REAL NOT NULL, finished REAL NOT NULL, PRIMARY KEY (pipeline_id, name))"
+        )
+        _db.commit()
+    return _db
+
+
+def _load_spec(pipeline_id: str) -> tuple:
+    """Returns (spec, job_id) of a pipeline."""
+    with _db_lock:
+        row = _connection().execute(
+            "SELECT spec, job_id FROM pipelines WHERE id = ? AND expires > ?", (pipeline_id, time.time())
+        ).fetchone()
+    if row is None:
+        raise PipelineNotFound(pipeline_id)
+    return json.loads(row[0]), row[1]
+
+
+def _load_checkpoints(pipeline_id: str) -> dict:
+    with _db_lock:
+        rows = _connection().execute(
+            "SELECT name, result FROM nodes WHERE pipeline_id = ?", (pipeline_id,)
+        ).fetchall()
+    return {name: json.loads(result) for name, result in rows}
+
+
+def _checkpoint(pipeline_id: str, name: str, result, started: float):
+    with _db_lock:
+        db = _connection()
+        db.execute(
+            "INSERT OR REPLACE INTO nodes (pipeline_id, name, result, started, finished) VALUES (?, ?, ?, ?, ?)",
+            (pipeline_id, name, json.dumps(result, ensure_ascii=False), started, time.time()),
+        )
+        db.commit()
+
+
+async def run_graph(pipeline_id: str, build) -> dict:
+    """
+    Runs a dependency graph of async steps, checkpointing each result.
+
+    Args:
+        pipeline_id (str): Key of the checkpoints; nodes already checkpointed are not run again.
+        build: Function called with the results so far, returning
+            {name: (dependencies, step)}. It is called again after every node
+            finishes, so nodes can be added once the results they come from exist.
+            A step is an async function called with the results so far.
+
+    Returns:
+        dict: Result of every node, by name.
+
+    Raises:
+        Exception: The error of the first failed node, once the nodes still
+            running have finished and been checkpointed.
+    """
+    done = await run_blocking(_load_checkpoints, pipeline_id)
+    running = {}
+    error = None
+    try:
+        while True:
+            if error is None:
+                for name, (dependencies, step) in build(done).items():
+                    if name not in done and name not in running and all(dependency in done for dependency in dependencies):
+                        running[name] = (asyncio.ensure_future(step(done)), time.time())
+            if not running:
+                break
+            finished, _ = await asyncio.wait([task for task, _ in running.values()], return_when=asyncio.FIRST_COMPLETED)
+            for name, (task, started) in list(running.items()):
+                if task not in finished:
+                    continue
+                del running[name]
+                metrics.pipeline_node_seconds.observe(name.split(":")[0], value=time.time() - started)
+                if task.exception() is not None:
+                    # No new nodes are started, but the running ones may still finish and be kept
+                    error = error or task.exception()
+                    continue
+                await run_blocking(_checkpoint, pipeline_id, name, task.result(), started)
+                done[name] = task.result()
+    finally:
+        # Cancelled (e.g. the worker is stopping): the job runs again later from the checkpoints
+        for task, _ in running.values():
+            task.cancel()
+    if error is not None:
+        raise error
+    return done
+
+
+def plot_points(outline) -> list:
+    """Returns the plot points of an outline response, whether a list or a numbered text."""
+    points = outline.get("outline") if isinstance(outline, dict) else outline
+    if isinstance(points, str):
+        points = [LIST_MARKER.sub("", line) for line in points.splitlines()]
+    return [str(point).strip() for point in points or [] if str(point).strip()][:PIPELINE_MAX_CHAPTERS]
+
+
+def character_text(profiles: list) -> str:
+    """Renders character profiles as character data for the chapter prompts."""
+    entries = []
+    for profile in profiles:
+        traits = ", ".join(str(trait) for trait in profile.get("personality_traits") or [])
+        entries.append(f"{profile.get('name', 'Unnamed')}: {traits}. {profile.get('backstory', '')}".strip())
+    return "\n\n".join(entries)
+
+
+def book_graph(spec: dict):
+    """Returns the `build` function of run_graph for a book spec (see module docstring)."""
+    character_nodes = [f"character:{index}" for index in range(len(spec["characters"]))]
+
+    async def outline(done):
+        async with endpoint_limit("outline"):
+            return await agenerate_plot_outline(spec["user_premise"], spec["user_genre"], use_cache=spec["use_cache"])
+
+    def character(index):
+        async def step(done):
+            async with endpoint_limit("character"):
+                return await agenerate_character_profile(spec["characters"][index], spec["user_genre"], use_cache=spec["use_cache"])
+        return step
+
+    def chapter(index, plot_point):
+        async def step(done):
+            previous = "\n\n\n".join(done[f"chapter:{earlier}"]["chapter_text"] for earlier in range(index))
+            character_data, worldbuilding_data = select_story_data(
+                plot_point, previous, character_text([done[name] for name in character_nodes]), spec["worldbuilding_data"])
+            async with endpoint_limit("chapter"):
+                return await agenerate_story_chapter(
+                    plot_point=plot_point,
+                    previous_chapters=previous,
+                    character_data=character_data,
+                    worldbuilding_data=worldbuilding_data,
+                    user_genre=spec["user_genre"],
+                    user_style=spec["user_style"],
+                    mode=spec["chapter_mode"],
+                )
+        return step
+
+    def session(points):
+        async def step(done):
+            created = await run_blocking(
+                sessions.create_session,
+                chapters=[done[f"chapter:{index}"]["chapter_text"] for index in range(len(points))],
+                character_data=character_text([done[name] for name in character_nodes]),
+                worldbuilding_data=spec["worldbuilding_data"],
+            )
+            return {"session_id": created["id"]}
+        return step
+
+    def build(done):
+        nodes = {"outline": ((), outline)}
+        nodes.update({name: ((), character(index)) for index, name in enumerate(character_nodes)})
+        if "outline" in done:
+            points = plot_points(done["outline"])
+            for index, plot_point in enumerate(points):
+                dependencies = ("outline", *character_nodes) + ((f"chapter:{index - 1}",) if index else ())
+                nodes[f"chapter:{index}"] = (dependencies, chapter(index, plot_point))
+            if spec["create_session"]:
+                nodes["session"] = (tuple(f"chapter:{index}" for index in range(len(points))), session(points))
+        return nodes
+
+    return build
+
+
+async def run_book_job(payload: dict) -> dict:
+    """Job handler: runs (or resumes) a book pipeline and returns the book."""
+    pipeline_id = payload["pipeline_id"]
+    spec, _ = await run_blocking(_load_spec, pipeline_id)
+    done = await run_graph(pipeline_id, book_graph(spec))
+    points = plot_points(done["outline"])
+    return {
+        "pipeline_id": pipeline_id,
+        "outline": points,
+        "characters": [done[f"character:{index}"] for index in range(len(spec["characters"]))],
+        "chapters": [done[f"chapter:{index}"]["chapter_text"] for index in range(len(points))],
+        "session_id": done.get("session", {}).get("session_id"),
+    }
+
+
+async def _submit(pipeline_id: str) -> dict:
+    job = await jobs.submit("book", {"pipeline_id": pipeline_id})
+    await run_blocking(_set_job, pipeline_id, job["job_id"])
+    return job
+
+
+def _set_job(pipeline_id: str, job_id: str):
+    now = time.time()
+    with _db_lock:
+        db = _connection()
+        db.execute(
+            "UPDATE pipelines SET job_id = ?, expires = ? WHERE id = ?",
+            (job_id, now + PIPELINE_TTL_SECONDS, pipeline_id),
+        )
+        db.commit()
+
+
+def purge_expired():
+    """Deletes pipelines that were not run for PIPELINE_TTL_SECONDS, with their checkpoints."""
+    with _db_lock:
+        db = _connection()
+        expired = db.execute("DELETE FROM pipelines WHERE expires <= ? RETURNING id", (time.time(),)).fetchall()
+        db.executemany("DELETE FROM nodes WHERE pipeline_id = ?", expired)
+        db.commit()
+
+
+async def start_book(user_premise: str, user_genre: str, user_style: str, characters: list,
+               worldbuilding_data: str = "", chapter_mode: str = "single", create_session: bool = True,
+               use_cache: bool = True) -> tuple:
+    """
+    Creates a book pipeline and queues its job.
+
+    Args:
+        user_premise (str): The main idea or scenario of the story.
+        user_genre (str): The genre of the story.
+        user_style (str): Style and length preferences for the chapters.
+        characters (list): One description per character to create.
+        worldbuilding_data (str): Information about the story's world, setting, and rules.
+        chapter_mode (str): "single" or "parallel" (see chapter.agenerate_story_chapter).
+        create_session (bool): Store the finished book in a story session.
+        use_cache (bool): Serve the outline and profiles from the response cache when possible.
+
+    Returns:
+        tuple: (pipeline_id, job description).
+    """
+    spec = {
+        "user_premise": user_premise,
+        "user_genre": user_genre,
+        "user_style": user_style,
+        "characters": list(characters),
+        "worldbuilding_data": worldbuilding_data or "",
+        "chapter_mode": chapter_mode,
+        "create_session": create_session,
+        "use_cache": use_cache,
+    }
+    pipeline_id = await run_blocking(_create, spec)
+    return pipeline_id, await _submit(pipeline_id)
+
+
+def _create(spec: dict) -> str:
+    purge_expired()
+    pipeline_id = uuid.uuid4().hex
+    now = time.time()
+    with _db_lock:
+        db = _connection()
+        db.execute(
+            "INSERT INTO pipelines (id, spec, created, expires) VALUES (?, ?, ?, ?)",
+            (pipeline_id, json.dumps(spec, ensure_ascii=False), now, now + PIPELINE_TTL_SECONDS),
+        )
+        db.commit()
+    return pipeline_id
+
+
+async def resume(pipeline_id: str) -> dict:
+    """
+    Queues a new job for a pipeline whose last job failed or expired; finished nodes are reused.
+
+    Raises:
+        PipelineNotFound: When the pipeline does not exist or has expired.
+        PipelineRunning: When its job is still queued or running.
+    """
+    await run_blocking(_check_idle, pipeline_id)
+    return await _submit(pipeline_id)
+
+
+def _check_idle(pipeline_id: str):
+    _, job_id = _load_spec(pipeline_id)
+    try:
+        if jobs.get_job(job_id)["status"] in ("queued", "running"):
+            raise PipelineRunning(f"Pipeline {pipeline_id} is already running as job {job_id}")
+    except jobs.JobNotFound:
+        pass
+
+
+def get_pipeline(pipeline_id: str) -> dict:
+    """
+    Returns a pipeline's progress: its current job and the nodes checkpointed so far,
+    with their timings.
+
+    Raises:
+        PipelineNotFound: When the pipeline does not exist or has expired.
+    """
+    _, job_id = _load_spec(pipeline_id)
+    with _db_lock:
+        rows = _connection().execute(
+            "SELECT name, started, finished FROM nodes WHERE pipeline_id = ? ORDER BY finished", (pipeline_id,)
+        ).fetchall()
+    try:
+        job_status = jobs.get_job(job_id)["status"]
+    except jobs.JobNotFound:
+        job_status = "expired"
+    return {
+        "pipeline_id": pipeline_id,
+        "job_id": job_id,
+        "status": job_status,
+        "completed_nodes": [
+            {"node": name, "seconds": round(finished - started, 3), "finished": finished}
+            for name, started, finished in rows
+        ],
+    }
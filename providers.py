@@ -0,0 +1,253 @@
+"""
+Central registry for model and API clients.
+
+Configuration is loaded from the environment (and `.env`) once, when this module
+is first imported. Clients are only constructed the first time they are used, so
+a worker that never serves /tts/ never imports or builds the ElevenLabs client,
+and every module shares one client (and one HTTP connection pool) per provider.
+"""
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+from langchain_core.runnables import Runnable
+
+import metrics
+import resilience
+import tokens
+
+# Load environment variables once for the whole process
+load_dotenv()
+
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY")
+ELEVEN_LABS_API_KEY = os.getenv("ELEVEN_LABS_API_KEY")
+
+TOGETHER_BASE_URL = "https://api.together.xyz/v1"
+
+# Default models used by the chains
+GEMINI_MODEL = "gemini-2.0-pro-exp-02-05"
+TOGETHER_CHAT_MODEL = "google/gemma-2-27b-it"
+
+# Connection pool size of the shared HTTP clients
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+
+_lock = threading.RLock()
+_clients = {}
+_overrides = {}
+# Every LazyChatModel created by chat_model(), resolved ahead of traffic by warm_up()
+_lazy_models = []
+
+
+def _get_or_create(key, factory):
+    with _lock:
+        if key not in _clients:
+            _clients[key] = factory()
+        return _clients[key]
+
+
+def override(provider: str, client):
+    """
+    Replaces a provider's client, e.g. with one of the stand-ins from fakes.py.
+    Passing None removes the override.
+
+    Providers are "gemini", "together" (chat models), "together_images" and "elevenlabs".
+    """
+    with _lock:
+        if client is None:
+            _overrides.pop(provider, None)
+        else:
+            _overrides[provider] = client
+
+
+def _http_clients():
+    """Returns the (sync, async) httpx clients shared by all Together chat models."""
+    import httpx
+
+    def create():
+        limits = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS)
+        return httpx.Client(limits=limits, timeout=None), httpx.AsyncClient(limits=limits, timeout=None)
+
+    return _get_or_create("together_http", create)
+
+
+def get_chat_model(provider: str, model: str, temperature: float = 1):
+    """
+    Returns the shared chat model for a provider, model and temperature,
+    creating it on first use.
+    """
+    if provider in _overrides:
+        return _overrides[provider]
+
+    def create():
+        if provider == "gemini":
+            from langchain_google_genai import ChatGoogleGenerativeAI
+
+            kwargs = {"google_api_key": GEMINI_API_KEY} if GEMINI_API_KEY else {}
+            # A single attempt per call: retries are handled by the resilience layer
+            return ChatGoogleGenerativeAI(model=model, temperature=temperature, max_retries=1, **kwargs)
+        if provider == "together":
+            from langchain_openai import ChatOpenAI
+
+            http_client, http_async_client = _http_clients()
+            return ChatOpenAI(
+                base_url=TOGETHER_BASE_URL,
+                api_key=TOGETHER_API_KEY,
+                model=model,
+                temperature=temperature,
+                http_client=http_client,
+                http_async_client=http_async_client,
+                max_retries=0,
+            )
+        raise ValueError(f"Unknown chat model provider: {provider}")
+
+    return _get_or_create(("chat", provider, model, temperature), create)
+
+
+def get_together_client():
+    """Returns the shared Together client used for image generation."""
+    if "together_images" in _overrides:
+        return _overrides["together_images"]
+
+    def create():
+        if os.getenv("IMAGE_PROVIDER") == "fake":
+            from fakes import FakeTogether
+            return FakeTogether()
+        from together import Together
+        return Together(api_key=TOGETHER_API_KEY, max_retries=0)
+
+    return _get_or_create("together_images", create)
+
+
+def get_elevenlabs_client():
+    """Returns the shared ElevenLabs client used for text-to-speech."""
+    if "elevenlabs" in _overrides:
+        return _overrides["elevenlabs"]
+
+    def create():
+        if os.getenv("TTS_PROVIDER") == "fake":
+            from fakes import FakeElevenLabs
+            return FakeElevenLabs()
+        from elevenlabs.client import ElevenLabs
+        return ElevenLabs(api_key=ELEVEN_LABS_API_KEY)
+
+    return _get_or_create("elevenlabs", create)
+
+
+class LazyChatModel(Runnable):
+    """
+    Placeholder for a chat model that is only resolved when the chain runs.
+
+    Modules build their `prompt | llm | parser` chains at import time with one of
+    these, so importing a module does not construct any client. `model` and
+    `temperature` are exposed for cache keys. Every call goes through the
+    provider's rate limits, retries and circuit breaker (see resilience.py), and
+    is checked against and recorded in the token accounting (see tokens.py).
+    Upstream time, time to first chunk and error classes go to metrics.py.
+    """
+
+    def __init__(self, provider: str, model: str, temperature: float = 1):
+        self.provider = provider
+        self.model = model
+        self.temperature = temperature
+
+    @property
+    def backend(self) -> str:
+        """Metrics label of this backend."""
+        return f"{self.provider}:{self.model}"
+
+    def resolve(self):
+        return get_chat_model(self.provider, self.model, self.temperature)
+
+    def _record(self, input_tokens: int, output):
+        tokens.record(self.model, "input", input_tokens)
+        tokens.record(self.model, "output", tokens.count_tokens(str(getattr(output, "content", output))))
+
+    def invoke(self, input, config=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            input_tokens = tokens.check_prompt(input)
+            model = self.resolve()
+            result = resilience.call_blocking(
+                self.provider, lambda: model.invoke(input, config, **kwargs), input_tokens
+            )
+        except Exception as e:
+            metrics.record_error(e, backend=self.backend)
+            raise
+        metrics.observe_stage("upstream", self.backend, time.perf_counter() - start)
+        self._record(input_tokens, result)
+        return result
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            input_tokens = tokens.check_prompt(input)
+            model = self.resolve()
+            result = await resilience.acall(
+                self.provider, lambda: model.ainvoke(input, config, **kwargs), input_tokens
+            )
+        except Exception as e:
+            metrics.record_error(e, backend=self.backend)
+            raise
+        metrics.observe_stage("upstream", self.backend, time.perf_counter() - start)
+        self._record(input_tokens, result)
+        return result
+
+    def stream(self, input, config=None, **kwargs):
+        yield from self.resolve().stream(input, config, **kwargs)
+
+    async def astream(self, input, config=None, **kwargs):
+        started = time.perf_counter()
+
+        async def start():
+            # Retries are only possible until the first chunk has been handed on
+            stream = model.astream(input, config, **kwargs)
+            try:
+                return stream, await stream.__anext__()
+            except StopAsyncIteration:
+                return None, None
+
+        try:
+            input_tokens = tokens.check_prompt(input)
+            model = self.resolve()
+            stream, first = await resilience.acall(self.provider, start, input_tokens)
+            if stream is None:
+                return
+            metrics.observe_stage("ttft", self.backend, time.perf_counter() - started)
+            output = [str(first.content)]
+            yield first
+            async for chunk in stream:
+                output.append(str(chunk.content))
+                yield chunk
+        except Exception as e:
+            metrics.record_error(e, backend=self.backend)
+            raise
+        metrics.observe_stage("upstream", self.backend, time.perf_counter() - started)
+        self._record(input_tokens, "".join(output))
+
+
+def chat_model(provider: str = "gemini", model: str = None, temperature: float = 1) -> LazyChatModel:
+    """Returns a lazily resolved chat model for use in a module-level chain."""
+    if model is None:
+        model = GEMINI_MODEL if provider == "gemini" else TOGETHER_CHAT_MODEL
+    lazy = LazyChatModel(provider, model, temperature)
+    _lazy_models.append(lazy)
+    return lazy
+
+
+def warm_up() -> list:
+    """
+    Constructs the clients of every chat model the chains use, so the first request
+    does not pay for importing and building them.
+
+    Returns:
+        list: "provider/model: error" for each client that could not be built.
+    """
+    errors = []
+    for lazy in list(_lazy_models):
+        try:
+            lazy.resolve()
+        except Exception as e:
+            errors.append(f"{lazy.provider}/{lazy.model}: {e}")
+    return errors
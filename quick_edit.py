@@ -1,28 +1,23 @@
-from langchain_google_genai import ChatGoogleGenerativeAI
-from dotenv import load_dotenv
-from langchain_core.output_parsers import JsonOutputParser
-from langchain_core.prompts import PromptTemplate
-from langchain_core.pydantic_v1 import BaseModel, Field
+import math
 import os
+import re
 
-# Load environment variables
-load_dotenv()
+from langchain_core.prompts import PromptTemplate
+from langchain_core.pydantic_v1 import BaseModel, Field
 
-# Get GEMINI API Key
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+from router import routed_model
+from metrics import timed_chain
+from parsers import TolerantJsonOutputParser
 
-# Initialize LLM with Google Generative AI
-llm = ChatGoogleGenerativeAI(
-    model="gemini-2.0-pro-exp-02-05",
-    temperature=1
-)
+# Initialize LLM (the shared Gemini client is created on first use)
+llm = routed_model("gemini", temperature=1)
 
 # Define Output Schema
 class EditedText(BaseModel):
     edited_text: str = Field(description="The edited version of the story text")
 
 # Create Output Parser
-parser = JsonOutputParser(pydantic_object=EditedText)
+parser = TolerantJsonOutputParser(pydantic_object=EditedText)
 
 # Define Quick Edit Prompt Template
 quick_edit_prompt_template = """
@@ -59,7 +54,7 @@ quick_edit_prompt = PromptTemplate(
 )
 
 # Combine Prompt, LLM, and Parser into a Chain
-quick_edit_chain = quick_edit_prompt | llm | parser
+quick_edit_chain = timed_chain(quick_edit_prompt, llm, parser)
 
 # Function to Perform Quick Edit
 def perform_quick_edit(user_request: str, document_text: str, character_data: str, worldbuilding_data: str, user_genre: str) -> dict:
@@ -90,3 +85,243 @@ def perform_quick_edit(user_request: str, document_text: str, character_data: st
     
     # Return the edited story text in JSON format
     return response
+
+async def aperform_quick_edit(user_request: str, document_text: str, character_data: str, worldbuilding_data: str, user_genre: str) -> dict:
+    """
+    Async version of perform_quick_edit that awaits the model call. Character and
+    worldbuilding data are sent as given; callers narrow them to the entries relevant
+    to the request and document with retrieval.select_story_data.
+    """
+    input_data = {
+        "userRequest": user_request,
+        "documentText": document_text,
+        "characterData": character_data,
+        "worldbuildingData": worldbuilding_data,
+        "userGenre": user_genre
+    }
+
+    response = await quick_edit_chain.ainvoke(input_data)
+    return response
+
+# Patch mode: only the paragraphs most relevant to the request are sent in full
+# (up to QUICK_EDIT_CONTEXT_WORDS), and the model returns paragraph replacements
+QUICK_EDIT_CONTEXT_WORDS = int(os.getenv("QUICK_EDIT_CONTEXT_WORDS", "1500"))
+QUICK_EDIT_PREVIEW_WORDS = 12
+
+# Define Output Schema for Patch Mode
+class ParagraphEdits(BaseModel):
+    edits: list = Field(description="Paragraph replacements, each with id, anchor and text")
+
+patch_parser = TolerantJsonOutputParser(pydantic_object=ParagraphEdits)
+
+quick_edit_patch_prompt_template = """
+    TASK: Perform a quick edit on a story based on the user's specific request.
+    The story is split into numbered paragraphs. Paragraphs marked [FULL] are given in full; the others only
+    show their first words, for orientation, and must not be edited.
+    Consider the overall story context, characters, worldbuilding, and genre to ensure the edit is consistent and appropriate.
+    Fulfill the user's request concisely and effectively, changing as few paragraphs as possible.
+
+    Return only the paragraphs you change. For each one give its id, the first five words of the original
+    paragraph as "anchor", and its complete new text. Use an empty text to delete a paragraph, and separate
+    paragraphs with a blank line to split one or to insert new ones after it.
+    Output the result in JSON format as follows:
+
+    ```json
+    {{
+        "edits": [
+            {{"id": "P3", "anchor": "First five words of P3", "text": "New text of paragraph P3"}}
+        ]
+    }}
+    ```
+
+    USER REQUEST: {userRequest}
+
+    STORY PARAGRAPHS:
+    {paragraphs}
+
+    CHARACTERS (for context):
+    {characterData}
+
+    WORLDBUILDING (for context):
+    {worldbuildingData}
+
+    GENRE (for context):
+    {userGenre}
+"""
+
+quick_edit_patch_prompt = PromptTemplate(
+    input_variables=["userRequest", "paragraphs", "characterData", "worldbuildingData", "userGenre"],
+    template=quick_edit_patch_prompt_template,
+)
+
+quick_edit_patch_chain = timed_chain(quick_edit_patch_prompt, llm, patch_parser)
+
+PARAGRAPH_BREAK = re.compile(r"(\n[ \t]*\n\s*)")
+STOPWORDS = {
+    "the", "and", "for", "that", "this", "with", "from", "into", "make", "more", "less", "change",
+    "rewrite", "edit", "please", "should", "would", "could", "about", "them", "their", "they", "was", "are",
+}
+
+def split_document(document_text: str) -> tuple:
+    """
+    Splits a document into paragraphs, keeping the separators so unchanged text is
+    returned byte for byte.
+
+    Returns:
+        tuple: (pieces, paragraph_ids) where pieces alternates paragraph text and
+        separators, and paragraph_ids maps "P1", "P2", ... to indexes into pieces.
+    """
+    pieces = PARAGRAPH_BREAK.split(document_text)
+    paragraph_ids = {}
+    for index in range(0, len(pieces), 2):
+        if pieces[index].strip():
+            paragraph_ids[f"P{len(paragraph_ids) + 1}"] = index
+    return pieces, paragraph_ids
+
+def words_of(text: str) -> set:
+    return {word for word in re.findall(r"\w+", text.lower()) if len(word) > 2 and word not in STOPWORDS}
+
+def select_relevant(user_request: str, paragraphs: dict) -> set:
+    """
+    Returns the ids of the paragraphs to send in full: the ones sharing the most
+    (IDF-weighted) words with the request, up to QUICK_EDIT_CONTEXT_WORDS words.
+    Short documents, and documents sharing no words with the request (e.g. "make
+    the tone darker", which applies everywhere), are sent in full.
+    """
+    sizes = {pid: len(text.split()) for pid, text in paragraphs.items()}
+    if sum(sizes.values()) <= QUICK_EDIT_CONTEXT_WORDS:
+        return set(paragraphs)
+
+    request_words = words_of(user_request)
+    paragraph_words = {pid: words_of(text) for pid, text in paragraphs.items()}
+    document_frequency = {word: sum(word in words for words in paragraph_words.values()) for word in request_words}
+
+    def score(pid):
+        return sum(
+            math.log(1 + len(paragraphs) / document_frequency[word])
+            for word in request_words & paragraph_words[pid]
+        )
+
+    ranked = sorted(paragraphs, key=score, reverse=True)
+    if score(ranked[0]) == 0:
+        return set(paragraphs)
+    selected, used = set(), 0
+    for pid in ranked:
+        if selected and (score(pid) == 0 or used + sizes[pid] > QUICK_EDIT_CONTEXT_WORDS):
+            break
+        selected.add(pid)
+        used += sizes[pid]
+    return selected
+
+def render_paragraphs(paragraphs: dict, full_ids: set) -> str:
+    lines = []
+    for pid, text in paragraphs.items():
+        if pid in full_ids:
+            lines.append(f"[{pid}] [FULL]\n{text.strip()}")
+        else:
+            preview = " ".join(text.split()[:QUICK_EDIT_PREVIEW_WORDS])
+            lines.append(f"[{pid}] {preview} ...")
+    return "\n\n".join(lines)
+
+def patch_view(user_request: str, document_text: str) -> tuple:
+    """
+    Returns what patch mode sends of a document: (ids of the paragraphs sent in full,
+    the rendered paragraphs, the text of the full paragraphs).
+    """
+    pieces, paragraph_ids = split_document(document_text)
+    paragraphs = {pid: pieces[index] for pid, index in paragraph_ids.items()}
+    full_ids = select_relevant(user_request, paragraphs)
+    context = "\n\n".join(paragraphs[pid] for pid in full_ids)
+    return full_ids, render_paragraphs(paragraphs, full_ids), context
+
+def normalize(text: str) -> str:
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+def apply_edits(document_text: str, edits: list, full_ids: set) -> dict:
+    """
+    Verifies paragraph edits against the document and applies the valid ones.
+
+    An edit is rejected when its id does not exist, was not sent in full, is edited
+    twice, or its anchor is missing or does not match the start of the paragraph.
+
+    Returns:
+        dict: "edited_text" (the merged document), "patch" (applied edits with the
+        original paragraph) and "rejected" (edits that failed verification, with a reason).
+    """
+    pieces, paragraph_ids = split_document(document_text)
+    patch, rejected, seen = [], [], set()
+
+    for edit in edits:
+        if not isinstance(edit, dict):
+            rejected.append({"edit": edit, "reason": "not an object"})
+            continue
+        pid, text = str(edit.get("id", "")).strip("[] "), edit.get("text")
+        anchor = normalize(str(edit.get("anchor") or ""))
+        if pid not in paragraph_ids:
+            reason = "unknown paragraph id"
+        elif pid not in full_ids:
+            reason = "paragraph was not sent in full"
+        elif pid in seen:
+            reason = "paragraph edited more than once"
+        elif not isinstance(text, str):
+            reason = "missing text"
+        elif not anchor:
+            reason = "missing anchor"
+        elif not normalize(pieces[paragraph_ids[pid]]).startswith(anchor):
+            reason = "anchor does not match the paragraph"
+        else:
+            reason = None
+        if reason:
+            rejected.append({"edit": edit, "reason": reason})
+            continue
+
+        seen.add(pid)
+        index = paragraph_ids[pid]
+        original = pieces[index]
+        if text.strip() == original.strip():
+            continue
+        leading = original[:len(original) - len(original.lstrip())]
+        pieces[index] = leading + text.strip() if text.strip() else ""
+        if not text.strip():
+            # Drop the separator too, so deleting a paragraph leaves no gap
+            if index + 1 < len(pieces):
+                pieces[index + 1] = ""
+            elif index > 0:
+                pieces[index - 1] = ""
+        patch.append({"id": pid, "original": original.strip(), "text": text.strip()})
+
+    return {"edited_text": "".join(pieces), "patch": patch, "rejected": rejected}
+
+async def aperform_quick_edit_patch(user_request: str, document_text: str, character_data: str, worldbuilding_data: str, user_genre: str,
+                                    view: tuple = None) -> dict:
+    """
+    Performs a quick edit by asking only for paragraph-level replacements.
+
+    The document is split into paragraphs and only the ones relevant to the request
+    are sent in full, so a one-sentence change on a long chapter costs a few
+    paragraphs of input and output instead of the whole document twice. The
+    returned edits are verified and applied on the server. Character and
+    worldbuilding data are sent as given; callers narrow them with
+    retrieval.select_story_data, using the full paragraphs as context.
+
+    Args:
+        user_request (str): Specific editing request from the user.
+        document_text (str): The current story text to be edited.
+        character_data (str): Character information for context.
+        worldbuilding_data (str): Worldbuilding details for consistency.
+        user_genre (str): The genre of the story (e.g., Fantasy, Romance, Thriller).
+        view (tuple): patch_view(user_request, document_text) when the caller already computed it.
+
+    Returns:
+        dict: "edited_text" with the merged document, plus "patch" and "rejected" (see apply_edits).
+    """
+    full_ids, rendered, _ = view or patch_view(user_request, document_text)
+
+    response = await quick_edit_patch_chain.ainvoke({
+        "userRequest": user_request,
+        "paragraphs": rendered,
+        "characterData": character_data,
+        "worldbuildingData": worldbuilding_data,
+        "userGenre": user_genre,
+    })
+    return apply_edits(document_text, response.get("edits") or [], full_ids)
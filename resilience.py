@@ -0,0 +1,294 @@
+"""
+Shared resilience layer for the upstream providers (Gemini, Together, ElevenLabs).
+
+Every provider call goes through `acall` (async) or `call_blocking` (worker threads),
+which applies, in order:
+
+* a circuit breaker that fails fast with CircuitOpenError while a provider is down,
+* token-bucket limits on requests per minute and tokens per minute,
+* retries with exponential backoff and full jitter for retryable errors (429, 5xx,
+  timeouts and connection errors).
+
+Limits are configured per provider with `<PROVIDER>_RPM` and `<PROVIDER>_TPM`
+(0 or unset disables the limit), e.g. `GEMINI_RPM=60`. They are shared by the
+RATE_LIMIT_PROCESSES server processes (set by serve.py), each enforcing its share.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "4"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "8"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.getenv("RATE_LIMIT_MAX_WAIT_SECONDS", "30"))
+RATE_LIMIT_PROCESSES = max(1, int(os.getenv("RATE_LIMIT_PROCESSES", "1")))
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+RETRYABLE_NAMES = {
+    "ResourceExhausted", "ServiceUnavailable", "InternalServerError", "DeadlineExceeded",
+    "RateLimitError", "APIConnectionError", "APITimeoutError", "ConnectError",
+    "ReadTimeout", "ConnectTimeout", "RemoteProtocolError",
+}
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling the provider while its circuit breaker is open."""
+    status_code = 503
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a call would have to wait longer than RATE_LIMIT_MAX_WAIT_SECONDS for the limiter."""
+    status_code = 429
+
+
+def status_code_of(error: Exception):
+    """Returns the HTTP status carried by a provider exception, if any."""
+    for attribute in ("status_code", "code", "http_status"):
+        value = getattr(error, attribute, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(error, "response", None)
+    value = getattr(response, "status_code", None)
+    return value if isinstance(value, int) else None
+
+
+def is_retryable(error: Exception) -> bool:
+    """Whether an error is worth retrying: rate limits, server errors, timeouts and dropped connections."""
+    if isinstance(error, (CircuitOpenError, RateLimitExceeded)):
+        return False
+    if isinstance(error, (TimeoutError, ConnectionError, asyncio.TimeoutError)):
+        return True
+    if status_code_of(error) in RETRYABLE_STATUS:
+        return True
+    return any(cls.__name__ in RETRYABLE_NAMES for cls in type(error).__mro__)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at `per_minute` tokens per minute.
+
+    `reserve` takes the tokens immediately (the balance may go negative) and returns
+    how long the caller must wait before using them, so callers are served in order.
+    """
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+            if wait > RATE_LIMIT_MAX_WAIT_SECONDS:
+                raise RateLimitExceeded(f"Rate limit wait of {wait:.1f}s exceeds {RATE_LIMIT_MAX_WAIT_SECONDS:.0f}s")
+            self.tokens -= amount
+            return wait
+
+
+class CircuitBreaker:
+    """
+    Opens after BREAKER_FAILURE_THRESHOLD consecutive failures and rejects calls for
+    BREAKER_RESET_SECONDS. Then a single trial call is let through (half-open): success
+    closes the circuit, failure opens it again.
+    """
+
+    def __init__(self):
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        # When the circuit last closed again after being open
+        self.recovered_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self, provider: str):
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < BREAKER_RESET_SECONDS:
+                    raise CircuitOpenError(f"{provider} is unavailable, circuit breaker is open")
+                self.state = "half_open"
+                self._trial_running = False
+            if self.state == "half_open":
+                if self._trial_running:
+                    raise CircuitOpenError(f"{provider} is unavailable, circuit breaker is half-open")
+                self._trial_running = True
+
+    def trial_due(self) -> bool:
+        """Whether the next call would be let through as the half-open trial."""
+        with self._lock:
+            if self.state == "open":
+                return time.monotonic() - self.opened_at >= BREAKER_RESET_SECONDS
+            return self.state == "half_open" and not self._trial_running
+
+    def release_trial(self):
+        """Frees the half-open trial slot when a call was abandoned before reaching the provider."""
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                self.recovered_at = time.monotonic()
+            self.state = "closed"
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.state == "half_open" or self.failures >= BREAKER_FAILURE_THRESHOLD:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+class Provider:
+    """Limiters, breaker and counters for one upstream provider."""
+
+    def __init__(self, name: str):
+        self.name = name
+        rpm = float(os.getenv(f"{name.upper()}_RPM", "0") or 0) / RATE_LIMIT_PROCESSES
+        tpm = float(os.getenv(f"{name.upper()}_TPM", "0") or 0) / RATE_LIMIT_PROCESSES
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.breaker = CircuitBreaker()
+        self.stats = {"calls": 0, "failures": 0, "retries": 0, "rejected": 0, "limiter_wait_seconds": 0.0}
+
+    def reserve(self, tokens: int) -> float:
+        wait = 0.0
+        if self.requests:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens and tokens:
+            wait = max(wait, self.tokens.reserve(min(tokens, self.tokens.capacity)))
+        self.stats["limiter_wait_seconds"] += wait
+        return wait
+
+    def backoff(self, attempt: int) -> float:
+        # Full jitter: uniform between 0 and the exponential cap
+        return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_provider(name: str) -> Provider:
+    with _providers_lock:
+        if name not in _providers:
+            _providers[name] = Provider(name)
+        return _providers[name]
+
+
+def _admit(provider: Provider, tokens: int) -> float:
+    """Checks the breaker and reserves limiter capacity; returns the time to wait before calling."""
+    try:
+        provider.breaker.before_call(provider.name)
+    except CircuitOpenError:
+        provider.stats["rejected"] += 1
+        raise
+    try:
+        return provider.reserve(tokens)
+    except RateLimitExceeded:
+        provider.breaker.release_trial()
+        provider.stats["rejected"] += 1
+        raise
+
+
+def _retry_delay(provider: Provider, error: BaseException, attempt: int):
+    """
+    Records a failed attempt and returns the backoff before the next one,
+    or None when the error should be raised to the caller.
+    """
+    if not isinstance(error, Exception):
+        # Cancellation: the provider was not at fault
+        provider.breaker.release_trial()
+        return None
+    provider.stats["failures"] += 1
+    if not is_retryable(error):
+        # The provider answered (e.g. a 400), so it is up
+        provider.breaker.record_success()
+        return None
+    provider.breaker.record_failure()
+    if attempt + 1 == RETRY_MAX_ATTEMPTS:
+        return None
+    provider.stats["retries"] += 1
+    return provider.backoff(attempt)
+
+
+async def acall(provider_name: str, func, tokens: int = 0):
+    """
+    Awaits func() under the provider's breaker, rate limits and retry policy.
+
+    Args:
+        provider_name (str): "gemini", "together" or "elevenlabs".
+        func: Zero-argument function returning an awaitable; called once per attempt.
+        tokens (int): Estimated tokens used by the call, for the tokens-per-minute limit.
+
+    Returns:
+        The result of func().
+    """
+    provider = get_provider(provider_name)
+    for attempt in range(RETRY_MAX_ATTEMPTS):
+        wait = _admit(provider, tokens)
+        try:
+            if wait:
+                await asyncio.sleep(wait)
+        except BaseException:
+            # Cancelled while waiting for the limiter, before reaching the provider
+            provider.breaker.release_trial()
+            raise
+        provider.stats["calls"] += 1
+        try:
+            result = await func()
+        except BaseException as e:
+            delay = _retry_delay(provider, e, attempt)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            continue
+        provider.breaker.record_success()
+        return result
+
+
+def call_blocking(provider_name: str, func, tokens: int = 0):
+    """Blocking version of `acall` for code that already runs in a worker thread."""
+    provider = get_provider(provider_name)
+    for attempt in range(RETRY_MAX_ATTEMPTS):
+        wait = _admit(provider, tokens)
+        try:
+            if wait:
+                time.sleep(wait)
+        except BaseException:
+            # Cancelled while waiting for the limiter, before reaching the provider
+            provider.breaker.release_trial()
+            raise
+        provider.stats["calls"] += 1
+        try:
+            result = func()
+        except BaseException as e:
+            delay = _retry_delay(provider, e, attempt)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            continue
+        provider.breaker.record_success()
+        return result
+
+
+def all_stats() -> dict:
+    """Returns call counters, total limiter wait time and breaker state for every provider."""
+    with _providers_lock:
+        providers = list(_providers.values())
+    return {
+        provider.name: dict(provider.stats, breaker_state=provider.breaker.state)
+        for provider in providers
+    }
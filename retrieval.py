@@ -0,0 +1,219 @@
+"""
+Relevance-based selection of character and worldbuilding entries.
+
+A story bible can describe dozens of characters and places while a chapter or an
+edit involves only a few of them. Instead of pasting all of it into every
+prompt, the text is split into entries (paragraphs, or bullet lines) and ranked
+against the request with BM25. The best entries are kept, in their original
+order, up to a token budget (CHARACTER_CONTEXT_TOKENS / WORLDBUILDING_CONTEXT_TOKENS).
+Text that already fits its budget is passed through unchanged.
+
+Indexes are built locally and cached by the digest of their text. Term counts are
+cached per entry, so when an entry is added or edited, only that entry is
+tokenized again.
+"""
+import hashlib
+import math
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+
+from tokens import count_tokens
+
+RETRIEVAL_ENABLED = os.getenv("RETRIEVAL_ENABLED", "1") == "1"
+CHARACTER_CONTEXT_TOKENS = int(os.getenv("CHARACTER_CONTEXT_TOKENS", "1500"))
+WORLDBUILDING_CONTEXT_TOKENS = int(os.getenv("WORLDBUILDING_CONTEXT_TOKENS", "1500"))
+# Words at the end of the previous chapters used as context for a chapter's selection, for continuity
+RETRIEVAL_HISTORY_WORDS = int(os.getenv("RETRIEVAL_HISTORY_WORDS", "200"))
+RETRIEVAL_MAX_INDEXES = int(os.getenv("RETRIEVAL_MAX_INDEXES", "64"))
+RETRIEVAL_MAX_CACHED_ENTRIES = int(os.getenv("RETRIEVAL_MAX_CACHED_ENTRIES", "20000"))
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Weight of the surrounding text (e.g. the end of the last chapter) relative to the request itself
+CONTEXT_WEIGHT = 0.3
+
+ENTRY_BREAK = re.compile(r"\n[ \t]*\n")
+BULLET = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s+")
+HEADING = re.compile(r"^\s*(?:#{1,6}\s+.*|[^.!?]{1,60}:)\s*$")
+STOPWORDS = {
+    "the", "and", "for", "that", "this", "with", "from", "into", "was", "are", "were", "has", "had", "have",
+    "his", "her", "hers", "him", "she", "they", "them", "their", "who", "whom", "its", "but", "not", "all",
+    "any", "can", "will", "would", "should", "could", "been", "being", "than", "then", "there", "when",
+    "where", "which", "while", "about", "after", "before", "over", "under", "out", "one", "our", "you",
+}
+
+stats = {"selections": 0, "passed_through": 0, "input_tokens": 0, "selected_tokens": 0}
+_lock = threading.Lock()
+_indexes = OrderedDict()
+_entry_terms = OrderedDict()
+
+
+def terms(text: str) -> list:
+    """Lowercased content words of text, with plural and possessive endings removed."""
+    words = []
+    for word in re.findall(r"\w+", text.lower()):
+        if len(word) < 2 or word in STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        words.append(word)
+    return words
+
+
+def split_entries(text: str) -> list:
+    """
+    Splits a character or worldbuilding text into entries: blank-line separated
+    blocks, with each item of a bullet list as its own entry. A heading line is
+    kept with the block that follows it.
+    """
+    entries = []
+    heading = ""
+    for block in ENTRY_BREAK.split(text):
+        lines = [line for line in block.strip().splitlines() if line.strip()]
+        if not lines:
+            continue
+        if len(lines) == 1 and HEADING.match(lines[0]):
+            heading = f"{heading}\n{lines[0]}".strip()
+            continue
+        if len(lines) > 1 and all(BULLET.match(line) for line in lines[1:]):
+            # A list: the first line is its heading unless it is an item itself
+            items = lines if BULLET.match(lines[0]) else lines[1:]
+            prefix = "" if BULLET.match(lines[0]) else lines[0]
+            for item in items:
+                entries.append("\n".join(part for part in (heading, prefix, item) if part))
+        else:
+            entries.append("\n".join(part for part in (heading, "\n".join(lines)) if part))
+        heading = ""
+    if heading:
+        entries.append(heading)
+    return entries
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _terms_of_entry(entry: str) -> Counter:
+    key = _digest(entry)
+    with _lock:
+        counts = _entry_terms.get(key)
+        if counts is not None:
+            _entry_terms.move_to_end(key)
+            return counts
+    counts = Counter(terms(entry))
+    with _lock:
+        _entry_terms[key] = counts
+        while len(_entry_terms) > RETRIEVAL_MAX_CACHED_ENTRIES:
+            _entry_terms.popitem(last=False)
+    return counts
+
+
+class BM25Index:
+    """BM25 index over the entries of one text."""
+
+    def __init__(self, entries: list):
+        self.entries = entries
+        self.counts = [_terms_of_entry(entry) for entry in entries]
+        self.lengths = [sum(counts.values()) for counts in self.counts]
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0
+        self.document_frequency = Counter()
+        for counts in self.counts:
+            self.document_frequency.update(counts.keys())
+
+    def idf(self, term: str) -> float:
+        frequency = self.document_frequency.get(term, 0)
+        return math.log(1 + (len(self.entries) - frequency + 0.5) / (frequency + 0.5))
+
+    def scores(self, query: str, context: str = "") -> list:
+        """Returns the BM25 score of every entry for the query, in entry order. Terms of context count less."""
+        query_counts = Counter()
+        for term in terms(query):
+            query_counts[term] += 1
+        for term in terms(context):
+            query_counts[term] += CONTEXT_WEIGHT
+        weights = {term: self.idf(term) * count for term, count in query_counts.items() if term in self.document_frequency}
+        scores = []
+        for counts, length in zip(self.counts, self.lengths):
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * length / (self.average_length or 1))
+            score = 0.0
+            for term, weight in weights.items():
+                frequency = counts.get(term)
+                if frequency:
+                    score += weight * frequency * (BM25_K1 + 1) / (frequency + norm)
+            scores.append(score)
+        return scores
+
+
+def index_for(text: str) -> BM25Index:
+    """Returns the index of a text, building it on first use."""
+    key = _digest(text)
+    with _lock:
+        index = _indexes.get(key)
+        if index is not None:
+            _indexes.move_to_end(key)
+            return index
+    index = BM25Index(split_entries(text))
+    with _lock:
+        _indexes[key] = index
+        while len(_indexes) > RETRIEVAL_MAX_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+
+def select_context(text: str, query: str, budget_tokens: int, context: str = "") -> str:
+    """
+    Returns the entries of text most relevant to query, in their original order,
+    within budget_tokens. Text that fits the budget is returned unchanged.
+
+    Args:
+        text (str): Character or worldbuilding data.
+        query (str): What the prompt is about (plot point, edit request, ...).
+        budget_tokens (int): Maximum estimated tokens of the returned text.
+        context (str): Surrounding text whose terms count CONTEXT_WEIGHT as much as the query's.
+
+    Returns:
+        str: The selected entries separated by blank lines.
+    """
+    total = count_tokens(text or "")
+    if not RETRIEVAL_ENABLED or total <= budget_tokens:
+        with _lock:
+            stats["passed_through"] += 1
+        return text
+
+    index = index_for(text)
+    scores = index.scores(query, context)
+    ranked = sorted((i for i in range(len(index.entries)) if scores[i] > 0), key=lambda i: scores[i], reverse=True)
+    # When nothing matches the query, the entries are taken in order
+    if not ranked:
+        ranked = range(len(index.entries))
+
+    chosen, used = [], 0
+    for position in ranked:
+        size = count_tokens(index.entries[position]) + 1
+        if used + size > budget_tokens:
+            continue
+        chosen.append(position)
+        used += size
+    selected = "\n\n".join(index.entries[position] for position in sorted(chosen))
+
+    with _lock:
+        stats["selections"] += 1
+        stats["input_tokens"] += total
+        stats["selected_tokens"] += count_tokens(selected)
+    return selected
+
+
+def select_story_data(character_data: str, worldbuilding_data: str, query: str, context: str = "") -> tuple:
+    """Narrows character and worldbuilding data to CHARACTER_CONTEXT_TOKENS and WORLDBUILDING_CONTEXT_TOKENS."""
+    return (
+        select_context(character_data, query, CHARACTER_CONTEXT_TOKENS, context),
+        select_context(worldbuilding_data, query, WORLDBUILDING_CONTEXT_TOKENS, context),
+    )
+
+
+def recent_words(previous_chapters: str) -> str:
+    """The last RETRIEVAL_HISTORY_WORDS words of the previous chapters, used as context for a chapter's selection."""
+    return " ".join((previous_chapters or "").split()[-RETRIEVAL_HISTORY_WORDS:])
@@ -1,39 +1,33 @@
-from langchain_google_genai import ChatGoogleGenerativeAI
-from dotenv import load_dotenv
-from langchain_openai import ChatOpenAI
-from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.prompts import PromptTemplate
 from langchain_core.pydantic_v1 import BaseModel, Field
-import os
-from langchain_core.prompts import PromptTemplate
-
 
+from router import routed_model
+from metrics import timed_chain
+from parsers import TolerantJsonOutputParser
+from cache import acached_invoke, get_cache
 
-load_dotenv()
 
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+llm = routed_model("gemini", temperature=1)
 
+# Most variants returned by one request
+MAX_REWRITE_VARIANTS = 5
 
+class RewriteVariants(BaseModel):
+    variants: list = Field(description="Rewritten versions of the text, each taking a different approach")
 
-llm = ChatGoogleGenerativeAI(
-    model="gemini-2.0-pro-exp-02-05",
-    temperature=1,
-    
-)
-class rewrittenText(BaseModel):
-    newText: str = Field(description="new_eddited_text")
+parser = TolerantJsonOutputParser(pydantic_object=RewriteVariants)
 
-parser = JsonOutputParser(pydantic_object=rewrittenText)
+rewrite_system_prompt = """You are a helpful and creative writing assistant. You are collaborating with a writer on a story. Your current task is to REWRITE some sentences based on the writer's needs to improve the writing. Focus on clarity, style, and impact as requested by the writer.
 
-rewrite_prompt_template = {
-    "system": """You are a helpful and creative writing assistant. You are collaborating with a writer on a story. Your current task is to REWRITE some sentences based on the writer's needs to improve the writing. Focus on clarity, style, and impact as requested by the writer. The response must be in JSON format as follows:
+Write {variantCount} rewritten version(s) of the text. When asked for more than one, each version must take a noticeably different approach (wording, rhythm, emphasis) so the writer has a real choice. The response must be in JSON format as follows:
 
     ```json
     {{
-        "rewritten_text": "Your rewritten version here"
+        "variants": ["Your first rewritten version here", "Your second rewritten version here"]
     }}
-    ```""",
+    ```"""
 
+rewrite_task_prompts = {
     "shorter": """TASK: Rewrite the following text to make it significantly more concise and to the point. Remove any unnecessary words, phrases, or sentences. Aim for brevity without losing the core meaning.
 
     ORIGINAL TEXT:
@@ -63,42 +57,68 @@ rewrite_prompt_template = {
     {customPrompt}""",
 }
 
+REWRITE_TYPES = tuple(rewrite_task_prompts)
+
+# One prompt per rewrite type, compiled once at import
+rewrite_prompts = {
+    rewrite_type: PromptTemplate.from_template(rewrite_system_prompt + "\n\n" + task_prompt)
+    for rewrite_type, task_prompt in rewrite_task_prompts.items()
+}
+
+chains = {rewrite_type: timed_chain(prompt, llm, parser) for rewrite_type, prompt in rewrite_prompts.items()}
 
+rewrite_cache = get_cache("rewrite")
 
-rewrite_prompt = PromptTemplate( input_variables=["selectedText", "customPrompt"], template=rewrite_prompt_template ,
-                                      partial_variables={"format_instructions": parser.get_format_instructions()})
 
+def rewrite_input(rewrite_type, selected_text, custom_prompt, variants):
+    """Validates the arguments and returns the prompt input for a rewrite."""
+    if rewrite_type not in rewrite_prompts:
+        raise ValueError(f"Unknown rewrite type {rewrite_type!r}, expected one of {', '.join(REWRITE_TYPES)}")
+    if not 1 <= variants <= MAX_REWRITE_VARIANTS:
+        raise ValueError(f"variants must be between 1 and {MAX_REWRITE_VARIANTS}")
+    input_data = {"selectedText": selected_text, "variantCount": variants}
+    if rewrite_type == "custom":
+        input_data["customPrompt"] = custom_prompt or ""
+    return input_data
 
-chain = rewrite_prompt | llm | parser
 
+def rewrite_result(response, variants):
+    """Shapes the model response as {"newText": best, "variants": [...]}."""
+    candidates = [str(text).strip() for text in response.get("variants") or [] if str(text).strip()]
+    if not candidates and response.get("newText"):
+        candidates = [response["newText"]]
+    if not candidates:
+        raise ValueError("The model returned no rewritten text")
+    candidates = candidates[:variants]
+    return {"newText": candidates[0], "variants": candidates}
 
 
-def get_rewritten_text(selected_text, custom_prompt=""):
+def get_rewritten_text(rewrite_type, selected_text, custom_prompt="", variants=1):
     """
     Generates rewritten text using the specified rewrite type.
-    
+
     Args:
         rewrite_type (str): The type of rewriting (e.g., 'shorter', 'longer', 'more_intense', 'more_descriptive', 'custom').
         selected_text (str): The text that needs to be rewritten.
         custom_prompt (str): (Optional) Custom instructions for the 'custom' rewrite type.
-        
+        variants (int): Number of alternative rewrites to generate in the same model call.
+
     Returns:
-        str: The rewritten text in JSON format.
+        dict: "newText" with the first rewrite and "variants" with all of them.
     """
-    # Choose the appropriate prompt template
-    
-    
-    # Prepare the input for the chain
-    input_data = {
-        "selectedText": selected_text,
-        "customPrompt": custom_prompt
-    }
-    
-    # Generate the prompt using PromptTemplate
-    
-    
-    # Invoke the chain and get the response
-    response = chain.invoke(input_data)
-    return response
+    input_data = rewrite_input(rewrite_type, selected_text, custom_prompt, variants)
+
+    # Invoke the chain for this rewrite type and get the response
+    response = chains[rewrite_type].invoke(input_data)
+    return rewrite_result(response, variants)
+
 
+async def aget_rewritten_text(rewrite_type, selected_text, custom_prompt="", variants=1, use_cache=True):
+    """
+    Async version of get_rewritten_text that awaits the model call.
+    Identical requests are served from the response cache unless use_cache is False.
+    """
+    input_data = rewrite_input(rewrite_type, selected_text, custom_prompt, variants)
 
+    response = await acached_invoke(rewrite_cache, rewrite_prompts[rewrite_type], llm, parser, input_data, use_cache)
+    return rewrite_result(response, variants)
@@ -0,0 +1,347 @@
+"""
+Latency-aware routing of chat model calls across backends (Gemini and Together).
+
+Each chain is given a preferred backend plus the fallbacks in ROUTER_FALLBACK_MODELS.
+A fallback only takes a call whose prompt, plus ROUTER_OUTPUT_RESERVE_TOKENS for the
+answer, fits its context window (ROUTER_CONTEXT_TOKENS); short prompts can fail over
+to a small model while long ones stay on the backends that hold them. The router keeps a rolling window of latencies and outcomes per backend (the last
+ROUTER_WINDOW calls within ROUTER_WINDOW_SECONDS) and sends every call to the best
+healthy one: the preferred backend, unless it is unhealthy (open circuit breaker or
+error rate above ROUTER_MAX_ERROR_RATE) or its median latency is more than
+ROUTER_LATENCY_TOLERANCE times that of a healthy fallback. A backend whose breaker
+has been open for BREAKER_RESET_SECONDS is healthy again for one half-open trial
+call. A call that fails with a retryable error is tried again on the next backend.
+
+Answers from a fallback are marked in their response metadata, so they are not
+cached under the preferred model's key (see cache.py).
+
+With ROUTER_HEDGE=1, a call that takes longer than its backend's p95 latency fires
+a second (hedged) request to the next backend; whichever answers first wins and the
+other one is cancelled.
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+
+from langchain_core.runnables import Runnable
+
+import resilience
+import tokens
+from providers import chat_model, LazyChatModel
+
+ROUTER_WINDOW = int(os.getenv("ROUTER_WINDOW", "100"))
+# Samples older than this are dropped, so a past failure burst does not mark a backend unhealthy for good
+ROUTER_WINDOW_SECONDS = float(os.getenv("ROUTER_WINDOW_SECONDS", "300"))
+ROUTER_MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", "5"))
+ROUTER_MAX_ERROR_RATE = float(os.getenv("ROUTER_MAX_ERROR_RATE", "0.5"))
+ROUTER_LATENCY_TOLERANCE = float(os.getenv("ROUTER_LATENCY_TOLERANCE", "1.5"))
+ROUTER_HEDGE = os.getenv("ROUTER_HEDGE", "0") == "1"
+# Hedge delay used until a backend has ROUTER_MIN_SAMPLES latencies to compute its p95
+ROUTER_HEDGE_DELAY_SECONDS = float(os.getenv("ROUTER_HEDGE_DELAY_SECONDS", "20"))
+# Backends tried after a chain's preferred model, as provider:model pairs
+ROUTER_FALLBACK_MODELS = os.getenv(
+    "ROUTER_FALLBACK_MODELS", "gemini:gemini-2.0-pro-exp-02-05,together:google/gemma-2-27b-it"
+)
+# Context windows of the models with a small one, as model=tokens pairs; other models are assumed to fit any budget
+ROUTER_CONTEXT_TOKENS = os.getenv("ROUTER_CONTEXT_TOKENS", "google/gemma-2-27b-it=8192")
+# Room left in a fallback's context window for the answer
+ROUTER_OUTPUT_RESERVE_TOKENS = int(os.getenv("ROUTER_OUTPUT_RESERVE_TOKENS", "2048"))
+# Response metadata key naming the fallback backend that answered a call
+FALLBACK_METADATA_KEY = "routed_fallback"
+
+
+def _percentile(values, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class BackendStats:
+    """Rolling window of call latencies and outcomes for one backend, as (time, value) samples."""
+
+    def __init__(self):
+        self.latencies = deque(maxlen=ROUTER_WINDOW)
+        self.outcomes = deque(maxlen=ROUTER_WINDOW)
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float = None, ok: bool = True):
+        now = time.monotonic()
+        with self._lock:
+            if seconds is not None:
+                self.latencies.append((now, seconds))
+            self.outcomes.append((now, ok))
+
+    def _expire(self):
+        cutoff = time.monotonic() - ROUTER_WINDOW_SECONDS
+        for samples in (self.latencies, self.outcomes):
+            while samples and samples[0][0] < cutoff:
+                samples.popleft()
+
+    def error_rate(self, since: float = 0.0) -> float:
+        """Returns the share of failed calls in the window, counting only calls after `since` (monotonic)."""
+        with self._lock:
+            self._expire()
+            outcomes = [ok for at, ok in self.outcomes if at >= since]
+        if len(outcomes) < ROUTER_MIN_SAMPLES:
+            return 0.0
+        return outcomes.count(False) / len(outcomes)
+
+    def latency(self, fraction: float):
+        """Returns a latency percentile, or None while there are too few samples."""
+        with self._lock:
+            self._expire()
+            if len(self.latencies) < ROUTER_MIN_SAMPLES:
+                return None
+            return _percentile([seconds for _, seconds in self.latencies], fraction)
+
+    def snapshot(self) -> dict:
+        p50, p95 = self.latency(0.50), self.latency(0.95)
+        with self._lock:
+            samples = len(self.latencies)
+        return {
+            "samples": samples,
+            "error_rate": round(self.error_rate(), 3),
+            "latency_p50": round(p50, 4) if p50 is not None else None,
+            "latency_p95": round(p95, 4) if p95 is not None else None,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        }
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def backend_stats(backend: LazyChatModel) -> BackendStats:
+    key = f"{backend.provider}:{backend.model}"
+    with _stats_lock:
+        if key not in _stats:
+            _stats[key] = BackendStats()
+        return _stats[key]
+
+
+def is_healthy(backend: LazyChatModel) -> bool:
+    breaker = resilience.get_provider(backend.provider).breaker
+    if breaker.state != "closed":
+        # The breaker lets one trial call through once BREAKER_RESET_SECONDS have passed;
+        # it decides whether the backend is back, whatever its past error rate
+        return breaker.trial_due()
+    # Failures from before the breaker last recovered are not held against the backend
+    return backend_stats(backend).error_rate(since=breaker.recovered_at) <= ROUTER_MAX_ERROR_RATE
+
+
+def rank_backends(backends: list) -> list:
+    """
+    Orders backends for a call: healthy ones first, the preferred backend ahead of
+    the others unless a fallback is ROUTER_LATENCY_TOLERANCE times faster at the median.
+    """
+    healthy = [backend for backend in backends if is_healthy(backend)]
+    unhealthy = [backend for backend in backends if backend not in healthy]
+    if len(healthy) > 1:
+        medians = {id(backend): backend_stats(backend).latency(0.50) for backend in healthy}
+        known = [median for median in medians.values() if median is not None]
+        if known:
+            fastest = min(known)
+
+            def too_slow(backend):
+                median = medians[id(backend)]
+                return median is not None and median > fastest * ROUTER_LATENCY_TOLERANCE
+
+            # Stable sort keeps the configured preference among comparable backends
+            healthy.sort(key=too_slow)
+    return healthy + unhealthy
+
+
+def should_fail_over(error: Exception) -> bool:
+    """Whether a failed call is worth trying on another backend."""
+    return isinstance(error, (resilience.CircuitOpenError, resilience.RateLimitExceeded)) or resilience.is_retryable(error)
+
+
+class RoutedChatModel(Runnable):
+    """
+    Chat model that routes each call to one of several LazyChatModel backends.
+
+    `model` and `temperature` are those of the preferred backend and are used in
+    cache keys; `backend` labels the chain's prompt and parse metrics. Results from any other backend are marked with FALLBACK_METADATA_KEY.
+    """
+
+    def __init__(self, backends: list):
+        self.backends = backends
+        self.model = backends[0].model
+        self.temperature = backends[0].temperature
+        self.backend = backends[0].backend
+
+    def candidates(self, input) -> list:
+        """Ranks the backends that can take a prompt; the preferred backend is always kept."""
+        count = tokens.prompt_tokens(input)
+        return rank_backends([
+            backend for backend in self.backends
+            if backend is self.backends[0] or fits_context(backend.model, count)
+        ])
+
+    def invoke(self, input, config=None, **kwargs):
+        last_error = None
+        for backend in self.candidates(input):
+            stats = backend_stats(backend)
+            start = time.perf_counter()
+            try:
+                result = backend.invoke(input, config, **kwargs)
+            except Exception as e:
+                stats.record(ok=False)
+                if not should_fail_over(e):
+                    raise
+                last_error = e
+                continue
+            stats.record(time.perf_counter() - start)
+            return self._mark(backend, result)
+        raise last_error
+
+    def _mark(self, backend, result):
+        if backend is not self.backends[0] and hasattr(result, "response_metadata"):
+            result.response_metadata[FALLBACK_METADATA_KEY] = f"{backend.provider}:{backend.model}"
+        return result
+
+    async def _timed(self, backend, input, config, kwargs):
+        stats = backend_stats(backend)
+        start = time.perf_counter()
+        try:
+            result = await backend.ainvoke(input, config, **kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            stats.record(ok=False)
+            raise
+        stats.record(time.perf_counter() - start)
+        return self._mark(backend, result)
+
+    async def _hedged(self, primary, secondary, input, config, kwargs, tried: set):
+        """Runs primary, adding secondary once primary exceeds its p95; returns the first success."""
+        delay = backend_stats(primary).latency(0.95) or ROUTER_HEDGE_DELAY_SECONDS
+        tasks = [asyncio.ensure_future(self._timed(primary, input, config, kwargs))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                backend_stats(primary).hedges += 1
+                tried.add(id(secondary))
+                tasks.append(asyncio.ensure_future(self._timed(secondary, input, config, kwargs)))
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            backend_stats(primary).hedge_wins += 1
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            # Cancel the losing request
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        ranked = self.candidates(input)
+        last_error = None
+        tried = set()
+        for index, backend in enumerate(ranked):
+            if id(backend) in tried:
+                continue
+            tried.add(id(backend))
+            try:
+                if ROUTER_HEDGE and index + 1 < len(ranked):
+                    return await self._hedged(backend, ranked[index + 1], input, config, kwargs, tried)
+                return await self._timed(backend, input, config, kwargs)
+            except Exception as e:
+                if not should_fail_over(e):
+                    raise
+                last_error = e
+        raise last_error
+
+    async def astream(self, input, config=None, **kwargs):
+        # Streams are routed but not hedged, and fail over only before the first chunk
+        last_error = None
+        for backend in self.candidates(input):
+            stats = backend_stats(backend)
+            stream = backend.astream(input, config, **kwargs)
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                stats.record()
+                return
+            except Exception as e:
+                stats.record(ok=False)
+                if not should_fail_over(e):
+                    raise
+                last_error = e
+                continue
+            yield first
+            try:
+                async for chunk in stream:
+                    yield chunk
+            except Exception:
+                stats.record(ok=False)
+                raise
+            stats.record()
+            return
+        raise last_error
+
+
+def _fallback_models() -> list:
+    backends = []
+    for entry in ROUTER_FALLBACK_MODELS.split(","):
+        provider, _, model = entry.strip().partition(":")
+        if provider:
+            backends.append((provider, model or None))
+    return backends
+
+
+def context_tokens(model: str):
+    """Returns the context window of a model from ROUTER_CONTEXT_TOKENS, or None when it is not limited."""
+    for entry in ROUTER_CONTEXT_TOKENS.split(","):
+        name, _, size = entry.strip().rpartition("=")
+        if name == model and size.strip().isdigit():
+            return int(size)
+    return None
+
+
+def fits_context(model: str, prompt_tokens: int) -> bool:
+    """Whether a prompt and ROUTER_OUTPUT_RESERVE_TOKENS fit the model's context window."""
+    window = context_tokens(model or "")
+    return window is None or prompt_tokens + ROUTER_OUTPUT_RESERVE_TOKENS <= window
+
+
+def fallback_backend(message):
+    """Returns the "provider:model" of the fallback that produced a model response, or None."""
+    return (getattr(message, "response_metadata", None) or {}).get(FALLBACK_METADATA_KEY)
+
+
+def routed_model(provider: str = "gemini", model: str = None, temperature: float = 1) -> RoutedChatModel:
+    """
+    Returns a chat model for a module-level chain that prefers the given provider
+    and model and falls back to the backends in ROUTER_FALLBACK_MODELS.
+
+    Args:
+        provider (str): Provider of the preferred model.
+        model (str): Preferred model, or None for the provider's default.
+        temperature (float): Sampling temperature of every backend.
+    """
+    backends = [chat_model(provider, model, temperature)]
+    for fallback_provider, fallback_model in _fallback_models():
+        if (fallback_provider, fallback_model) in [(b.provider, b.model) for b in backends]:
+            continue
+        backends.append(chat_model(fallback_provider, fallback_model, temperature))
+    return RoutedChatModel(backends)
+
+
+def all_stats() -> dict:
+    """Returns rolling latency percentiles, error rate and hedge counts for every backend."""
+    with _stats_lock:
+        items = list(_stats.items())
+    return {key: stats.snapshot() for key, stats in items}
@@ -0,0 +1,60 @@
+"""
+Production launcher: serves api.app with several worker processes.
+
+    python serve.py --workers 4 --port 8080
+
+Each worker is a separate Python process, so JSON parsing, prompt rendering and
+validation use every core instead of one. The workers share their state through
+the databases and files under CACHE_DIR, SESSIONS_DIR, JOBS_DIR and IMAGE_DIR (see
+store.py): a response cached, a session updated or a job queued by one worker is
+seen by all of them. Provider rate limits (<PROVIDER>_RPM / _TPM) are split
+between the workers.
+
+A worker only accepts connections once it has warmed up (see api.warm_up), and
+GET /ready reports whether it is ready. On SIGTERM or Ctrl+C, workers stop
+accepting connections, let in-flight requests and background jobs finish for up
+to SERVE_DRAIN_SECONDS, then exit.
+"""
+import argparse
+import os
+
+import uvicorn
+
+SERVE_HOST = os.getenv("SERVE_HOST", "0.0.0.0")
+SERVE_PORT = int(os.getenv("SERVE_PORT", "8080"))
+SERVE_WORKERS = int(os.getenv("SERVE_WORKERS", str(os.cpu_count() or 1)))
+SERVE_DRAIN_SECONDS = float(os.getenv("SERVE_DRAIN_SECONDS", "120"))
+
+
+def serve(workers: int = SERVE_WORKERS, host: str = SERVE_HOST, port: int = SERVE_PORT,
+          drain_seconds: float = SERVE_DRAIN_SECONDS):
+    """
+    Runs the API with `workers` processes until it is stopped.
+
+    Args:
+        workers (int): Number of worker processes.
+        host (str): Interface to listen on.
+        port (int): Port to listen on.
+        drain_seconds (float): How long in-flight requests and jobs may take to finish on shutdown.
+    """
+    # Read by the workers when they start
+    os.environ.setdefault("RATE_LIMIT_PROCESSES", str(workers))
+    os.environ["SERVE_DRAIN_SECONDS"] = str(drain_seconds)
+    uvicorn.run(
+        "api:app",
+        host=host,
+        port=port,
+        workers=workers,
+        timeout_graceful_shutdown=drain_seconds,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the API with several worker processes.")
+    parser.add_argument("--workers", type=int, default=SERVE_WORKERS, help="worker processes (default: SERVE_WORKERS or the CPU count)")
+    parser.add_argument("--host", default=SERVE_HOST)
+    parser.add_argument("--port", type=int, default=SERVE_PORT)
+    parser.add_argument("--drain-seconds", type=float, default=SERVE_DRAIN_SECONDS,
+                        help="time given to in-flight requests and jobs on shutdown")
+    args = parser.parse_args()
+    serve(args.workers, args.host, args.port, args.drain_seconds)
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import re
+import uuid
+
+import store
+
+# Where session manifests and content-addressed blobs are stored
+SESSIONS_DIR = os.getenv("SESSIONS_DIR", ".sessions")
+
+# Fields of a session that hold a single text blob
+TEXT_FIELDS = ("character_data", "worldbuilding_data", "document_text")
+
+# Session IDs are uuid4 hex strings and blobs are named by their SHA-256 digest.
+# Both become file names, so anything else is rejected before a path is built.
+SESSION_ID_PATTERN = r"^[0-9a-f]{32}$"
+DIGEST_PATTERN = r"^[0-9a-f]{64}$"
+
+class SessionNotFound(KeyError):
+    """Raised when a session ID does not exist or is not a valid session ID."""
+
+
+def _check_id(session_id: str):
+    if not isinstance(session_id, str) or not re.match(SESSION_ID_PATTERN, session_id):
+        raise SessionNotFound(session_id)
+
+
+def _blob_path(digest: str) -> str:
+    if not isinstance(digest, str) or not re.match(DIGEST_PATTERN, digest):
+        raise ValueError(f"Invalid blob digest: {digest!r}")
+    return os.path.join(SESSIONS_DIR, "blobs", digest[:2], digest)
+
+
+def _session_path(session_id: str) -> str:
+    _check_id(session_id)
+    return os.path.join(SESSIONS_DIR, "sessions", f"{session_id}.json")
+
+
+def _lock(session_id: str):
+    _check_id(session_id)
+    # Updates read, change and rewrite the manifest, so they are serialized across processes.
+    # The lock blocks, so async callers run session functions in the blocking pool.
+    return store.file_lock(os.path.join(SESSIONS_DIR, "locks", f"{session_id}.lock"))
+
+
+def _write_atomic(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+def put_blob(text: str) -> str:
+    """Stores text under its SHA-256 digest and returns the digest. Existing blobs are reused."""
+    data = text.encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()
+    path = _blob_path(digest)
+    if not os.path.exists(path):
+        _write_atomic(path, data)
+    return digest
+
+
+def get_blob(digest: str) -> str:
+    """Returns the text stored under digest."""
+    with open(_blob_path(digest), "rb") as file:
+        return file.read().decode("utf-8")
+
+
+def _load(session_id: str) -> dict:
+    try:
+        with open(_session_path(session_id), "rb") as file:
+            return json.loads(file.read())
+    except (FileNotFoundError, ValueError):
+        raise SessionNotFound(session_id)
+
+
+def _save(session: dict):
+    _write_atomic(_session_path(session["id"]), json.dumps(session).encode("utf-8"))
+
+
+def create_session(chapters=None, **fields) -> dict:
+    """
+    Creates a story session.
+
+    Args:
+        chapters (list): Optional initial chapter texts, oldest first.
+        **fields: Optional initial character_data, worldbuilding_data and document_text.
+
+    Returns:
+        dict: The session manifest.
+    """
+    session = {"id": uuid.uuid4().hex, "chapters": []}
+    for field in TEXT_FIELDS:
+        text = fields.get(field)
+        session[field] = put_blob(text) if text is not None else None
+    session["chapters"] = [put_blob(text) for text in chapters or []]
+    _save(session)
+    return session
+
+
+def get_session(session_id: str) -> dict:
+    """Returns the session manifest (blob digests, not the texts)."""
+    return _load(session_id)
+
+
+def append_chapter(session_id: str, chapter_text: str) -> dict:
+    """Appends a chapter to the session and returns the updated manifest."""
+    _load(session_id)
+    digest = put_blob(chapter_text)
+    with _lock(session_id):
+        session = _load(session_id)
+        session["chapters"].append(digest)
+        _save(session)
+    return session
+
+
+def set_text(session_id: str, field: str, text: str) -> dict:
+    """Replaces one of TEXT_FIELDS in the session and returns the updated manifest."""
+    if field not in TEXT_FIELDS:
+        raise ValueError(f"Unknown session field: {field}")
+    _load(session_id)
+    digest = put_blob(text)
+    with _lock(session_id):
+        session = _load(session_id)
+        session[field] = digest
+        _save(session)
+    return session
+
+
+def resolve_chapters(session_id: str) -> list:
+    """Returns the texts of all chapters in the session, oldest first."""
+    return [get_blob(digest) for digest in _load(session_id)["chapters"]]
+
+
+def resolve_text(session_id: str, field: str) -> str:
+    """Returns the text stored for one of TEXT_FIELDS, or an empty string if unset."""
+    digest = _load(session_id).get(field)
+    return get_blob(digest) if digest else ""
+
+
+def describe(session: dict) -> dict:
+    """Summarizes a manifest for API responses."""
+    return {
+        "session_id": session["id"],
+        "chapter_count": len(session["chapters"]),
+        "chapters": session["chapters"],
+        **{field: session.get(field) for field in TEXT_FIELDS},
+    }
@@ -0,0 +1,51 @@
+"""
+Shared on-disk state for running the API as several processes (see serve.py).
+
+The response cache, semantic cache, job queue, sessions and images live in SQLite
+databases and files under their *_DIR settings, so every worker process sees the
+same data instead of keeping a cold private copy. This module opens those
+databases for concurrent use (write-ahead log, so readers never block the writer,
+and a busy timeout for writers) and provides a lock that works across processes.
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single process only
+    fcntl = None
+
+# How long a write waits for another process's write to finish
+STORE_BUSY_TIMEOUT_SECONDS = float(os.getenv("STORE_BUSY_TIMEOUT_SECONDS", "30"))
+
+_thread_lock = threading.Lock()
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Opens a SQLite database shared by all processes, creating its directory if needed."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    db = sqlite3.connect(path, timeout=STORE_BUSY_TIMEOUT_SECONDS, check_same_thread=False)
+    # Switching the journal mode fails instead of waiting when another process does it at the same time
+    with file_lock(f"{path}.lock"):
+        db.execute("PRAGMA journal_mode=WAL")
+    # With the write-ahead log, NORMAL only risks the last commits on power loss, not corruption
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+@contextmanager
+def file_lock(path: str):
+    """Holds an exclusive lock on path (created if needed), across threads and processes."""
+    if fcntl is None:
+        with _thread_lock:
+            yield
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
@@ -0,0 +1,155 @@
+"""
+Token accounting and per-endpoint prompt budgets.
+
+Every chat model call records its input and output tokens in a histogram per
+endpoint and model. The endpoint is the one whose `concurrency.endpoint_limit`
+the call runs under.
+
+Each endpoint has an input budget, `<ENDPOINT>_MAX_INPUT_TOKENS`. It falls back to
+DEFAULT_BUDGETS and then MAX_INPUT_TOKENS. Requests over budget are rejected with
+PromptTooLarge (HTTP 413), or trimmed when `<ENDPOINT>_BUDGET_POLICY=trim`. Rendered
+prompts are checked again right before the model is called.
+
+Tokens are estimated at four characters per token. No provider tokenizer is loaded,
+and the estimate is close enough for budgets and billing trends.
+"""
+import os
+import threading
+from contextvars import ContextVar
+
+MAX_INPUT_TOKENS = int(os.getenv("MAX_INPUT_TOKENS", "32000"))
+TOKEN_BUDGET_POLICY = os.getenv("TOKEN_BUDGET_POLICY", "reject")
+# Tokens taken by an endpoint's prompt template itself, on top of the request fields
+PROMPT_OVERHEAD_TOKENS = int(os.getenv("PROMPT_OVERHEAD_TOKENS", "1000"))
+
+# Gemma 2 on Together has an 8k context window
+DEFAULT_BUDGETS = {"brainstorming": 6000}
+
+HISTOGRAM_BUCKETS = (64, 256, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072)
+
+current_endpoint = ContextVar("current_endpoint", default="other")
+
+
+class PromptTooLarge(Exception):
+    """Raised when a request's input does not fit the endpoint's token budget."""
+    status_code = 413
+
+
+def count_tokens(text: str) -> int:
+    """Estimated token count of text (about four characters per token)."""
+    return (len(text) + 3) // 4 if text else 0
+
+
+def prompt_tokens(prompt) -> int:
+    """Estimated token count of a rendered prompt value, message list or string."""
+    text = prompt.to_string() if hasattr(prompt, "to_string") else str(prompt)
+    return count_tokens(text)
+
+
+def input_budget(endpoint: str) -> int:
+    """Returns the input token budget of an endpoint."""
+    value = os.getenv(f"{endpoint.upper()}_MAX_INPUT_TOKENS")
+    return int(value) if value else DEFAULT_BUDGETS.get(endpoint, MAX_INPUT_TOKENS)
+
+
+def budget_policy(endpoint: str) -> str:
+    """Returns "reject" or "trim" for an endpoint."""
+    return os.getenv(f"{endpoint.upper()}_BUDGET_POLICY", TOKEN_BUDGET_POLICY)
+
+
+def fit_to_budget(endpoint: str, fields: dict, trimmable: dict = None) -> dict:
+    """
+    Checks the request fields of an endpoint against its budget.
+
+    Args:
+        endpoint (str): Endpoint name, for the budget and policy settings.
+        fields (dict): Text fields that go into the prompt.
+        trimmable (dict): Fields that the "trim" policy may shorten, mapped to the
+            part to keep: "head" (the beginning) or "tail" (the end).
+
+    Returns:
+        dict: fields, with trimmable fields shortened if needed.
+
+    Raises:
+        PromptTooLarge: When the fields do not fit and cannot be trimmed to fit.
+    """
+    budget = input_budget(endpoint) - PROMPT_OVERHEAD_TOKENS
+    sizes = {name: count_tokens(value or "") for name, value in fields.items()}
+    excess = sum(sizes.values()) - budget
+    if excess <= 0:
+        return fields
+
+    trimmable = trimmable or {}
+    room = sum(sizes[name] for name in trimmable if name in fields)
+    if budget_policy(endpoint) != "trim" or room < excess:
+        raise PromptTooLarge(
+            f"Input of about {sum(sizes.values()) + PROMPT_OVERHEAD_TOKENS} tokens exceeds "
+            f"the {endpoint} budget of {input_budget(endpoint)} tokens"
+        )
+
+    fitted = dict(fields)
+    # Trim the largest fields first
+    for name in sorted(trimmable, key=lambda name: sizes.get(name, 0), reverse=True):
+        if excess <= 0 or name not in fields:
+            continue
+        cut = min(excess, sizes[name])
+        keep = max(len(fields[name]) - cut * 4, 0)
+        fitted[name] = fields[name][:keep] if trimmable[name] == "head" else fields[name][len(fields[name]) - keep:]
+        excess -= cut
+    return fitted
+
+
+def check_prompt(prompt):
+    """Rejects a rendered prompt that exceeds the current endpoint's budget; returns its token count."""
+    endpoint = current_endpoint.get()
+    count = prompt_tokens(prompt)
+    if count > input_budget(endpoint):
+        raise PromptTooLarge(f"Prompt of about {count} tokens exceeds the {endpoint} budget of {input_budget(endpoint)} tokens")
+    return count
+
+
+class Histogram:
+    """Cumulative bucket counts plus sum and count, like a Prometheus histogram."""
+
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        return {
+            "buckets": dict(zip([str(bound) for bound in self.buckets], self.counts)),
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+
+_histograms = {}
+_lock = threading.Lock()
+
+
+def record(model: str, direction: str, count: int):
+    """Records the input or output token count of one call under the current endpoint."""
+    key = (current_endpoint.get(), model, direction)
+    with _lock:
+        if key not in _histograms:
+            _histograms[key] = Histogram()
+        _histograms[key].observe(count)
+
+
+def all_stats() -> dict:
+    """Returns the token histograms keyed by endpoint, model and direction ("input"/"output")."""
+    with _lock:
+        items = [(key, histogram.snapshot()) for key, histogram in _histograms.items()]
+    stats = {}
+    for (endpoint, model, direction), snapshot in items:
+        stats.setdefault(endpoint, {}).setdefault(model, {})[direction] = snapshot
+    return stats
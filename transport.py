@@ -0,0 +1,282 @@
+"""
+HTTP transport: fast JSON rendering, compression and conditional GETs.
+
+* FastJSONResponse renders with orjson when it is installed (the stdlib json
+  otherwise). metrics.TimedJSONResponse, the app's default response class, builds on it.
+* TransportMiddleware negotiates zstd or gzip compression (Accept-Encoding) for
+  JSON and text responses of at least COMPRESSION_MIN_BYTES, and decompresses
+  request bodies sent with `Content-Encoding: gzip` or `zstd`. zstd needs the
+  zstandard package; without it only gzip is offered and accepted.
+* GET responses get an ETag (a hash of the body), and a request whose
+  If-None-Match carries it is answered with 304 Not Modified and no body.
+
+Streamed responses (SSE, audio) pass through untouched.
+"""
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "1") == "1"
+# Smaller bodies are sent as is: the headers would cost more than the savings
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+ZSTD_LEVEL = int(os.getenv("ZSTD_LEVEL", "3"))
+# Largest request body accepted after decompression, against compression bombs
+MAX_DECOMPRESSED_REQUEST_BYTES = int(os.getenv("MAX_DECOMPRESSED_REQUEST_MB", "64")) * 1024 * 1024
+
+# Encodings in order of preference
+ENCODINGS = ("zstd", "gzip") if zstandard is not None else ("gzip",)
+DECODE_ERRORS = (zlib.error, zstandard.ZstdError) if zstandard is not None else (zlib.error,)
+
+stats = {
+    "compressed_responses": 0, "response_bytes": 0, "response_bytes_compressed": 0, "compress_seconds": 0.0,
+    "decompressed_requests": 0, "request_bytes": 0, "request_bytes_compressed": 0, "decompress_seconds": 0.0,
+    "not_modified": 0,
+}
+_stats_lock = threading.Lock()
+
+
+class RequestBodyError(Exception):
+    """Raised when a compressed request body cannot be decoded."""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _count(**amounts):
+    with _stats_lock:
+        for name, amount in amounts.items():
+            stats[name] += amount
+
+
+def dumps(content) -> bytes:
+    """Serializes content to compact UTF-8 JSON."""
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson when available."""
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def negotiate(accept_encoding: str):
+    """Returns the preferred encoding the client accepts, or None for identity."""
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def decompress(body: bytes, encoding: str, limit: int = MAX_DECOMPRESSED_REQUEST_BYTES) -> bytes:
+    """
+    Decodes a request body, reading at most limit bytes of output.
+
+    Raises:
+        RequestBodyError: 415 for an unsupported encoding, 400 for corrupt data,
+            413 when the decoded body exceeds limit.
+    """
+    try:
+        if encoding == "gzip":
+            decoder = zlib.decompressobj(wbits=31)
+            data = decoder.decompress(body, limit + 1)
+            if not decoder.eof and len(data) <= limit:
+                raise RequestBodyError(400, "Truncated gzip request body")
+        elif encoding == "zstd" and zstandard is not None:
+            with zstandard.ZstdDecompressor().stream_reader(body) as reader:
+                data = reader.read(limit + 1)
+        else:
+            raise RequestBodyError(415, f"Unsupported Content-Encoding: {encoding}")
+    except DECODE_ERRORS as e:
+        raise RequestBodyError(400, f"Invalid {encoding} request body: {e}")
+    if len(data) > limit:
+        raise RequestBodyError(413, "Decompressed request body is too large")
+    return data
+
+
+def etag_of(body: bytes) -> str:
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Checks an If-None-Match header against an ETag value, ignoring weak and encoding markers."""
+    if not if_none_match:
+        return False
+    candidates = []
+    for tag in if_none_match.split(","):
+        tag = tag.strip().removeprefix("W/").strip('"')
+        for encoding in ENCODINGS:
+            tag = tag.removesuffix(f"-{encoding}")
+        candidates.append(tag)
+    return "*" in candidates or etag in candidates
+
+
+def _compressible(media_type: str) -> bool:
+    media_type = media_type.split(";")[0].strip().lower()
+    if media_type == "text/event-stream":
+        return False
+    return media_type.startswith("text/") or media_type.endswith("json")
+
+
+class TransportMiddleware:
+    """
+    ASGI middleware adding request decompression, response compression and ETags
+    (see module docstring). Written as plain ASGI so streamed responses pass through.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope["headers"]}
+        content_encoding = headers.get("content-encoding", "identity").strip().lower()
+        if content_encoding != "identity":
+            try:
+                scope, receive = await self._decoded_request(scope, receive, content_encoding)
+            except RequestBodyError as e:
+                response = FastJSONResponse({"detail": e.detail}, status_code=e.status_code)
+                return await response(scope, receive, send)
+
+        encoding = negotiate(headers.get("accept-encoding", "")) if COMPRESSION_ENABLED else None
+        conditional = scope["method"] in ("GET", "HEAD")
+        if encoding is None and not conditional:
+            return await self.app(scope, receive, send)
+
+        if_none_match = headers.get("if-none-match", "")
+        start_message = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start_message, passthrough
+            if passthrough:
+                return await send(message)
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or start_message is None:
+                return await send(message)
+            if message.get("more_body", False):
+                # A streamed response: sent as is
+                passthrough = True
+                await send(start_message)
+                return await send(message)
+            await self._send_complete(start_message, message.get("body", b""), encoding, conditional, if_none_match, send)
+
+        await self.app(scope, receive, send_wrapper)
+
+    async def _decoded_request(self, scope, receive, encoding):
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] != "http.request":
+                break
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        body = b"".join(chunks)
+        start = time.perf_counter()
+        decoded = decompress(body, encoding)
+        _count(decompressed_requests=1, request_bytes=len(decoded), request_bytes_compressed=len(body),
+               decompress_seconds=time.perf_counter() - start)
+
+        sent = False
+
+        async def decoded_receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": decoded, "more_body": False}
+            return await receive()
+
+        scope = dict(scope)
+        scope["headers"] = [(key, value) for key, value in scope["headers"]
+                            if key.lower() not in (b"content-encoding", b"content-length")]
+        scope["headers"].append((b"content-length", str(len(decoded)).encode("latin-1")))
+        return scope, decoded_receive
+
+    async def _send_complete(self, start_message, body, encoding, conditional, if_none_match, send):
+        status = start_message["status"]
+        headers = [(key, value) for key, value in start_message.get("headers", [])]
+        names = {key.decode("latin-1").lower() for key, _ in headers}
+
+        etag = None
+        if conditional and status == 200 and "etag" not in names:
+            etag = etag_of(body)
+            if etag_matches(if_none_match, etag):
+                _count(not_modified=1)
+                headers = [(key, value) for key, value in headers
+                           if key.lower() not in (b"content-length", b"content-type")]
+                headers.append((b"etag", f'"{etag}"'.encode("latin-1")))
+                await send({"type": "http.response.start", "status": 304, "headers": headers})
+                return await send({"type": "http.response.body", "body": b""})
+
+        media_type = next((value.decode("latin-1") for key, value in headers if key.lower() == b"content-type"), "")
+        if (encoding is not None and len(body) >= COMPRESSION_MIN_BYTES and status not in (204, 304)
+                and "content-encoding" not in names and _compressible(media_type)):
+            start = time.perf_counter()
+            compressed = compress(body, encoding)
+            _count(compressed_responses=1, response_bytes=len(body), response_bytes_compressed=len(compressed),
+                   compress_seconds=time.perf_counter() - start)
+            body = compressed
+            headers = [(key, value) for key, value in headers if key.lower() != b"content-length"]
+            headers.append((b"content-length", str(len(body)).encode("latin-1")))
+            headers.append((b"content-encoding", encoding.encode("latin-1")))
+            if etag is not None:
+                etag = f"{etag}-{encoding}"
+        if COMPRESSION_ENABLED and _compressible(media_type):
+            headers.append((b"vary", b"Accept-Encoding"))
+        if etag is not None:
+            headers.append((b"etag", f'"{etag}"'.encode("latin-1")))
+
+        await send(dict(start_message, headers=headers))
+        await send({"type": "http.response.body", "body": body})
+
+
+def all_stats() -> dict:
+    """Returns compression counters and the average compression ratio of requests and responses."""
+    with _stats_lock:
+        result = dict(stats)
+    for direction in ("response", "request"):
+        compressed = result[f"{direction}_bytes_compressed"]
+        result[f"{direction}_compression_ratio"] = round(result[f"{direction}_bytes"] / compressed, 2) if compressed else None
+    return result
@@ -1,20 +1,107 @@
-from elevenlabs.client import ElevenLabs
-from dotenv import load_dotenv
+import asyncio
+import base64
 import os
-import json
-# import base64
-# from pygame import mixer
-import tempfile
-from elevenlabs import play
+import re
 
-# Load environment variables
-load_dotenv()
-ELEVEN_LABS_API_KEY = os.getenv("ELEVEN_LABS_API_KEY")
+import providers
+import resilience
+from concurrency import run_blocking
 
-# Initialize the client
-client = ElevenLabs(
-    api_key=ELEVEN_LABS_API_KEY
-)
+# Voice and output settings
+VOICE_ID = "JBFqnCBsd6RMkjVDRZzb"  # Change this to another voice if needed
+MODEL_ID = "eleven_multilingual_v2"
+OUTPUT_FORMAT = "mp3_44100_128"
+
+# Streaming settings: chunks are at most TTS_CHUNK_CHARS long and up to
+# TTS_CHUNK_CONCURRENCY of them are converted at the same time
+TTS_CHUNK_CHARS = int(os.getenv("TTS_CHUNK_CHARS", "600"))
+TTS_CHUNK_CONCURRENCY = int(os.getenv("TTS_CHUNK_CONCURRENCY", "4"))
+
+SENTENCE_END = re.compile(r"(?<=[.!?…])\s+|(?<=[.!?…][\"')\]])\s+")
+
+def set_client(new_client):
+    """Swaps the text-to-speech client, e.g. for fakes.FakeElevenLabs in tests and benchmarks."""
+    providers.override("elevenlabs", new_client)
+
+def split_story(story_text: str, max_chars: int = TTS_CHUNK_CHARS) -> list:
+    """
+    Splits a story into chunks for speech synthesis.
+
+    Paragraph and sentence boundaries are respected, and sentences are packed
+    together up to max_chars. The first chunk is always a single sentence so
+    playback can start as early as possible.
+    """
+    chunks = []
+    for paragraph in re.split(r"\n\s*\n", story_text):
+        current = ""
+        for sentence in SENTENCE_END.split(paragraph.strip()):
+            sentence = sentence.strip()
+            if not sentence:
+                continue
+            if not chunks and not current:
+                chunks.append(sentence)
+                continue
+            if current and len(current) + len(sentence) + 1 > max_chars:
+                chunks.append(current)
+                current = sentence
+            else:
+                current = f"{current} {sentence}" if current else sentence
+        if current:
+            chunks.append(current)
+    return chunks
+
+def convert_chunk(text: str, previous_text: str = None, next_text: str = None) -> bytes:
+    """
+    Converts one chunk of text to MP3 bytes. The neighbouring chunks are passed
+    along so the voice keeps a consistent intonation across chunk boundaries.
+    """
+    context = {}
+    if previous_text:
+        context["previous_text"] = previous_text
+    if next_text:
+        context["next_text"] = next_text
+    audio = providers.get_elevenlabs_client().text_to_speech.convert(
+        text=text,
+        voice_id=VOICE_ID,
+        model_id=MODEL_ID,
+        output_format=OUTPUT_FORMAT,
+        **context,
+    )
+    return audio if isinstance(audio, bytes) else b"".join(audio)
+
+async def astream_story_audio(story_text: str):
+    """
+    Converts a story to speech chunk by chunk and yields the MP3 bytes in order.
+
+    All chunks are scheduled up front and converted concurrently (at most
+    TTS_CHUNK_CONCURRENCY at a time), but each chunk is only yielded once every
+    chunk before it has been sent. Pending conversions are cancelled if the
+    consumer stops early.
+
+    Yields:
+        bytes: MP3 audio for the next chunk of the story.
+    """
+    chunks = split_story(story_text)
+    semaphore = asyncio.Semaphore(TTS_CHUNK_CONCURRENCY)
+
+    async def convert(index):
+        async with semaphore:
+            previous_text = chunks[index - 1] if index > 0 else None
+            next_text = chunks[index + 1] if index + 1 < len(chunks) else None
+            # ElevenLabs bills by character, so its tokens-per-minute limit counts characters
+            return await resilience.acall(
+                "elevenlabs",
+                lambda: run_blocking(convert_chunk, chunks[index], previous_text, next_text),
+                len(chunks[index]),
+            )
+
+    tasks = [asyncio.ensure_future(convert(index)) for index in range(len(chunks))]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
 
 def get_audio_base64_from_story(story_text):
     """
@@ -23,16 +110,9 @@ def get_audio_base64_from_story(story_text):
     """
     if not story_text:
         return {"error": "No story provided"}
-    
-   
-    audio = client.text_to_speech.convert(
-            text=story_text,
-            voice_id="JBFqnCBsd6RMkjVDRZzb",  # Change this to another voice if needed
-            model_id="eleven_multilingual_v2",
-            output_format="mp3_44100_128",
-        )
-        
-        # # Encode the audio bytes as a base64 string
-        # audio_base64 = base64.b64encode(audio).decode('utf-8')
-        
-    play(audio)
\ No newline at end of file
+
+    audio = resilience.call_blocking("elevenlabs", lambda: convert_chunk(story_text), len(story_text))
+
+    # Encode the audio bytes as a base64 string
+    audio_base64 = base64.b64encode(audio).decode('utf-8')
+    return {"audio_base64": audio_base64}